@@ -2,6 +2,8 @@
 from __future__ import annotations
 
 import collections
+import itertools
+import concurrent.futures
 import io
 import logging
 import os
@@ -9,25 +11,36 @@ import pprint
 import shutil
 import sys
 import tempfile
+import threading
 import time
 import tkinter as tk
 import urllib
-from typing import List, Dict, Tuple
+from typing import List, Dict, Iterable, Iterator, Set, Tuple
 
 import canvasapi
 import canvasapi.quiz
 import canvasapi.assignment
+import canvasapi.progress
+import canvasapi.submission
 import canvasapi.upload
+import canvasapi.user
 
 import html2text
 import pandas as pd
 import pymupdf as fitz
+import requests
+import requests.adapters
 import requests.exceptions
 
 import ai_helper
+import downloader
+import file_cache
 import grader as grader_module
 import misc
+import pipeline
 import question
+import roster
+import sync_state
 from misc import get_file_list
 import fuzzywuzzy.fuzz
 import colorama
@@ -193,17 +206,22 @@ class QuestionLocation:
 
 class CanvasAssignment(Assignment):
   canvas : canvasapi.Canvas = None
+  canvas_url : str = None
+  canvas_key : str = None
+  current_user_id : int = None
+  http_session : requests.Session = None
   
   def __init__(self, course_id : int, assignment_id : int, prod=False):
     if self.__class__.canvas is None:
+      # Store connection details on the class so that every assignment sharing the canvas object can use them
       if prod:
         log.debug("Using canvas PROD")
-        self.canvas_url = os.environ.get("CANVAS_API_URL_prod")
-        self.canvas_key = os.environ.get("CANVAS_API_KEY_prod")
+        self.__class__.canvas_url = os.environ.get("CANVAS_API_URL_prod")
+        self.__class__.canvas_key = os.environ.get("CANVAS_API_KEY_prod")
       else:
         log.debug("Using canvas DEV")
-        self.canvas_url = os.environ.get("CANVAS_API_URL")
-        self.canvas_key = os.environ.get("CANVAS_API_KEY")
+        self.__class__.canvas_url = os.environ.get("CANVAS_API_URL")
+        self.__class__.canvas_key = os.environ.get("CANVAS_API_KEY")
       self.__class__.canvas = canvasapi.Canvas(self.canvas_url, self.canvas_key)
     
     self.canvas_course = self.canvas.get_course(course_id)
@@ -211,6 +229,19 @@ class CanvasAssignment(Assignment):
     
     self.working_dir = tempfile.mkdtemp()
     self.submission_files = {}
+    # Submission objects fetched during this run, so grading and pushing don't need to ask canvas for them again
+    self.submissions_by_user_id : Dict[int, canvasapi.submission.Submission] = {}
+    self.submissions_lock = threading.Lock()
+    # Number of comments clobbered per user_id, for the end-of-run summary
+    self.clobber_counts : Dict[int, int] = {}
+    self.clobber_lock = threading.Lock()
+    # Tracks what has already been graded so reruns can skip it, if the subclass supports it
+    self.sync_state : sync_state.SyncState|None = None
+    # Submissions whose files haven't been downloaded yet, for when downloading is left to the grading pipeline
+    self.submissions_to_download : List[canvasapi.assignment.Submission] = []
+    self.download_all_variations = False
+    self.file_cache = file_cache.SubmissionFileCache()
+    self.roster = roster.CourseRoster(self.canvas_course, self.canvas_url)
     
     super().__init__([])
   
@@ -219,13 +250,49 @@ class CanvasAssignment(Assignment):
   
   def __exit__(self, exc_type, exc_val, exc_tb):
     shutil.rmtree(self.working_dir)
+    self.file_cache.close()
   
   def get_student_submissions(self, canvas_assignment: canvasapi.assignment, only_include_latest=True) -> List[canvasapi.assignment.Submission]:
     log.debug(f"get_student_submission({canvas_assignment}, {only_include_latest})")
     
-    return list(self.canvas_assignment.get_submissions(include='submission_history'))
+    return list(self.iter_student_submissions())
   
-  def download_submission_files(self, submissions: List[canvasapi.assignment.Submission], download_all_variations=False, download_dir=None, overwrite=False, user_id=None)\
+  def iter_student_submissions(
+      self,
+      workflow_state: str|None = None,
+      user_ids: List[int]|None = None,
+      submitted_since: str|None = None,
+      limit: int|None = None,
+      per_page=100
+  ) -> Iterator[canvasapi.submission.Submission]:
+    """
+    Yield submissions (with their history) a page at a time instead of pulling the whole course up front.
+    Filters are passed along to canvas's students/submissions endpoint so only matching submissions are sent back.
+    :param workflow_state: e.g. "submitted" to only get submissions that haven't been graded yet
+    :param user_ids: only get submissions for these users
+    :param submitted_since: ISO8601 timestamp, only get submissions made after it
+    :param limit: stop after this many submissions, only requesting as many pages as needed
+    :param per_page: page size to ask canvas for
+    """
+    log.debug(f"iter_student_submissions({workflow_state}, {user_ids}, {submitted_since}, {limit})")
+    
+    request_kwargs = {
+      "assignment_ids" : [self.canvas_assignment.id],
+      "student_ids" : user_ids if user_ids is not None else ["all"],
+      "include" : ["submission_history"],
+      "per_page" : per_page if limit is None else max(1, min(per_page, limit)),
+    }
+    if workflow_state is not None:
+      request_kwargs["workflow_state"] = workflow_state
+    if submitted_since is not None:
+      request_kwargs["submitted_since"] = submitted_since
+    
+    submissions = self.canvas_course.get_multiple_submissions(**request_kwargs)
+    if limit is not None:
+      return itertools.islice(submissions, limit)
+    return iter(submissions)
+  
+  def download_submission_files(self, submissions: List[canvasapi.assignment.Submission], download_all_variations=False, download_dir=None, overwrite=False, user_id=None, max_workers=8, use_file_cache=True, attachment_downloader=None)\
       -> Dict[Tuple[int, int, str],List[str]]:
     log.debug(f"download_submission_files(self, {len(submissions)} submissions)")
     
@@ -239,6 +306,8 @@ class CanvasAssignment(Assignment):
       os.mkdir(download_dir)
     
     submission_files = collections.defaultdict(list)
+    download_jobs = []
+    attachments_to_cache = []
     
     for student_submission in submissions:
       if student_submission.missing:
@@ -248,7 +317,7 @@ class CanvasAssignment(Assignment):
         continue
       
       # Get student name for posterity
-      student_name = self.canvas_course.get_user(student_submission.user_id)
+      student_name = self.get_user(student_submission.user_id)
       log.debug(f"For {student_submission.user_id} there are {len(student_submission.submission_history)} submissions")
       
       # Cycle through each attempt, but walk the list backwards so we grab the latest first, in case that's the only one we end up grading
@@ -261,20 +330,22 @@ class CanvasAssignment(Assignment):
           continue
         log.debug(f"Submission #{attempt_number+1} has {len(submission_attempt['attachments'])} variations")
         
-        # Download each attachment
+        # Queue up each attachment
         for attachment in submission_attempt['attachments']:
           
           # Generate a local file name with a number of options
           local_file_name = f"{student_name.name.replace(' ', '-')}_{attempt_number}_{student_submission.user_id}_{attachment['filename']}"
           local_path = os.path.join(download_dir, local_file_name)
           
-          # Download the file, overwriting if appropriate.
-          if overwrite or not os.path.exists(local_path):
-            log.debug(f"Downloading {attachment['url']} to {local_path}")
-            urllib.request.urlretrieve(attachment['url'], local_path)
-            time.sleep(0.1)
+          # Pull from the local file cache if we've seen this exact attachment before, otherwise queue it up for download
+          cached_path = self.file_cache.lookup(attachment) if use_file_cache else None
+          if cached_path is not None:
+            if overwrite or not os.path.exists(local_path):
+              log.debug(f"Using cached copy of {attachment['filename']} for {local_path}")
+              self.file_cache.link(cached_path, local_path)
           else:
-            log.debug(f"{local_path} already exists")
+            download_jobs.append((attachment['url'], local_path))
+            attachments_to_cache.append((attachment, local_path))
           
           # Store the local filenames on a per-(student,attempt) basis
           submission_files[(student_submission.user_id, attempt_number, student_name)].append(local_path)
@@ -282,8 +353,50 @@ class CanvasAssignment(Assignment):
         # Break if we were only supposed to download a single variation
         if not download_all_variations:
           break
+    
+    # Download everything at once so we can keep several requests in flight
+    log.debug(f"Downloading {len(download_jobs)} attachments")
+    if attachment_downloader is not None:
+      attachment_downloader.download(download_jobs, overwrite=overwrite)
+    else:
+      with downloader.AttachmentDownloader(headers=self.get_auth_headers(), max_workers=max_workers) as attachment_downloader:
+        attachment_downloader.download(download_jobs, overwrite=overwrite)
+    
+    if use_file_cache:
+      # Move the new downloads into the cache and link back out of it so identical files share storage
+      for attachment, local_path in attachments_to_cache:
+        self.file_cache.link(self.file_cache.add(attachment, local_path), local_path)
+      self.file_cache.prune()
+    
     return dict(submission_files)
   
+  def index_submissions(self, submissions: List[canvasapi.submission.Submission]):
+    with self.submissions_lock:
+      for submission in submissions:
+        self.submissions_by_user_id[submission.user_id] = submission
+  
+  def get_submission(self, user_id, refresh=False) -> canvasapi.submission.Submission:
+    """
+    Get a student's submission, reusing the one from the listing phase when we have it.
+    :param refresh: Fetch a fresh copy (with comments) from canvas, e.g. before deleting old comments
+    """
+    with self.submissions_lock:
+      if not refresh and user_id in self.submissions_by_user_id:
+        return self.submissions_by_user_id[user_id]
+    log.debug(f"Fetching submission for {user_id}")
+    submission = self.canvas_assignment.get_submission(user_id, include=["submission_comments"])
+    with self.submissions_lock:
+      self.submissions_by_user_id[user_id] = submission
+    return submission
+  
+  def get_user(self, user_id) -> canvasapi.user.User:
+    return self.roster.get_user(user_id)
+  
+  def get_auth_headers(self) -> Dict[str,str]:
+    if self.canvas_key is None:
+      return {}
+    return {"Authorization": f"Bearer {self.canvas_key}"}
+  
   def check_student_names(self, names_and_ids:List[Tuple[str, int]], threshold=0.8):
     
     id_width = max(map(lambda s: len(str(s[1])), names_and_ids))
@@ -294,7 +407,7 @@ class CanvasAssignment(Assignment):
     for student_name, user_id in names_and_ids:
       sys.stderr.write('.')
       sys.stderr.flush()
-      canvas_name = self.canvas_course.get_user(int(user_id)).name
+      canvas_name = self.get_user(user_id).name
       ratio = (fuzzywuzzy.fuzz.ratio(student_name, canvas_name) / 100.0)
       comparisons.append((
         ratio,
@@ -311,80 +424,346 @@ class CanvasAssignment(Assignment):
       
       log.debug(compare_str)
     
-  def push_feedback(self, user_id, score, feedback_text, attachments=[], clobber_feedback=False):
+  def push_feedback(self, user_id, score, feedback_text, attachments=[], clobber_feedback=False, clobber_dry_run=False) -> bool:
+    """
+    :return: Whether the grade and all of the comments made it to canvas (always True for a dry run)
+    """
     log.debug(f"Adding feedback for {user_id}")
     
     try:
-      self.canvas_assignment.submissions_bulk_update(
-        grade_data={
-          'submission[posted_grade]' : score
+      # We only need an up-to-date copy if we're going to be looking through existing comments
+      submission = self.get_submission(user_id, refresh=bool(clobber_feedback))
+      if clobber_dry_run:
+        return self.push_comments(submission, feedback_text, attachments, clobber_feedback=clobber_feedback, clobber_dry_run=True)
+      
+      # Push feedback to canvas
+      submission.edit(
+        submission={
+          'posted_grade':score,
         },
-        student_ids=[user_id]
       )
-      
-      submission = self.canvas_assignment.get_submission(user_id)
+      return self.push_comments(submission, feedback_text, attachments, clobber_feedback=clobber_feedback)
     except requests.exceptions.ConnectionError as e:
       log.error(e)
       log.debug(f"Failed on user_id = {user_id})")
-      log.debug(f"username: {self.canvas_course.get_user(user_id)}")
-      return
-      
-    # Push feedback to canvas
-    submission.edit(
-      submission={
-        'posted_grade':score,
-      },
-    )
-
+      log.debug(f"username: {self.get_user(user_id)}")
+      return False
+  
+  def push_comments(self, submission: canvasapi.submission.Submission, feedback_text, attachments=[], clobber_feedback=False, clobber_dry_run=False) -> bool:
+    """
+    Upload feedback text and attachments as comments on a submission.
+    :return: Whether every upload succeeded
+    :param clobber_feedback: True (or "all") deletes every existing comment first, "own" only deletes comments that
+      were authored by the account we're running as, i.e. feedback.txt files from previous runs
+    :param clobber_dry_run: Only count what clobbering would delete, without deleting or uploading anything
+    """
+    user_id = submission.user_id
+    
     if clobber_feedback:
       log.debug("Clobbering...")
-      
-      for comment in submission.submission_comments:
-        # log.debug(f"Existing comment: {comment}")
-        comment_id = comment['id']
-        # Construct the URL to delete the comment
-        delete_url = f"{self.canvas_url}/api/v1/courses/{self.canvas_course.id}/assignments/{self.canvas_assignment.id}/submissions/{user_id}/comments/{comment_id}"
-        
-        # Make the DELETE request to delete the comment
-        response = requests.delete(delete_url, headers={"Authorization": f"Bearer {self.canvas_key}"})
-        if response.status_code == 200:
-          print(f"Deleted comment {comment_id}")
-        else:
-          print(f"Failed to delete comment {comment_id}: {response.json()}")
-    
-    
-    def upload_buffer_as_file(buffer, name):
-      with io.FileIO(name, 'w+') as ffid:
-        ffid.write(buffer)
-        ffid.flush()
-        ffid.seek(0)
-        submission.upload_comment(ffid)
-      os.remove(name)
-    
+      comments_to_delete = self.get_comments_to_clobber(submission, own_only=(clobber_feedback == "own"))
+      with self.clobber_lock:
+        self.clobber_counts[user_id] = len(comments_to_delete)
+      if clobber_dry_run:
+        log.debug(f"Would delete {len(comments_to_delete)} comments for {user_id}")
+        return True
+      self.delete_comments(user_id, [comment['id'] for comment in comments_to_delete])
+    elif clobber_dry_run:
+      return True
+    
+    def upload_buffer_as_file(buffer, name) -> bool:
+      # Stage in a private directory since several students' comments may be uploading at the same time
+      upload_dir = tempfile.mkdtemp()
+      upload_path = os.path.join(upload_dir, os.path.basename(name))
+      try:
+        with io.FileIO(upload_path, 'w+') as ffid:
+          ffid.write(buffer)
+          ffid.flush()
+          ffid.seek(0)
+          uploaded, response = submission.upload_comment(ffid)
+      finally:
+        shutil.rmtree(upload_dir)
+      if not uploaded:
+        log.error(f"Failed to upload {name} for {user_id}: {response}")
+      return uploaded
+    
+    success = True
     if len(feedback_text) > 0:
-      upload_buffer_as_file(feedback_text.encode('utf-8'), "feedback.txt")
+      success = upload_buffer_as_file(feedback_text.encode('utf-8'), "feedback.txt") and success
       
     for i, attachment_buffer in enumerate(attachments):
-      upload_buffer_as_file(attachment_buffer.read(), attachment_buffer.name)
+      success = upload_buffer_as_file(attachment_buffer.read(), attachment_buffer.name) and success
+    return success
   
+  def get_current_user_id(self) -> int:
+    if self.__class__.current_user_id is None:
+      self.__class__.current_user_id = self.canvas.get_current_user().id
+    return self.__class__.current_user_id
   
-  def grade(self, grader: grader_module.Grader_old, push_feedback=False, clobber_feedback=False, *args, **kwargs):
-    # (student_submission.user_id, attempt_number, student_name), [local_paths]
-    for (current_user_id, attempt_number, student_name), files in self.submission_files.items():
-      log.debug(f"grading ({current_user_id}) : {files}")
+  def get_comments_to_clobber(self, submission: canvasapi.submission.Submission, own_only=False) -> List[Dict]:
+    comments = getattr(submission, "submission_comments", None) or []
+    if own_only:
+      comments = [comment for comment in comments if comment.get('author_id') == self.get_current_user_id()]
+    return comments
+  
+  @classmethod
+  def get_http_session(cls, pool_size=16) -> requests.Session:
+    """A pooled session for canvas calls that canvasapi doesn't cover, shared by every assignment and thread"""
+    if cls.http_session is None:
+      session = requests.Session()
+      adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+      session.mount("http://", adapter)
+      session.mount("https://", adapter)
+      session.headers.update({"Authorization": f"Bearer {cls.canvas_key}"})
+      cls.http_session = session
+    return cls.http_session
+  
+  def delete_comments(self, user_id, comment_ids: List[int], max_workers=8):
+    if len(comment_ids) == 0:
+      return
+    session = self.get_http_session()
+    
+    def delete_comment(comment_id):
+      # Construct the URL to delete the comment
+      delete_url = f"{self.canvas_url}/api/v1/courses/{self.canvas_course.id}/assignments/{self.canvas_assignment.id}/submissions/{user_id}/comments/{comment_id}"
+      
+      # Make the DELETE request to delete the comment
+      response = session.delete(delete_url)
+      if response.status_code == 200:
+        log.debug(f"Deleted comment {comment_id}")
+      else:
+        log.error(f"Failed to delete comment {comment_id}: {response.text}")
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(comment_ids))) as executor:
+      for future in concurrent.futures.as_completed([executor.submit(delete_comment, comment_id) for comment_id in comment_ids]):
+        future.result()
+  
+  def log_clobber_summary(self, dry_run=False):
+    with self.clobber_lock:
+      if len(self.clobber_counts) == 0:
+        return
+      num_comments = sum(self.clobber_counts.values())
+      num_students = len([count for count in self.clobber_counts.values() if count > 0])
+      self.clobber_counts = {}
+    log.info(f"{'Would delete' if dry_run else 'Deleted'} {num_comments} comments across {num_students} students")
+  
+  def wait_for_progress(self, progress: canvasapi.progress.Progress, poll_interval=1.0, max_poll_interval=10.0, timeout=600) -> bool:
+    """
+    Poll a canvas Progress object until its job finishes.
+    :return: True if the job completed successfully
+    """
+    start_time = time.time()
+    while progress.workflow_state not in ["completed", "failed"]:
+      if time.time() - start_time > timeout:
+        log.error(f"Gave up waiting on {progress} after {timeout}s")
+        return False
+      time.sleep(poll_interval)
+      poll_interval = min(2 * poll_interval, max_poll_interval)
+      progress.query()
+      log.debug(f"Progress: {progress} ({getattr(progress, 'completion', None)}%)")
+    if progress.workflow_state == "failed":
+      log.error(f"Canvas job failed: {getattr(progress, 'message', progress)}")
+      return False
+    return True
+  
+  def push_feedback_batch(self, feedback_by_user_id: Dict[int, misc.Feedback], clobber_feedback=False, clobber_dry_run=False, max_workers=8) -> Set[int]:
+    """
+    Push a whole grading run to canvas.
+    Grades for every student go out in a single submissions_bulk_update job, and then comments and attachments are
+    uploaded in parallel since canvas has no bulk endpoint for those.
+    :param feedback_by_user_id: Feedback to push, keyed by user_id
+    :param clobber_feedback: Whether to delete existing comments before uploading the new ones, see push_comments
+    :param clobber_dry_run: Only report how many comments clobbering would delete, without changing anything
+    :param max_workers: Number of students to upload comments for at once
+    :return: The user_ids whose grade or comments didn't make it to canvas, for the caller to retry or leave ungraded
+    """
+    if len(feedback_by_user_id) == 0:
+      return set()
+    log.info(f"Pushing grades for {len(feedback_by_user_id)} students")
+    
+    # Phase 1: all grades in one asynchronous job
+    if not clobber_dry_run:
       try:
-        submission = self.canvas_assignment.get_submission(current_user_id)
+        progress = self.canvas_assignment.submissions_bulk_update(
+          grade_data={
+            user_id : {'posted_grade' : feedback.overall_score}
+            for user_id, feedback in feedback_by_user_id.items()
+          }
+        )
+        completed = self.wait_for_progress(progress)
       except requests.exceptions.ConnectionError as e:
         log.error(e)
-        log.debug(f"Failed on user_id = {current_user_id})")
-        log.debug(f"username: {self.canvas_course.get_user(current_user_id)}")
-        continue
-      
-      # Grade submission
+        completed = False
+      if not completed:
+        log.error("Bulk grade update did not complete, not uploading comments")
+        return set(feedback_by_user_id.keys())
+    
+    # Phase 2: comments, which have to be done per student
+    def push_student_comments(user_id, feedback: misc.Feedback) -> bool:
+      if len(feedback.overall_feedback) == 0 and len(feedback.attachments) == 0 and not clobber_feedback:
+        return True
+      try:
+        submission = self.get_submission(user_id, refresh=bool(clobber_feedback))
+        return self.push_comments(submission, feedback.overall_feedback, feedback.attachments, clobber_feedback=clobber_feedback, clobber_dry_run=clobber_dry_run)
+      except requests.exceptions.ConnectionError as e:
+        log.error(e)
+        log.debug(f"Failed on user_id = {user_id})")
+        log.debug(f"username: {self.get_user(user_id)}")
+        return False
+    
+    failed_user_ids = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+      futures = {
+        executor.submit(push_student_comments, user_id, feedback) : user_id
+        for user_id, feedback in feedback_by_user_id.items()
+      }
+      for future in concurrent.futures.as_completed(futures):
+        if not future.result():
+          failed_user_ids.add(futures[future])
+    self.log_clobber_summary(dry_run=clobber_dry_run)
+    if len(failed_user_ids) > 0:
+      log.error(f"Could not push comments for {len(failed_user_ids)} students: {sorted(failed_user_ids)}")
+    return failed_user_ids
+  
+  def record_graded(self, user_ids):
+    """Note that these students' grades made it to canvas, so incremental runs can skip them"""
+    if self.sync_state is None:
+      return
+    for user_id in user_ids:
+      self.sync_state.record_graded(user_id)
+  
+  def grade(self, grader: grader_module.Grader_old, push_feedback=False, clobber_feedback=False, pipelined=False, clobber_dry_run=False, *args, grade_workers=1, **kwargs) -> Dict[int, misc.Feedback]:
+    """
+    :param grade_workers: How many students to grade at once, or "auto" to size it to this machine's cores and memory
+    """
+    grade_workers = self.get_grade_workers(grader, grade_workers)
+    try:
+      if pipelined:
+        return self.grade_pipelined(grader, push_feedback, clobber_feedback, *args, clobber_dry_run=clobber_dry_run, grade_workers=grade_workers, **kwargs)
+      return self.grade_serial(grader, push_feedback, clobber_feedback, *args, clobber_dry_run=clobber_dry_run, grade_workers=grade_workers, **kwargs)
+    finally:
+      if isinstance(grader, grader_module.Grader):
+        grader.cleanup()
+  
+  @staticmethod
+  def get_grade_workers(grader: grader_module.Grader, grade_workers) -> int:
+    if grade_workers == "auto":
+      grade_workers = misc.get_default_parallelism()
+      log.info(f"Grading {grade_workers} students at a time")
+    grade_workers = int(grade_workers)
+    if grade_workers > 1 and not getattr(grader, "supports_parallel_grading", False):
+      log.warning(f"{type(grader).__name__} can only grade one student at a time")
+      grade_workers = 1
+    if isinstance(grader, grader_module.Grader):
+      grader.set_parallelism(grade_workers)
+    return grade_workers
+  
+  def grade_student(self, grader: grader_module.Grader, current_user_id, files, *args, **kwargs) -> misc.Feedback:
+    with misc.log_tag(current_user_id):
+      log.debug(f"grading ({current_user_id}) : {files}")
       feedback: misc.Feedback = grader.grade_assignment(input_files=files, student_id=current_user_id, *args, **kwargs)
       log.debug(f"feedback: {feedback}")
+    return feedback
+  
+  def grade_serial(self, grader: grader_module.Grader, push_feedback=False, clobber_feedback=False, *args, clobber_dry_run=False, grade_workers=1, **kwargs) -> Dict[int, misc.Feedback]:
+    """Grade everything in self.submission_files, grade_workers students at a time, and then push the feedback in one batch"""
+    
+    # (student_submission.user_id, attempt_number, student_name), [local_paths]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=grade_workers) as executor:
+      futures = [
+        (current_user_id, executor.submit(self.grade_student, grader, current_user_id, files, *args, **kwargs))
+        for (current_user_id, attempt_number, student_name), files in self.submission_files.items()
+      ]
+      # Collected in submission order, so the results come out the same as grading one at a time
+      feedback_by_user_id : Dict[int, misc.Feedback] = {}
+      for current_user_id, future in futures:
+        try:
+          feedback_by_user_id[current_user_id] = future.result()
+        except Exception as e:
+          # Leave them out (and ungraded for the next run) rather than losing everyone else's grades
+          log.error(f"Grading failed for {current_user_id}: {e}")
+    
+    if push_feedback:
+      failed_user_ids = self.push_feedback_batch(feedback_by_user_id, clobber_feedback=clobber_feedback, clobber_dry_run=clobber_dry_run)
+      # Anything that didn't make it stays outstanding, so the next run picks it up again
+      if not clobber_dry_run:
+        self.record_graded(user_id for user_id in feedback_by_user_id.keys() if user_id not in failed_user_ids)
+    if self.sync_state is not None:
+      self.sync_state.save()
+    return feedback_by_user_id
+  
+  def grade_pipelined(
+      self,
+      grader: grader_module.Grader,
+      push_feedback=False,
+      clobber_feedback=False,
+      *args,
+      download_workers=4,
+      grade_workers=1,
+      push_workers=2,
+      queue_size=4,
+      clobber_dry_run=False,
+      **kwargs
+  ) -> Dict[int, misc.Feedback]:
+    """
+    Download, grade and push as a pipeline, so each student moves on to the next stage as soon as they are ready
+    rather than waiting for the whole class.  Each stage gets its own number of workers and the queues between them
+    are bounded by queue_size.
+    Submissions left in self.submissions_to_download by prepare_assignment_for_grading are downloaded as part of the
+    pipeline; anything already in self.submission_files is fed straight to grading.
+    """
+    feedback_by_user_id : Dict[int, misc.Feedback] = {}
+    stages = []
+    
+    attachment_downloader = downloader.AttachmentDownloader(headers=self.get_auth_headers(), max_workers=download_workers)
+    
+    def download_stage(student_submission):
+      # Returns the ((user_id, attempt_number, student_name), [local_paths]) pairs for this student
+      submission_files = self.download_submission_files(
+        [student_submission],
+        download_all_variations=self.download_all_variations,
+        attachment_downloader=attachment_downloader
+      )
+      self.submission_files.update(submission_files)
+      return list(submission_files.items())
+    
+    def grade_stage(key_and_files):
+      (current_user_id, attempt_number, student_name), files = key_and_files
+      return [(current_user_id, self.grade_student(grader, current_user_id, files, *args, **kwargs))]
+    
+    def push_stage(user_id_and_feedback):
+      user_id, feedback = user_id_and_feedback
       if push_feedback:
-        self.push_feedback(current_user_id, feedback.overall_score, feedback.overall_feedback, feedback.attachments, clobber_feedback=clobber_feedback)
+        pushed = self.push_feedback(user_id, feedback.overall_score, feedback.overall_feedback, feedback.attachments, clobber_feedback=clobber_feedback, clobber_dry_run=clobber_dry_run)
+        # Anything that didn't make it stays outstanding, so the next run picks it up again
+        if pushed and not clobber_dry_run:
+          self.record_graded([user_id])
+      return [user_id_and_feedback]
+    
+    if len(self.submissions_to_download) > 0:
+      items = list(self.submissions_to_download) + list(self.submission_files.items())
+      # Anything that was already downloaded skips the download stage by being passed through as-is
+      stages.append(pipeline.Stage(
+        "download",
+        (lambda item: download_stage(item) if isinstance(item, canvasapi.submission.Submission) else [item]),
+        num_workers=download_workers,
+        queue_size=queue_size
+      ))
+    else:
+      items = list(self.submission_files.items())
+    stages.append(pipeline.Stage("grade", grade_stage, num_workers=grade_workers, queue_size=queue_size))
+    stages.append(pipeline.Stage("push", push_stage, num_workers=push_workers, queue_size=queue_size))
+    
+    try:
+      for user_id, feedback in pipeline.Pipeline(stages).run(items):
+        feedback_by_user_id[user_id] = feedback
+    finally:
+      attachment_downloader.close()
+      if self.sync_state is not None:
+        self.sync_state.save()
+    self.log_clobber_summary(dry_run=clobber_dry_run)
+    self.submissions_to_download = []
+    return feedback_by_user_id
 
 
 
@@ -464,29 +843,64 @@ class CanvasProgrammingAssignment(CanvasAssignment):
     #   until I have time for a refactor
     super().__init__(course_id, assignment_id, prod)
     self.needs_grading = True
+    self.sync_state = sync_state.SyncState(course_id, assignment_id, self.canvas_url)
   
-  def prepare_assignment_for_grading(self, limit=None, regrade=False, only_include_latest=True, *args, **kwargs):
-    
-    # Grab assignment contents
-    assignment_submissions : List[canvasapi.assignment.Submission] = self.get_student_submissions(self.canvas_assignment, True)
-    log.debug(f"# assignment_submissions: {len(assignment_submissions)}")
-    
-    if regrade:
-      ungraded_submissions = assignment_submissions
-    # elif "user_ids" in kwargs and kwargs["user_ids"] is not None:
-    #   ungraded_submissions = list(filter(lambda s: s.user_id in kwargs["user_ids"], assignment_submissions))
-    else:
-      ungraded_submissions = list(filter(lambda s: s.workflow_state == "submitted", assignment_submissions))
-      
-    
-    if limit is not None:
-      ungraded_submissions = ungraded_submissions[:limit]
+  @staticmethod
+  def unique_by_user_id(submissions: Iterable[canvasapi.submission.Submission]) -> Iterator[canvasapi.submission.Submission]:
+    seen_user_ids = set()
+    for submission in submissions:
+      if submission.user_id in seen_user_ids:
+        continue
+      seen_user_ids.add(submission.user_id)
+      yield submission
+  
+  def prepare_assignment_for_grading(self, limit=None, regrade=False, only_include_latest=True, download=True, full_resync=False, *args, **kwargs):
+    """
+    Find the submissions that need grading and download their files.
+    Only submissions made since the last synced run, and whose attachments haven't already been graded, are picked up
+    unless full_resync is set.
+    If download is False the submissions are only queued up in self.submissions_to_download, so grade(pipelined=True)
+    can download them while it grades.
+    """
+    if full_resync:
+      log.info("Doing a full resync")
+      self.sync_state.reset()
+    
+    # Only ask for specific users if some were actually given
+    user_ids = None
+    if "user_ids" in kwargs and kwargs["user_ids"] is not None:
+      user_ids = [user_id for user_id in kwargs["user_ids"] if user_id is not None] or None
+    
+    # Grab assignment contents, letting canvas do the filtering so we only pull what we are going to grade
+    submissions = self.iter_student_submissions(
+      workflow_state=(None if regrade else "submitted"),
+      user_ids=user_ids,
+      submitted_since=(None if regrade else self.sync_state.submitted_at_watermark),
+      per_page=(100 if limit is None else limit)
+    )
+    # Students from earlier runs whose feedback didn't all make it may already be graded on canvas, so ask for them by id
+    retry_user_ids = sorted(u for u in self.sync_state.retry_user_ids if user_ids is None or u in user_ids)
+    if not regrade and len(retry_user_ids) > 0:
+      log.debug(f"Retrying {retry_user_ids} from an earlier run")
+      submissions = self.unique_by_user_id(itertools.chain(self.iter_student_submissions(user_ids=retry_user_ids), submissions))
+    # Then drop anything we've already graded, only fetching more pages if we still need more for the limit
+    ungraded_submissions : List[canvasapi.submission.Submission] = list(itertools.islice(
+      self.sync_state.filter_submissions(submissions, skip_graded=(not regrade)),
+      limit
+    ))
+    # Coming up short of the limit means the listing ran out, so it was complete anyway
+    self.sync_state.listing_complete = (user_ids is None and (limit is None or len(ungraded_submissions) < limit))
     
     self.needs_grading = len(list(ungraded_submissions)) != 0
     
     log.debug(f"# ungraded_submissions: {len(ungraded_submissions)}")
     
-    self.submission_files = self.download_submission_files(ungraded_submissions, download_all_variations=(not only_include_latest))
+    self.index_submissions(ungraded_submissions)
+    self.download_all_variations = (not only_include_latest)
+    if download:
+      self.submission_files = self.download_submission_files(ungraded_submissions, download_all_variations=self.download_all_variations)
+    else:
+      self.submissions_to_download = ungraded_submissions
   
 class CanvasAssignment_manual(CanvasAssignment):
   def prepare_assignment_for_grading(self, student_ids:List[int], limit=None, regrade=False, only_inlcude_latest=True):
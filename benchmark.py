@@ -0,0 +1,226 @@
+#!env python
+from __future__ import annotations
+
+import argparse
+import csv
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import assignment
+import fake_canvas
+import grader
+import misc
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+class BenchmarkGrader(grader.Grader):
+  """Hands back a fixed grade after an optional delay, so the benchmark measures the canvas side of a run"""
+  def __init__(self, delay=0.0, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.delay = delay
+
+  def grade_assignment(self, input_files: List[str], *args, **kwargs) -> misc.Feedback:
+    if self.delay > 0:
+      time.sleep(self.delay)
+    return misc.Feedback(overall_score=float(len(input_files)), overall_feedback=f"Graded {len(input_files)} files")
+
+
+def reset_canvas_connection(assignment_class):
+  # The canvas connection is cached on the class, so clear it out to point at a fresh fake server
+  for cls in assignment_class.__mro__:
+    if issubclass(cls, assignment.CanvasAssignment):
+      for attr in ["canvas", "canvas_url", "canvas_key", "current_user_id", "http_session"]:
+        if attr in cls.__dict__:
+          setattr(cls, attr, None)
+
+
+def run_benchmark(
+    num_students: int,
+    num_attachments=2,
+    attachment_size=4096,
+    latency=0.0,
+    rate_limit_capacity=700.0,
+    rate_limit_leak=10000.0,
+    grade_delay=0.0,
+    pipelined=False,
+    download_workers=4,
+    grade_workers=1,
+    push_workers=2
+) -> List[Dict]:
+  """
+  Time prepare_assignment_for_grading, grade and push_feedback against a fake canvas with num_students students.
+  :return: one row per phase with wall time and number of requests made
+  """
+  data = fake_canvas.FakeCanvasData.generate_course(num_students, num_attachments, attachment_size)
+
+  # Keep the caches from earlier runs (or from real grading) from making things look faster than they are
+  cache_dir = tempfile.mkdtemp()
+  previous_cache_dir = os.environ.get("GRADING_ASSISTANT_CACHE")
+  os.environ["GRADING_ASSISTANT_CACHE"] = cache_dir
+
+  rows = []
+  def record(phase, start_time, server: fake_canvas.FakeCanvasServer):
+    elapsed = time.time() - start_time
+    request_counts = server.reset_counts()
+    rows.append({
+      "students": num_students,
+      "mode": "pipelined" if pipelined else "phased",
+      "phase": phase,
+      "seconds": round(elapsed, 3),
+      "requests": sum(request_counts.values()),
+      "students_per_second": round(num_students / elapsed, 1) if elapsed > 0 else None,
+    })
+    log.info(f"{num_students} students, {phase}: {elapsed:0.2f}s, {sum(request_counts.values())} requests {dict(request_counts)}")
+
+  try:
+    with fake_canvas.FakeCanvasServer(
+        data,
+        latency=latency,
+        rate_limit_capacity=rate_limit_capacity,
+        rate_limit_leak=rate_limit_leak
+    ) as server:
+      os.environ["CANVAS_API_URL"] = server.url
+      os.environ["CANVAS_API_KEY"] = "fake-key"
+      reset_canvas_connection(assignment.CanvasProgrammingAssignment)
+
+      start_time = time.time()
+      with assignment.CanvasProgrammingAssignment(1, 1) as a:
+        record("setup", start_time, server)
+        benchmark_grader = BenchmarkGrader(delay=grade_delay)
+
+        start_time = time.time()
+        a.prepare_assignment_for_grading(download=(not pipelined))
+        record("prepare_assignment_for_grading", start_time, server)
+
+        if pipelined:
+          start_time = time.time()
+          a.grade(
+            benchmark_grader,
+            push_feedback=True,
+            pipelined=True,
+            download_workers=download_workers,
+            grade_workers=grade_workers,
+            push_workers=push_workers
+          )
+          record("grade+push_feedback", start_time, server)
+        else:
+          start_time = time.time()
+          feedback_by_user_id = a.grade(benchmark_grader, push_feedback=False)
+          record("grade", start_time, server)
+
+          start_time = time.time()
+          a.push_feedback_batch(feedback_by_user_id)
+          record("push_feedback", start_time, server)
+  finally:
+    if previous_cache_dir is None:
+      del os.environ["GRADING_ASSISTANT_CACHE"]
+    else:
+      os.environ["GRADING_ASSISTANT_CACHE"] = previous_cache_dir
+    shutil.rmtree(cache_dir)
+
+  return rows
+
+
+def run_backend_benchmark(assignment_path, submissions: List[List[str]], backends=("docker", "local"), use_online_repo=False, num_repeats=10) -> List[Dict]:
+  """
+  Grade the same submissions with each Grader_CST334 backend and time them.
+  :param submissions: the input files for each submission, as they would be passed to grade_assignment
+  :return: one row per backend and submission with the time taken and the score, so backends can be checked to agree
+  """
+  backend_classes = {"docker": grader.Grader_CST334, "local": grader.Grader_CST334_local}
+  rows = []
+  for backend in backends:
+    backend_grader = backend_classes[backend](assignment_path, use_online_repo=use_online_repo, use_result_cache=False)
+    try:
+      # Don't count the image build or checkout against the backend
+      backend_grader.get_image()
+      for i, input_files in enumerate(submissions):
+        start_time = time.time()
+        feedback = backend_grader.grade_assignment(input_files, student_id=i, num_repeats=num_repeats)
+        elapsed = time.time() - start_time
+        rows.append({
+          "backend": backend,
+          "submission": ' '.join(input_files),
+          "seconds": round(elapsed, 3),
+          "score": feedback.overall_score,
+        })
+        log.info(f"{backend}, {' '.join(input_files)}: {elapsed:0.2f}s, score {feedback.overall_score}")
+    finally:
+      backend_grader.cleanup()
+  return rows
+
+
+def parse_args():
+  parser = argparse.ArgumentParser(description="Time the canvas side of a grading run against a local fake canvas")
+  parser.add_argument("--students", type=int, nargs='+', default=[50, 500, 5000])
+  parser.add_argument("--attachments", type=int, default=2)
+  parser.add_argument("--attachment_size", type=int, default=4096)
+  parser.add_argument("--latency", type=float, default=0.01, help="Seconds added to every fake canvas request")
+  parser.add_argument("--rate_limit_capacity", type=float, default=700.0)
+  parser.add_argument("--rate_limit_leak", type=float, default=10000.0, help="Rate limit units regained per second")
+  parser.add_argument("--grade_delay", type=float, default=0.0, help="Seconds the stand-in grader takes per student")
+  parser.add_argument("--pipeline", action="store_true")
+  parser.add_argument("--download_workers", type=int, default=4)
+  parser.add_argument("--grade_workers", type=int, default=1)
+  parser.add_argument("--push_workers", type=int, default=2)
+  parser.add_argument("--backends", nargs='+', choices=["docker", "local"], default=None, help="Compare grading backends on --submissions instead of benchmarking canvas")
+  parser.add_argument("--assignment_path", default="PA1", help="Programming assignment to grade --submissions as")
+  parser.add_argument("--submissions", nargs='+', default=[], help="student_code.c files (or directories of a submission's files) to grade with each backend")
+  parser.add_argument("--num_repeats", type=int, default=10)
+  parser.add_argument("--online", action="store_true")
+  parser.add_argument("--output", default=None, help="CSV file to write results to")
+  parser.add_argument("--verbose", action="store_true")
+  return parser.parse_args()
+
+
+def main():
+  args = parse_args()
+
+  if not args.verbose:
+    # Per-student debug logging would dominate the timings
+    for module_name in ["assignment", "downloader", "file_cache", "roster", "sync_state", "pipeline", "grader", "fake_canvas", "container_pool", "image_builder"]:
+      logging.getLogger(module_name).setLevel(logging.WARNING)
+
+  rows = []
+  if args.backends is not None:
+    submissions = [
+      [os.path.join(submission, f) for f in sorted(os.listdir(submission))] if os.path.isdir(submission) else [submission]
+      for submission in args.submissions
+    ]
+    rows = run_backend_benchmark(args.assignment_path, submissions, args.backends, use_online_repo=args.online, num_repeats=args.num_repeats)
+  else:
+    for num_students in args.students:
+      rows.extend(run_benchmark(
+        num_students,
+        num_attachments=args.attachments,
+        attachment_size=args.attachment_size,
+        latency=args.latency,
+        rate_limit_capacity=args.rate_limit_capacity,
+        rate_limit_leak=args.rate_limit_leak,
+        grade_delay=args.grade_delay,
+        pipelined=args.pipeline,
+        download_workers=args.download_workers,
+        grade_workers=args.grade_workers,
+        push_workers=args.push_workers
+      ))
+
+  output = open(args.output, 'w', newline='') if args.output is not None else sys.stdout
+  try:
+    writer = csv.DictWriter(output, fieldnames=list(rows[0].keys()))
+    writer.writeheader()
+    writer.writerows(rows)
+  finally:
+    if output is not sys.stdout:
+      output.close()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,280 @@
+#!env python
+from __future__ import annotations
+
+import atexit
+import concurrent.futures
+import io
+import logging
+import shutil
+import tarfile
+import threading
+import time
+from typing import Dict, List
+
+import docker
+import docker.errors
+import docker.models.containers
+import docker.types
+
+import misc
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+class ContainerPool:
+  """
+  Keeps a handful of containers from one image running so that grading runs don't each pay for starting and removing
+  a container.  Student code runs as root in these containers, so nothing it could have changed is trusted between
+  uses: the root filesystem is read-only, tmpfs_paths are emptied, and each of reset_paths is a volume that is emptied
+  and refilled from an archive of the image's copy that we hold on the host.  Anything still running is killed first.
+  Containers that fail a health check, fail to reset or have been used max_uses times are replaced.
+  If results_mount is given, each container gets its own host directory (see misc.make_results_dir) mounted there,
+  which is emptied along with the rest of the reset.
+  """
+
+  def __init__(
+      self,
+      client: docker.DockerClient,
+      image,
+      size=4,
+      max_uses=50,
+      reset_paths=("/tmp/grading",),
+      tmpfs_paths=("/tmp", "/var/tmp"),
+      scratch_paths=("/tmp/results.json",),
+      results_mount=None,
+      read_only=True,
+      acquire_timeout=600
+  ):
+    self.client = client
+    self.image = image
+    self.size = size
+    self.max_uses = max_uses
+    self.reset_paths = list(reset_paths)
+    self.tmpfs_paths = list(tmpfs_paths)
+    self.scratch_paths = list(scratch_paths)
+    self.results_mount = results_mount
+    self.read_only = read_only
+    self.acquire_timeout = acquire_timeout
+    # container id -> host directory mounted at results_mount
+    self.results_dirs : Dict[str, str] = {}
+    # reset path -> tarball of its contents in the image, taken before any student code ran
+    self.pristine : Dict[str, bytes]|None = None
+    self.pristine_lock = threading.Lock()
+
+    self.idle : List[docker.models.containers.Container] = []
+    self.uses : Dict[str, int] = {}
+    self.num_containers = 0
+    self.closed = False
+    self.condition = threading.Condition()
+
+    # Counters for the end-of-run summary
+    self.num_created = 0
+    self.num_reused = 0
+    self.num_replaced = 0
+
+    atexit.register(self.close)
+
+  def warm(self, num_containers=None):
+    """Start containers up front (in parallel) so the first few grading runs don't wait on them"""
+    if num_containers is None:
+      num_containers = self.size
+    with self.condition:
+      num_containers = min(num_containers, self.size - self.num_containers)
+      self.num_containers += num_containers
+    if num_containers <= 0:
+      return
+    log.info(f"Starting {num_containers} pooled containers")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_containers) as executor:
+      futures = [executor.submit(self.create_container) for _ in range(num_containers)]
+      for future in concurrent.futures.as_completed(futures):
+        try:
+          container = future.result()
+        except docker.errors.DockerException as e:
+          log.error(f"Could not start pooled container: {e}")
+          with self.condition:
+            self.num_containers -= 1
+            self.condition.notify()
+          continue
+        with self.condition:
+          self.idle.append(container)
+          self.condition.notify()
+
+  @staticmethod
+  def strip_archive_root(data: bytes) -> bytes:
+    """Turn a get_archive tarball of a directory into one of its contents, to put_archive into the directory itself"""
+    stripped = io.BytesIO()
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r") as source, tarfile.open(fileobj=stripped, mode="w") as dest:
+      for member in source:
+        if '/' not in member.name:
+          continue
+        extracted = source.extractfile(member) if member.isfile() else None
+        member.name = member.name.split('/', 1)[1]
+        if member.islnk():
+          member.linkname = member.linkname.split('/', 1)[1]
+        dest.addfile(member, extracted)
+    return stripped.getvalue()
+
+  def get_pristine(self) -> Dict[str, bytes]:
+    """Archives of reset_paths as they are in the image, read from a container that is never started"""
+    with self.pristine_lock:
+      if self.pristine is None:
+        container = self.client.containers.create(image=self.image, labels={"grading_assistant": "pool"})
+        try:
+          pristine = {}
+          for path in self.reset_paths:
+            stream, _ = container.get_archive(path)
+            pristine[path] = self.strip_archive_root(b"".join(stream))
+        finally:
+          container.remove(force=True)
+        self.pristine = pristine
+      return self.pristine
+
+  def create_container(self) -> docker.models.containers.Container:
+    pristine = self.get_pristine()
+    results_dir = None
+    volumes = {}
+    group_add = []
+    if self.results_mount is not None:
+      results_dir = misc.make_results_dir()
+      volumes[results_dir] = {"bind": self.results_mount, "mode": "rw"}
+      group_add = misc.results_dir_group_add()
+    container = self.client.containers.run(
+      image=self.image,
+      detach=True,
+      tty=True,
+      read_only=self.read_only,
+      tmpfs={path: "rw,exec,mode=1777" for path in self.tmpfs_paths},
+      # Anonymous volumes, which go away with the container
+      mounts=[docker.types.Mount(target=path, source=None, type="volume") for path in self.reset_paths],
+      volumes=volumes,
+      group_add=group_add,
+      labels={"grading_assistant": "pool"}
+    )
+    if results_dir is not None:
+      self.results_dirs[container.id] = results_dir
+    if not self.restore(container, pristine):
+      self.remove_container(container)
+      raise docker.errors.DockerException(f"Could not fill {self.reset_paths} in pooled container {container.short_id}")
+    self.uses[container.id] = 0
+    self.num_created += 1
+    return container
+
+  def get_results_dir(self, container: docker.models.containers.Container) -> str|None:
+    """Host directory that is mounted at results_mount in container"""
+    return self.results_dirs.get(container.id)
+
+  def remove_container(self, container: docker.models.containers.Container):
+    try:
+      container.remove(force=True, v=True)
+    except docker.errors.APIError as e:
+      log.warning(f"Could not remove container {container.short_id}: {e}")
+    results_dir = self.results_dirs.pop(container.id, None)
+    if results_dir is not None:
+      shutil.rmtree(results_dir, ignore_errors=True)
+
+  @staticmethod
+  def is_healthy(container: docker.models.containers.Container) -> bool:
+    try:
+      container.reload()
+      if container.status != "running":
+        return False
+      rc, _ = container.exec_run(["true"])
+      return rc == 0
+    except docker.errors.APIError as e:
+      log.warning(f"Health check failed for container {container.short_id}: {e}")
+      return False
+
+  def restore(self, container: docker.models.containers.Container, pristine: Dict[str, bytes]) -> bool:
+    """Empty everything a grading run could have written to and refill reset_paths from the host's archives"""
+    mount_points = self.reset_paths + ([self.results_mount] if self.results_mount is not None else [])
+    # kill -1 signals everything but init and the calling shell, which clears out anything a student left running
+    commands = ["kill -9 -1 2>/dev/null; true"]
+    for path in self.tmpfs_paths:
+      # -xdev leaves the volumes and results directory mounted inside the tmpfs to be emptied below
+      exclusions = ' '.join(f"! -path {mount_point}" for mount_point in mount_points)
+      commands.append(f"find {path} -xdev -mindepth 1 {exclusions} -delete")
+    for mount_point in mount_points:
+      commands.append(f"find {mount_point} -mindepth 1 -delete")
+    if len(self.scratch_paths) > 0:
+      commands.append(f"rm -rf {' '.join(self.scratch_paths)}")
+    try:
+      rc, output = container.exec_run(["bash", "-c", " && ".join(commands)])
+      if rc != 0:
+        log.warning(f"Could not reset container {container.short_id}: {output}")
+        return False
+      for path, data in pristine.items():
+        if not container.put_archive(path, data):
+          log.warning(f"Could not restore {path} in container {container.short_id}")
+          return False
+    except docker.errors.APIError as e:
+      log.warning(f"Could not reset container {container.short_id}: {e}")
+      return False
+    return True
+
+  def reset(self, container: docker.models.containers.Container) -> bool:
+    return self.restore(container, self.get_pristine())
+
+  def acquire(self) -> docker.models.containers.Container:
+    """Hand out a healthy, freshly reset container, starting a new one if the pool has room"""
+    deadline = time.time() + self.acquire_timeout
+    while True:
+      with self.condition:
+        while len(self.idle) == 0 and self.num_containers >= self.size:
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            raise TimeoutError(f"No pooled container became available within {self.acquire_timeout}s")
+          self.condition.wait(timeout=remaining)
+        if len(self.idle) > 0:
+          container = self.idle.pop()
+        else:
+          container = None
+          self.num_containers += 1
+
+      if container is None:
+        try:
+          return self.create_container()
+        except docker.errors.DockerException:
+          with self.condition:
+            self.num_containers -= 1
+            self.condition.notify()
+          raise
+
+      if self.is_healthy(container):
+        if self.uses.get(container.id, 0) > 0:
+          self.num_reused += 1
+        return container
+      log.warning(f"Pooled container {container.short_id} is unhealthy, replacing it")
+      self.discard(container)
+
+  def release(self, container: docker.models.containers.Container):
+    """Return a container to the pool, resetting it for the next run or replacing it if it is worn out or broken"""
+    self.uses[container.id] = self.uses.get(container.id, 0) + 1
+    if self.closed or self.uses[container.id] >= self.max_uses or not self.reset(container):
+      self.discard(container)
+      return
+    with self.condition:
+      self.idle.append(container)
+      self.condition.notify()
+
+  def discard(self, container: docker.models.containers.Container):
+    self.remove_container(container)
+    self.uses.pop(container.id, None)
+    with self.condition:
+      self.num_containers -= 1
+      if not self.closed:
+        self.num_replaced += 1
+      self.condition.notify()
+
+  def close(self):
+    with self.condition:
+      if self.closed:
+        return
+      self.closed = True
+      idle, self.idle = self.idle, []
+    for container in idle:
+      self.remove_container(container)
+    with self.condition:
+      self.num_containers -= len(idle)
+    log.info(f"Closed container pool: {self.num_created} containers started, {self.num_reused} reuses, {self.num_replaced} replaced")
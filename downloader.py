@@ -0,0 +1,202 @@
+#!env python
+from __future__ import annotations
+
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Tuple
+
+import requests
+import requests.adapters
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+class ConcurrencyLimiter:
+  """
+  A semaphore whose limit can be changed while it is in use.
+  Used to shrink and grow the number of in-flight requests based on what canvas tells us about our rate limit.
+  """
+  def __init__(self, limit: int, min_limit: int = 1, max_limit: int|None = None):
+    self.min_limit = min_limit
+    self.max_limit = max_limit if max_limit is not None else limit
+    self.limit = max(min_limit, min(limit, self.max_limit))
+    self.in_flight = 0
+    self.condition = threading.Condition()
+
+  def __enter__(self):
+    with self.condition:
+      while self.in_flight >= self.limit:
+        self.condition.wait()
+      self.in_flight += 1
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    with self.condition:
+      self.in_flight -= 1
+      self.condition.notify_all()
+    return False
+
+  def set_limit(self, new_limit: int):
+    with self.condition:
+      new_limit = max(self.min_limit, min(new_limit, self.max_limit))
+      if new_limit != self.limit:
+        log.debug(f"Adjusting download concurrency from {self.limit} to {new_limit}")
+      self.limit = new_limit
+      self.condition.notify_all()
+
+
+class AttachmentDownloader:
+  """
+  Downloads submission attachments with a bounded pool of workers.
+
+  Concurrency follows an additive-increase/multiplicative-decrease scheme driven by canvas's X-Rate-Limit-Remaining
+  header: when the remaining quota falls below `low_water_mark` we halve the number of in-flight requests, and when it
+  is above `high_water_mark` we allow one more.  Files are written to a `.part` file first (which misc.get_file_list
+  ignores) and only moved into place once complete, so an interrupted download will be resumed with a Range request.
+  """
+
+  RATE_LIMIT_HEADER = "X-Rate-Limit-Remaining"
+
+  def __init__(
+      self,
+      headers: Dict[str,str]|None = None,
+      max_workers=8,
+      initial_workers=4,
+      low_water_mark=200.0,
+      high_water_mark=500.0,
+      max_retries=5,
+      chunk_size=1024*1024,
+      timeout=60
+  ):
+    self.max_workers = max_workers
+    self.low_water_mark = low_water_mark
+    self.high_water_mark = high_water_mark
+    self.max_retries = max_retries
+    self.chunk_size = chunk_size
+    self.timeout = timeout
+    self.limiter = ConcurrencyLimiter(initial_workers, min_limit=1, max_limit=max_workers)
+
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
+    if headers is not None:
+      self.session.headers.update(headers)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+    return False
+
+  def close(self):
+    self.session.close()
+
+  def update_from_response(self, response: requests.Response):
+    # Attachment URLs redirect off to file storage, so the rate limit header is usually on a response in the history
+    readings = []
+    for r in [*response.history, response]:
+      try:
+        readings.append(float(r.headers[self.RATE_LIMIT_HEADER]))
+      except (KeyError, ValueError):
+        continue
+    if len(readings) == 0:
+      return
+    remaining = min(readings)
+    if remaining < self.low_water_mark:
+      self.limiter.set_limit(self.limiter.limit // 2)
+    elif remaining > self.high_water_mark:
+      self.limiter.set_limit(self.limiter.limit + 1)
+
+  def download_file(self, url, local_path, overwrite=False) -> str:
+    """
+    Download a single file to local_path, resuming from local_path.part if a previous attempt was interrupted.
+    :return: local_path
+    """
+    if os.path.exists(local_path) and not overwrite:
+      log.debug(f"{local_path} already exists")
+      return local_path
+
+    part_path = f"{local_path}.part"
+    if overwrite and os.path.exists(part_path):
+      os.remove(part_path)
+
+    for attempt in range(self.max_retries):
+      headers = {}
+      already_downloaded = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+      if already_downloaded > 0:
+        headers["Range"] = f"bytes={already_downloaded}-"
+
+      try:
+        with self.limiter:
+          log.debug(f"Downloading {url} to {local_path}" + (f" (resuming at {already_downloaded})" if already_downloaded else ""))
+          with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            self.update_from_response(response)
+
+            if response.status_code in [403, 429] and "Rate Limit" in response.text:
+              # Canvas signals throttling with a 403, so back off hard and try again
+              self.limiter.set_limit(self.limiter.limit // 2)
+              raise requests.exceptions.RetryError(f"Rate limited while downloading {url}")
+            if response.status_code == 416:
+              # We asked for a range past the end, meaning the part file already holds everything
+              break
+            response.raise_for_status()
+
+            mode = "ab" if (already_downloaded > 0 and response.status_code == 206) else "wb"
+            with open(part_path, mode) as fid:
+              for chunk in response.iter_content(chunk_size=self.chunk_size):
+                fid.write(chunk)
+        break
+      except (
+          requests.exceptions.ConnectionError,
+          requests.exceptions.Timeout,
+          requests.exceptions.RetryError,
+          requests.exceptions.ChunkedEncodingError,  # connection dropped mid-body, the part file lets us resume
+      ) as e:
+        if attempt + 1 >= self.max_retries:
+          raise
+        backoff = (2 ** attempt) + random.random()
+        log.warning(f"Download of {url} failed ({e}), retrying in {backoff:0.1f}s")
+        time.sleep(backoff)
+
+    os.replace(part_path, local_path)
+    return local_path
+
+  def download(self, jobs: List[Tuple[str, str]], overwrite=False) -> List[str]:
+    """
+    Download a batch of files concurrently.
+    :param jobs: Format is [(url, local_path), ...]
+    :param overwrite: Whether to redownload files that already exist locally
+    :return: List of local paths, in the same order as jobs
+    """
+    if len(jobs) == 0:
+      return []
+
+    # Two workers writing the same .part file would corrupt it, so only fetch each local path once
+    unique_jobs = dict((local_path, url) for url, local_path in jobs)
+    
+    errors = []
+    with ThreadPoolExecutor(max_workers=min(self.max_workers, len(unique_jobs))) as executor:
+      futures = {
+        executor.submit(self.download_file, url, local_path, overwrite): (url, local_path)
+        for local_path, url in unique_jobs.items()
+      }
+      for future in as_completed(futures):
+        try:
+          future.result()
+        except Exception as e:
+          url, local_path = futures[future]
+          log.error(f"Failed to download {url} to {local_path}: {e}")
+          errors.append(e)
+
+    if len(errors) > 0:
+      # Partial downloads are left in place as .part files so a rerun will pick up where we left off
+      raise errors[0]
+    return [local_path for _, local_path in jobs]
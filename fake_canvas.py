@@ -0,0 +1,538 @@
+#!env python
+from __future__ import annotations
+
+import argparse
+import collections
+import email.parser
+import email.policy
+import itertools
+import json
+import logging
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+def timestamp(t: float) -> str:
+  return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t))
+
+
+class FakeCanvasData:
+  """
+  In-memory course state for the fake canvas server.
+  Only holds what the endpoints used by this repo need: courses, assignments, users, submissions with history and
+  attachments, comments, uploaded files and bulk-update progress objects.
+  """
+  def __init__(self):
+    self.courses : Dict[int, Dict] = {}
+    self.assignments : Dict[int, Dict] = {}
+    self.users : Dict[int, Dict] = {}
+    self.enrollments : Dict[int, List[int]] = collections.defaultdict(list)
+    self.submissions : Dict[Tuple[int, int], Dict] = {}
+    self.files : Dict[int, bytes] = {}
+    self.progress : Dict[int, Dict] = {}
+    self.upload_tokens : Dict[str, Dict] = {}
+    self.instructor = {"id": 1, "name": "Fake Instructor", "sortable_name": "Instructor, Fake", "short_name": "Fake Instructor"}
+
+    self.ids = itertools.count(1000)
+    self.lock = threading.RLock()
+
+  def next_id(self) -> int:
+    with self.lock:
+      return next(self.ids)
+
+  @classmethod
+  def generate_course(
+      cls,
+      num_students: int,
+      num_attachments: int = 2,
+      attachment_size: int = 4096,
+      num_attempts: int = 1,
+      fraction_submitted: float = 1.0,
+      course_id: int = 1,
+      assignment_id: int = 1,
+      seed: int = 0
+  ) -> FakeCanvasData:
+    """
+    Build a synthetic course with a single programming assignment.
+    :param num_students: number of enrolled students
+    :param num_attachments: attachments per submission attempt
+    :param attachment_size: size of each attachment in bytes
+    :param num_attempts: number of attempts in each student's submission history
+    :param fraction_submitted: fraction of students whose latest submission is waiting to be graded
+    """
+    rng = random.Random(seed)
+    data = cls()
+    data.courses[course_id] = {"id": course_id, "name": f"Fake Course {course_id}", "course_code": f"FAKE{course_id}"}
+    data.assignments[assignment_id] = {
+      "id": assignment_id,
+      "course_id": course_id,
+      "name": f"Fake Assignment {assignment_id}",
+      "points_possible": 100,
+    }
+
+    start_time = time.time() - 7 * 24 * 60 * 60
+    for i in range(num_students):
+      user_id = 10000 + i
+      data.users[user_id] = {
+        "id": user_id,
+        "name": f"Student {i:05}",
+        "sortable_name": f"{i:05}, Student",
+        "short_name": f"Student {i:05}",
+        "login_id": f"student{i:05}",
+      }
+      data.enrollments[course_id].append(user_id)
+
+      history = []
+      for attempt in range(num_attempts):
+        submitted_at = timestamp(start_time + rng.uniform(0, 6 * 24 * 60 * 60) + attempt)
+        attachments = []
+        for j in range(num_attachments):
+          file_id = data.next_id()
+          filename = "student_code.c" if j == 0 else ("student_code.h" if j == 1 else f"extra_{j}.txt")
+          data.files[file_id] = rng.randbytes(attachment_size)
+          attachments.append({
+            "id": file_id,
+            "filename": filename,
+            "display_name": filename,
+            "size": attachment_size,
+            "updated_at": submitted_at,
+          })
+        history.append({"attempt": attempt + 1, "submitted_at": submitted_at, "attachments": attachments})
+
+      submitted = rng.random() < fraction_submitted
+      data.submissions[(assignment_id, user_id)] = {
+        "id": data.next_id(),
+        "user_id": user_id,
+        "assignment_id": assignment_id,
+        "course_id": course_id,
+        "attempt": num_attempts,
+        "workflow_state": "submitted" if submitted else "graded",
+        "submitted_at": history[-1]["submitted_at"],
+        "graded_at": None if submitted else history[-1]["submitted_at"],
+        "missing": False,
+        "score": None,
+        "grade": None,
+        "submission_history": history,
+        "submission_comments": [],
+      }
+    return data
+
+
+class FakeCanvasServer:
+  """
+  A local stand-in for the canvas REST API, for load testing without touching a real course.
+
+  Every response carries canvas-style rate limit headers from a leaky bucket (capacity `rate_limit_capacity`, draining
+  at `rate_limit_leak` units per second, `request_cost` units per request), and a request that would overflow the
+  bucket gets canvas's 403 "Rate Limit Exceeded" response.  `latency` seconds are added to every request.
+
+    with FakeCanvasServer(FakeCanvasData.generate_course(50)) as server:
+      canvas = canvasapi.Canvas(server.url, "fake-key")
+  """
+
+  def __init__(
+      self,
+      data: FakeCanvasData,
+      host="127.0.0.1",
+      port=0,
+      latency=0.0,
+      rate_limit_capacity=700.0,
+      rate_limit_leak=10.0,
+      request_cost=1.0,
+      progress_delay=0.5
+  ):
+    self.data = data
+    self.latency = latency
+    self.rate_limit_capacity = rate_limit_capacity
+    self.rate_limit_leak = rate_limit_leak
+    self.request_cost = request_cost
+    self.progress_delay = progress_delay
+
+    self.bucket_level = 0.0
+    self.bucket_updated = time.time()
+    self.bucket_lock = threading.Lock()
+
+    self.request_counts : Dict[str, int] = collections.Counter()
+    self.counts_lock = threading.Lock()
+
+    self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+    self.httpd.daemon_threads = True
+    self.url = f"http://{host}:{self.httpd.server_address[1]}"
+    self.thread = None
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.stop()
+    return False
+
+  def start(self):
+    self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+    self.thread.start()
+    log.info(f"Fake canvas listening on {self.url}")
+
+  def stop(self):
+    self.httpd.shutdown()
+    self.httpd.server_close()
+
+  def reset_counts(self) -> Dict[str, int]:
+    with self.counts_lock:
+      counts = dict(self.request_counts)
+      self.request_counts = collections.Counter()
+    return counts
+
+  def take_from_bucket(self) -> float|None:
+    """Charge one request to the rate limit bucket, returning what is left or None if the request should be refused"""
+    with self.bucket_lock:
+      now = time.time()
+      self.bucket_level = max(0.0, self.bucket_level - (now - self.bucket_updated) * self.rate_limit_leak)
+      self.bucket_updated = now
+      if self.bucket_level + self.request_cost > self.rate_limit_capacity:
+        return None
+      self.bucket_level += self.request_cost
+      return self.rate_limit_capacity - self.bucket_level
+
+  ## Helpers for building responses ##
+
+  def api_url(self, path) -> str:
+    return f"{self.url}/api/v1/{path}"
+
+  def render_submission(self, submission: Dict, include: List[str]) -> Dict:
+    rendered = {k: v for k, v in submission.items() if k not in ["submission_history", "submission_comments"]}
+    if "submission_history" in include:
+      rendered["submission_history"] = [
+        dict(attempt, attachments=[
+          dict(attachment, url=f"{self.url}/files/{attachment['id']}/download?verifier=fake")
+          for attachment in attempt["attachments"]
+        ])
+        for attempt in submission["submission_history"]
+      ]
+    if "submission_comments" in include:
+      rendered["submission_comments"] = list(submission["submission_comments"])
+    return rendered
+
+  def update_submission(self, submission: Dict, posted_grade=None, file_ids=None, text_comment=None):
+    with self.data.lock:
+      if posted_grade is not None:
+        submission["score"] = float(posted_grade) if posted_grade not in ["", "None"] else None
+        submission["grade"] = posted_grade
+        submission["workflow_state"] = "graded"
+        submission["graded_at"] = timestamp(time.time())
+      if file_ids or text_comment:
+        submission["submission_comments"].append({
+          "id": self.data.next_id(),
+          "author_id": self.data.instructor["id"],
+          "comment": text_comment or "",
+          "created_at": timestamp(time.time()),
+          "attachments": [{"id": int(file_id)} for file_id in (file_ids or [])],
+        })
+
+  def _make_handler(self):
+    server = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = "HTTP/1.1"
+      # Headers and body go out in separate writes, which stalls on delayed ACKs with keep-alive unless Nagle is off
+      disable_nagle_algorithm = True
+
+      def log_message(self, format, *args):
+        pass
+
+      def send_json(self, body, status=200, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for k, v in (headers or {}).items():
+          self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(payload)
+
+      def send_paginated(self, items: List, path: str, query: Dict[str, List[str]], rate_headers):
+        per_page = int(query.get("per_page", ["10"])[0])
+        page = int(query.get("page", ["1"])[0])
+        page_items = items[(page - 1) * per_page : page * per_page]
+        headers = dict(rate_headers)
+        if page * per_page < len(items):
+          next_query = {k: v for k, v in query.items() if k != "page"}
+          next_query["page"] = [str(page + 1)]
+          headers["Link"] = f'<{server.api_url(path)}?{urllib.parse.urlencode(next_query, doseq=True)}>; rel="next"'
+        self.send_json(page_items, headers=headers)
+
+      def read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length > 0 else b""
+
+      def read_form(self) -> Dict[str, List[str]]:
+        return urllib.parse.parse_qs(self.read_body().decode(), keep_blank_values=True)
+
+      def handle_any(self, method):
+        parsed = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(parsed.query, keep_blank_values=True)
+        path = parsed.path
+
+        if server.latency > 0:
+          time.sleep(server.latency)
+
+        remaining = server.take_from_bucket()
+        if remaining is None:
+          self.read_body()
+          body = b"403 Forbidden (Rate Limit Exceeded)"
+          self.send_response(403)
+          self.send_header("Content-Length", str(len(body)))
+          self.send_header("X-Rate-Limit-Remaining", "0.0")
+          self.end_headers()
+          self.wfile.write(body)
+          return
+        rate_headers = {"X-Rate-Limit-Remaining": f"{remaining:0.1f}", "X-Request-Cost": f"{server.request_cost:0.1f}"}
+
+        for route_method, pattern, route_name, route_handler in ROUTES:
+          if route_method != method:
+            continue
+          match = re.fullmatch(pattern, path)
+          if match is None:
+            continue
+          with server.counts_lock:
+            server.request_counts[route_name] += 1
+          route_handler(self, query, rate_headers, *[int(g) if g.isdigit() else g for g in match.groups()])
+          return
+
+        self.read_body()
+        self.send_json({"errors": [{"message": f"No fake route for {method} {path}"}]}, status=404, headers=rate_headers)
+
+      def do_GET(self):
+        self.handle_any("GET")
+
+      def do_POST(self):
+        self.handle_any("POST")
+
+      def do_PUT(self):
+        self.handle_any("PUT")
+
+      def do_DELETE(self):
+        self.handle_any("DELETE")
+
+      ## Routes ##
+
+      def get_course(self, query, rate_headers, course_id):
+        self.send_json(server.data.courses[course_id], headers=rate_headers)
+
+      def get_assignment(self, query, rate_headers, course_id, assignment_id):
+        self.send_json(server.data.assignments[assignment_id], headers=rate_headers)
+
+      def get_self(self, query, rate_headers):
+        self.send_json(server.data.instructor, headers=rate_headers)
+
+      def list_users(self, query, rate_headers, course_id):
+        users = [server.data.users[user_id] for user_id in server.data.enrollments[course_id]]
+        self.send_paginated(users, f"courses/{course_id}/search_users", query, rate_headers)
+
+      def get_user(self, query, rate_headers, course_id, user_id):
+        if user_id not in server.data.users:
+          self.send_json({"errors": [{"message": "The specified resource does not exist."}]}, status=404, headers=rate_headers)
+          return
+        self.send_json(server.data.users[user_id], headers=rate_headers)
+
+      def list_assignment_submissions(self, query, rate_headers, course_id, assignment_id):
+        include = query.get("include[]", []) + query.get("include", [])
+        submissions = [
+          server.render_submission(s, include)
+          for (a_id, _), s in sorted(server.data.submissions.items()) if a_id == assignment_id
+        ]
+        self.send_paginated(submissions, f"courses/{course_id}/assignments/{assignment_id}/submissions", query, rate_headers)
+
+      def list_student_submissions(self, query, rate_headers, course_id):
+        include = query.get("include[]", []) + query.get("include", [])
+        assignment_ids = set(int(a) for a in query.get("assignment_ids[]", []))
+        student_ids = query.get("student_ids[]", ["all"])
+        student_ids = None if "all" in student_ids else set(int(s) for s in student_ids)
+        workflow_state = query.get("workflow_state", [None])[0]
+        submitted_since = query.get("submitted_since", [None])[0]
+
+        submissions = []
+        for (a_id, user_id), s in sorted(server.data.submissions.items()):
+          if len(assignment_ids) > 0 and a_id not in assignment_ids:
+            continue
+          if student_ids is not None and user_id not in student_ids:
+            continue
+          if workflow_state is not None and s["workflow_state"] != workflow_state:
+            continue
+          if submitted_since is not None and (s["submitted_at"] is None or s["submitted_at"] < submitted_since):
+            continue
+          submissions.append(server.render_submission(s, include))
+        self.send_paginated(submissions, f"courses/{course_id}/students/submissions", query, rate_headers)
+
+      def get_submission(self, query, rate_headers, course_id, assignment_id, user_id):
+        include = query.get("include[]", []) + query.get("include", [])
+        self.send_json(server.render_submission(server.data.submissions[(assignment_id, user_id)], include), headers=rate_headers)
+
+      def edit_submission(self, query, rate_headers, course_id, assignment_id, user_id):
+        form = self.read_form()
+        submission = server.data.submissions[(assignment_id, user_id)]
+        server.update_submission(
+          submission,
+          posted_grade=form.get("submission[posted_grade]", [None])[0],
+          file_ids=form.get("comment[file_ids][]", []) + form.get("comment[file_ids]", []),
+          text_comment=form.get("comment[text_comment]", [None])[0]
+        )
+        self.send_json(server.render_submission(submission, []), headers=rate_headers)
+
+      def bulk_update(self, query, rate_headers, course_id, assignment_id):
+        form = self.read_form()
+        grade_data = collections.defaultdict(dict)
+        for key, values in form.items():
+          match = re.fullmatch(r"grade_data\[(\d+)\]\[(\w+)\]", key)
+          if match:
+            grade_data[int(match.group(1))][match.group(2)] = values[0]
+
+        progress_id = server.data.next_id()
+        progress = {
+          "id": progress_id,
+          "tag": "submissions_update",
+          "workflow_state": "queued",
+          "completion": 0,
+          "message": None,
+          "url": server.api_url(f"progress/{progress_id}"),
+          "completes_at": time.time() + server.progress_delay,
+        }
+        with server.data.lock:
+          server.data.progress[progress_id] = progress
+          for user_id, updates in grade_data.items():
+            submission = server.data.submissions.get((assignment_id, user_id))
+            if submission is not None:
+              server.update_submission(submission, posted_grade=updates.get("posted_grade"), text_comment=updates.get("text_comment"))
+        self.send_json({k: v for k, v in progress.items() if k != "completes_at"}, headers=rate_headers)
+
+      def get_progress(self, query, rate_headers, progress_id):
+        progress = server.data.progress[progress_id]
+        if time.time() >= progress["completes_at"]:
+          progress["workflow_state"] = "completed"
+          progress["completion"] = 100
+        else:
+          progress["workflow_state"] = "running"
+          progress["completion"] = 50
+        self.send_json({k: v for k, v in progress.items() if k != "completes_at"}, headers=rate_headers)
+
+      def delete_comment(self, query, rate_headers, course_id, assignment_id, user_id, comment_id):
+        submission = server.data.submissions[(assignment_id, user_id)]
+        with server.data.lock:
+          comments = submission["submission_comments"]
+          matching = [c for c in comments if c["id"] == comment_id]
+          submission["submission_comments"] = [c for c in comments if c["id"] != comment_id]
+        if len(matching) == 0:
+          self.send_json({"errors": [{"message": "not found"}]}, status=404, headers=rate_headers)
+        else:
+          self.send_json(matching[0], headers=rate_headers)
+
+      def request_comment_upload(self, query, rate_headers, course_id, assignment_id, user_id):
+        form = self.read_form()
+        token = f"{server.data.next_id()}"
+        server.data.upload_tokens[token] = {"name": form.get("name", ["file"])[0]}
+        self.send_json({
+          "upload_url": f"{server.url}/files_upload/{token}",
+          "upload_params": {"token": token},
+        }, headers=rate_headers)
+
+      def upload_file(self, query, rate_headers, token):
+        body = self.read_body()
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+          f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body
+        )
+        contents = b""
+        for part in message.iter_parts():
+          if part.get_param("name", header="content-disposition") == "file":
+            contents = part.get_payload(decode=True) or b""
+        file_id = server.data.next_id()
+        server.data.files[file_id] = contents
+        self.send_json({
+          "id": file_id,
+          "display_name": server.data.upload_tokens.pop(token, {}).get("name", "file"),
+          "size": len(contents),
+          "url": f"{server.url}/files/{file_id}/download?verifier=fake",
+        }, headers=rate_headers)
+
+      def download_file(self, query, rate_headers, file_id):
+        contents = server.data.files[file_id]
+        status = 200
+        range_header = self.headers.get("Range")
+        if range_header is not None:
+          start = int(re.match(r"bytes=(\d+)-", range_header).group(1))
+          if start >= len(contents):
+            self.send_response(416)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+          contents = contents[start:]
+          status = 206
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(contents)))
+        for k, v in rate_headers.items():
+          self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(contents)
+
+    ROUTES = [
+      ("GET", r"/api/v1/courses/(\d+)", "get_course", Handler.get_course),
+      ("GET", r"/api/v1/courses/(\d+)/assignments/(\d+)", "get_assignment", Handler.get_assignment),
+      ("GET", r"/api/v1/users/self", "get_self", Handler.get_self),
+      ("GET", r"/api/v1/courses/(\d+)/search_users", "list_users", Handler.list_users),
+      ("GET", r"/api/v1/courses/(\d+)/users/(\d+)", "get_user", Handler.get_user),
+      ("GET", r"/api/v1/courses/(\d+)/assignments/(\d+)/submissions", "list_assignment_submissions", Handler.list_assignment_submissions),
+      ("GET", r"/api/v1/courses/(\d+)/students/submissions", "list_student_submissions", Handler.list_student_submissions),
+      ("POST", r"/api/v1/courses/(\d+)/assignments/(\d+)/submissions/update_grades", "bulk_update", Handler.bulk_update),
+      ("GET", r"/api/v1/courses/(\d+)/assignments/(\d+)/submissions/(\d+)", "get_submission", Handler.get_submission),
+      ("PUT", r"/api/v1/courses/(\d+)/assignments/(\d+)/submissions/(\d+)", "edit_submission", Handler.edit_submission),
+      ("DELETE", r"/api/v1/courses/(\d+)/assignments/(\d+)/submissions/(\d+)/comments/(\d+)", "delete_comment", Handler.delete_comment),
+      ("POST", r"/api/v1/courses/(\d+)/assignments/(\d+)/submissions/(\d+)/comments/files", "request_comment_upload", Handler.request_comment_upload),
+      ("GET", r"/api/v1/progress/(\d+)", "get_progress", Handler.get_progress),
+      ("POST", r"/files_upload/(\w+)", "upload_file", Handler.upload_file),
+      ("GET", r"/files/(\d+)/download", "download_file", Handler.download_file),
+    ]
+
+    return Handler
+
+
+def parse_args():
+  parser = argparse.ArgumentParser(description="Run a fake canvas server with a synthetic course")
+  parser.add_argument("--port", type=int, default=8765)
+  parser.add_argument("--students", type=int, default=50)
+  parser.add_argument("--attachments", type=int, default=2)
+  parser.add_argument("--attachment_size", type=int, default=4096)
+  parser.add_argument("--attempts", type=int, default=1)
+  parser.add_argument("--latency", type=float, default=0.0)
+  parser.add_argument("--rate_limit_capacity", type=float, default=700.0)
+  parser.add_argument("--rate_limit_leak", type=float, default=10.0)
+  return parser.parse_args()
+
+
+def main():
+  args = parse_args()
+  data = FakeCanvasData.generate_course(args.students, args.attachments, args.attachment_size, args.attempts)
+  server = FakeCanvasServer(
+    data,
+    port=args.port,
+    latency=args.latency,
+    rate_limit_capacity=args.rate_limit_capacity,
+    rate_limit_leak=args.rate_limit_leak
+  )
+  print(f"Serving course 1 / assignment 1 with {args.students} students at {server.url} (Ctrl-C to stop)")
+  try:
+    server.httpd.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,215 @@
+#!env python
+from __future__ import annotations
+
+import argparse
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Dict
+
+import misc
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+def parse_size(size_str: str) -> int:
+  """Parses sizes like '500M' or '10G' into a number of bytes"""
+  units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+  size_str = size_str.strip().upper().rstrip("B")
+  if len(size_str) > 0 and size_str[-1] in units:
+    return int(float(size_str[:-1]) * units[size_str[-1]])
+  return int(size_str)
+
+
+class SubmissionFileCache:
+  """
+  A persistent, content-addressed store of submission attachments that is shared between runs and assignments.
+
+  Canvas attachments are looked up by (attachment id, size, updated_at), which changes whenever the underlying file
+  does, and the bytes are stored once per sha256 so identical files (e.g. untouched starter code) are only kept once.
+  Files are handed out by hardlinking (or copying, if the filesystem doesn't allow it) out of the store,
+  and the least recently used blobs are evicted once the store grows past max_size.
+  """
+
+  DEFAULT_MAX_SIZE = 5 * 1024**3
+
+  def __init__(self, cache_dir=None, max_size: int|None = DEFAULT_MAX_SIZE):
+    if cache_dir is None:
+      cache_dir = misc.get_cache_dir("files")
+    self.cache_dir = cache_dir
+    self.blob_dir = os.path.join(cache_dir, "blobs")
+    os.makedirs(self.blob_dir, exist_ok=True)
+    self.max_size = max_size
+
+    # Downloads happen on worker threads, so share a single connection behind a lock
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"), check_same_thread=False)
+    with self.db:
+      self.db.execute("CREATE TABLE IF NOT EXISTS blobs (sha256 TEXT PRIMARY KEY, size INTEGER, last_used REAL)")
+      self.db.execute("CREATE TABLE IF NOT EXISTS attachments (key TEXT PRIMARY KEY, sha256 TEXT)")
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+    return False
+
+  def close(self):
+    self.db.close()
+
+  @staticmethod
+  def get_key(attachment: Dict) -> str:
+    return f"{attachment['id']}:{attachment.get('size')}:{attachment.get('updated_at')}"
+
+  @staticmethod
+  def hash_file(path) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fid:
+      for chunk in iter(lambda: fid.read(1024*1024), b''):
+        sha.update(chunk)
+    return sha.hexdigest()
+
+  def get_blob_path(self, sha256) -> str:
+    return os.path.join(self.blob_dir, sha256[:2], sha256)
+
+  def lookup(self, attachment: Dict) -> str|None:
+    """
+    Find the cached copy of an attachment, if we have one.
+    :param attachment: attachment dictionary as found in a submission's history
+    :return: path to the blob or None
+    """
+    with self.lock:
+      row = self.db.execute("SELECT sha256 FROM attachments WHERE key = ?", (self.get_key(attachment),)).fetchone()
+      if row is None:
+        return None
+      blob_path = self.get_blob_path(row[0])
+      if not os.path.exists(blob_path):
+        # Somebody cleaned up the blob directory behind our back
+        with self.db:
+          self.db.execute("DELETE FROM attachments WHERE sha256 = ?", (row[0],))
+          self.db.execute("DELETE FROM blobs WHERE sha256 = ?", (row[0],))
+        return None
+      with self.db:
+        self.db.execute("UPDATE blobs SET last_used = ? WHERE sha256 = ?", (time.time(), row[0]))
+    return blob_path
+
+  def add(self, attachment: Dict, src_path) -> str:
+    """
+    Add a downloaded attachment to the store.
+    :param attachment: attachment dictionary as found in a submission's history
+    :param src_path: path to the downloaded file
+    :return: path to the blob
+    """
+    sha256 = self.hash_file(src_path)
+    blob_path = self.get_blob_path(sha256)
+
+    if not os.path.exists(blob_path):
+      os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+      # Copy to a temporary name first so a concurrent reader never sees a half-written blob
+      fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(blob_path), suffix=".part")
+      os.close(fd)
+      shutil.copyfile(src_path, tmp_path)
+      os.replace(tmp_path, blob_path)
+
+    with self.lock, self.db:
+      self.db.execute(
+        "INSERT OR REPLACE INTO blobs (sha256, size, last_used) VALUES (?, ?, ?)",
+        (sha256, os.path.getsize(blob_path), time.time())
+      )
+      self.db.execute(
+        "INSERT OR REPLACE INTO attachments (key, sha256) VALUES (?, ?)",
+        (self.get_key(attachment), sha256)
+      )
+    return blob_path
+
+  @staticmethod
+  def link(blob_path, local_path):
+    """
+    Make blob_path available at local_path, preferring a hardlink and falling back to a plain copy.
+    A symlink would dangle as soon as prune evicted the blob, which can happen while the submission is still in use.
+    """
+    if os.path.lexists(local_path):
+      os.remove(local_path)
+    try:
+      os.link(blob_path, local_path)
+      return
+    except OSError:
+      pass
+    shutil.copyfile(blob_path, local_path)
+
+  def get_total_size(self) -> int:
+    with self.lock:
+      return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+  def prune(self, max_size: int|None = None) -> int:
+    """
+    Evict least recently used blobs until the store fits in max_size bytes.
+    :return: number of bytes freed
+    """
+    if max_size is None:
+      max_size = self.max_size
+    if max_size is None:
+      return 0
+
+    total_size = self.get_total_size()
+    bytes_freed = 0
+    with self.lock:
+      rows = self.db.execute("SELECT sha256, size FROM blobs ORDER BY last_used ASC").fetchall()
+      for sha256, size in rows:
+        if total_size - bytes_freed <= max_size:
+          break
+        log.debug(f"Evicting {sha256} ({size} bytes)")
+        try:
+          os.remove(self.get_blob_path(sha256))
+        except FileNotFoundError:
+          pass
+        with self.db:
+          self.db.execute("DELETE FROM attachments WHERE sha256 = ?", (sha256,))
+          self.db.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+        bytes_freed += size
+    if bytes_freed > 0:
+      log.info(f"Pruned {bytes_freed} bytes from {self.cache_dir}")
+    return bytes_freed
+
+  def describe(self):
+    with self.lock:
+      num_blobs, total_size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+      num_attachments = self.db.execute("SELECT COUNT(*) FROM attachments").fetchone()[0]
+    print(f"{self.cache_dir}: {num_attachments} attachments in {num_blobs} blobs, {total_size} bytes (limit: {self.max_size})")
+
+
+def parse_args():
+  parser = argparse.ArgumentParser(description="Manage the local submission file cache")
+  parser.add_argument("--cache_dir", default=None)
+  parser.add_argument("--max_size", default=None, help="Size limit for the cache, e.g. 500M or 10G")
+
+  subparsers = parser.add_subparsers(dest="action", required=True)
+  subparsers.add_parser("STATS")
+  subparsers.add_parser("PRUNE")
+  subparsers.add_parser("CLEAR")
+
+  return parser.parse_args()
+
+
+def main():
+  args = parse_args()
+  max_size = parse_size(args.max_size) if args.max_size is not None else SubmissionFileCache.DEFAULT_MAX_SIZE
+
+  with SubmissionFileCache(args.cache_dir, max_size=max_size) as cache:
+    if args.action == "PRUNE":
+      cache.prune()
+    elif args.action == "CLEAR":
+      cache.prune(max_size=0)
+    cache.describe()
+
+
+if __name__ == "__main__":
+  main()
@@ -21,6 +21,7 @@ import numpy as np
 import yaml
 
 import assignment
+import misc
 
 from flask import Flask, render_template, redirect, url_for
 
@@ -467,9 +468,7 @@ def combine_CSVs(a: AssignmentFromRubric, csvs : typing.List[str], fudge : float
 
 def get_submissions(course_id: int, assignment_id: int, prod: bool, limit=None):
   with assignment.CanvasAssignment(course_id, assignment_id, prod) as a:
-    student_submissions = a.get_student_submissions(a.canvas_assignment, True)
-    if limit != None:
-      student_submissions = student_submissions[:limit]
+    student_submissions = list(a.iter_student_submissions(limit=limit))
     log.debug(f"Asking to download to: {os.path.join(os.getcwd(), 'files')}")
     submissions = a.download_submission_files(student_submissions, download_dir=os.path.join(os.getcwd(), "files"), overwrite=False, download_all_variations=False)
   
@@ -484,12 +483,15 @@ def get_submissions(course_id: int, assignment_id: int, prod: bool, limit=None):
 
 def submit_feedback(course_id: int, assignment_id: int, prod: bool, feedback: typing.List[typing.Dict], limit=None):
   with assignment.CanvasAssignment(course_id, assignment_id, prod) as a:
-    for grading_response in feedback:
-      a.push_feedback(
-        grading_response["user_id"],
-        grading_response["score"],
-        grading_response["feedback"]
+    failed_user_ids = a.push_feedback_batch({
+      int(grading_response["user_id"]) : misc.Feedback(
+        overall_score=grading_response["score"],
+        overall_feedback=grading_response["feedback"]
       )
+      for grading_response in feedback
+    })
+    if len(failed_user_ids) > 0:
+      log.error(f"Feedback was not posted for {sorted(failed_user_ids)}")
 
 
 def parse_args():
@@ -1,12 +1,24 @@
 #!env python
+from __future__ import annotations
+
 import abc
+import base64
 import collections
+import concurrent.futures
+import dataclasses
+import hashlib
 import json
+import math
 import os
 import pprint
+import re
+import shlex
 import shutil
+import subprocess
+import tempfile
 import tarfile
 import textwrap
+import threading
 import time
 import typing
 from abc import ABC
@@ -22,6 +34,11 @@ import yaml
 import pandas as pd
 
 import misc
+import timing
+from container_pool import ContainerPool
+from image_builder import GradingImageBuilder
+from result_cache import GradingResultCache
+from shell_session import ShellSession
 
 
 import logging
@@ -32,6 +49,11 @@ log.setLevel(logging.DEBUG)
 
 class Grader:
   """A class that turns files to feedback.  Note: will probably be generalized to not just have files in the future"""
+  # Whether grade_assignment can be called for several students at once from different threads
+  supports_parallel_grading = True
+  # Bump whenever a change would give different feedback for the same files, so cached results aren't reused
+  version = "1"
+  
   def __init__(self, *args, **kwargs):
     pass
   
@@ -40,6 +62,14 @@ class Grader:
   @abc.abstractmethod
   def grade_assignment(self, *args, **kwargs) -> misc.Feedback:
     pass
+  
+  def set_parallelism(self, num_workers: int):
+    """Called before a run with how many students will be graded at once"""
+    pass
+  
+  def cleanup(self):
+    """Release anything held across students (e.g. pooled containers) once a grading run is finished"""
+    pass
 
 
 class GraderDummy:
@@ -49,61 +79,188 @@ class GraderDummy:
     return misc.Feedback(overall_score=42.0, overall_feedback="Excellent job!")
 
 
+@dataclasses.dataclass(frozen=True)
+class ContainerArchive:
+  """Files packed into one in-memory tarball, to be extracted at root in a container.  Can be reused across containers."""
+  root: str
+  data: bytes
+  
+  @classmethod
+  def from_files(cls, files: typing.Dict[str, bytes|str]) -> ContainerArchive:
+    """
+    :param files: {destination path in the container: file contents as bytes, or a path to a local file}
+    """
+    root = os.path.commonpath([os.path.dirname(dest) for dest in files.keys()])
+    tarstream = io.BytesIO()
+    with tarfile.open(fileobj=tarstream, mode="w") as tarhandle:
+      for dest, contents in files.items():
+        arcname = os.path.relpath(dest, root)
+        if isinstance(contents, bytes):
+          tarinfo = tarfile.TarInfo(arcname)
+          tarinfo.size = len(contents)
+          tarinfo.mtime = int(time.time())
+          tarinfo.mode = 0o644
+          tarhandle.addfile(tarinfo, io.BytesIO(contents))
+        else:
+          tarhandle.add(contents, arcname=arcname)
+    return cls(root, tarstream.getvalue())
+  
+  @classmethod
+  def from_files_to_copy(cls, files_to_copy : ContainerArchive|typing.Dict[str, bytes|str]|List[Tuple[str,str]]) -> ContainerArchive:
+    """Accepts anything add_files_to_docker does"""
+    if isinstance(files_to_copy, ContainerArchive):
+      return files_to_copy
+    if isinstance(files_to_copy, list):
+      files_to_copy = {
+        os.path.join(target_dir, os.path.basename(src_file)): src_file
+        for src_file, target_dir in files_to_copy
+      }
+    return cls.from_files(files_to_copy)
+
+
+class LazyDockerClient:
+  """Connects to docker the first time the client is used, so importing this module doesn't require a running daemon"""
+  def __init__(self):
+    self.client = None
+    self.lock = threading.Lock()
+  
+  def __get__(self, obj, objtype=None) -> docker.DockerClient:
+    with self.lock:
+      if self.client is None:
+        self.client = docker.from_env()
+    return self.client
+
+
 class Grader_docker(Grader, ABC):
-  client = docker.from_env()
+  client = LazyDockerClient()
+  # If set, each container gets a host directory mounted here that grading can write results to (see read_result)
+  results_mount : str|None = None
   
-  def __init__(self, image=None, *args, **kwargs):
+  def __init__(self, image=None, container_pool_size=0, use_result_cache=False, sample_container_stats=False, timing_report=None, trace_file=None, *args, **kwargs):
+    """
+    :param container_pool_size: How many warm containers to keep around between runs.  0 starts a fresh container for every run.
+    :param use_result_cache: Reuse feedback from earlier runs for files that have already been graded the same way
+    :param sample_container_stats: Poll the container's peak memory and CPU use during each run
+    :param timing_report: Where to write per-phase and per-student timings (.json or .csv) when the run is cleaned up
+    :param trace_file: Where to write the timings as a Chrome trace when the run is cleaned up
+    """
     super().__init__(*args, **kwargs)
     self.image = image if image is not None else "ubuntu"
+    # Each grading thread gets its own container
+    self.thread_state = threading.local()
     self.container : docker.models.containers.Container = None
+    self.container_pool_size = container_pool_size
+    self.container_pool : ContainerPool|None = None
+    self.container_pool_lock = threading.Lock()
+    self.image_future : concurrent.futures.Future|None = None
+    self.result_cache : GradingResultCache|None = GradingResultCache() if use_result_cache else None
+    self.timeline = timing.Timeline()
+    self.sample_container_stats = sample_container_stats
+    self.timing_report = timing_report
+    self.trace_file = trace_file
   
   @classmethod
-  def build_docker_image(cls, base_image, github_repo):
+  def build_docker_image(cls, base_image, github_repo) -> docker.models.images.Image:
+    return cls.start_docker_image_build(base_image, github_repo).result()
+  
+  @classmethod
+  def start_docker_image_build(cls, base_image, github_repo) -> concurrent.futures.Future:
+    """Start building (or finding a cached build of) the grading image in the background"""
     log.info("Building docker image for grading...")
-    
-    docker_file = io.BytesIO(f"""
-    FROM samogden/cst334
-    RUN git clone {github_repo} /tmp/grading/
-    WORKDIR /tmp/grading
-    CMD ["/bin/bash"]
-    """.encode())
-    
-    image, logs = cls.client.images.build(
-      fileobj=docker_file,
-      tag="grading",
-      pull=True,
-      nocache=True
-    )
-    # log.debug(logs)
-    log.debug("Docker image built successfully")
-    return image
+    return GradingImageBuilder.submit(cls.client, base_image, github_repo)
+  
+  @property
+  def container(self) -> docker.models.containers.Container|None:
+    return getattr(self.thread_state, "container", None)
+  
+  @container.setter
+  def container(self, container: docker.models.containers.Container|None):
+    self.thread_state.container = container
+  
+  @property
+  def results_dir(self) -> str|None:
+    """Host directory mounted at results_mount in this thread's container"""
+    return getattr(self.thread_state, "results_dir", None)
+  
+  @results_dir.setter
+  def results_dir(self, results_dir: str|None):
+    self.thread_state.results_dir = results_dir
+  
+  def set_parallelism(self, num_workers: int):
+    # Make sure every worker can have a warm container at once
+    if self.container_pool_size > 0 and num_workers > self.container_pool_size:
+      self.container_pool_size = num_workers
+      with self.container_pool_lock:
+        if self.container_pool is not None:
+          self.container_pool.size = num_workers
+  
+  def get_image(self):
+    if self.image_future is not None:
+      # Only the time spent waiting on the build shows up here, since it runs in the background
+      with self.timeline.span("image_build"):
+        self.image = self.image_future.result()
+      self.image_future = None
+    return self.image
+  
+  def get_image_id(self) -> str:
+    image = self.get_image()
+    if not isinstance(image, docker.models.images.Image):
+      try:
+        image = self.client.images.get(image)
+      except docker.errors.ImageNotFound:
+        # This can be asked for before any container is started, so pull the image ourselves like containers.run would
+        log.info(f"Pulling {image}")
+        repository, tag = docker.utils.parse_repository_tag(image)
+        image = self.client.images.pull(repository, tag=(tag or "latest"))
+      self.image = image
+    return image.id
+  
+  def get_result_cache_key(self, files: typing.Iterable[typing.Tuple[str, str]], *parts) -> str|None:
+    """Key for the result of grading files (pairs of (name graded as, local path)), or None if caching is off"""
+    if self.result_cache is None:
+      return None
+    return self.result_cache.get_key(files, type(self).__name__, self.version, self.get_image_id(), *parts)
+  
+  def get_container_pool(self, image) -> ContainerPool|None:
+    if self.container_pool_size <= 0:
+      return None
+    with self.container_pool_lock:
+      if self.container_pool is not None and self.container_pool.image != image:
+        self.container_pool.close()
+        self.container_pool = None
+      if self.container_pool is None:
+        self.container_pool = ContainerPool(self.client, image, size=self.container_pool_size, results_mount=self.results_mount)
+        self.container_pool.warm()
+      return self.container_pool
   
   def start(self, image : docker.models.images,):
+    container_pool = self.get_container_pool(image)
+    if container_pool is not None:
+      self.container = container_pool.acquire()
+      self.results_dir = container_pool.get_results_dir(self.container)
+      return
+    volumes = {}
+    group_add = []
+    if self.results_mount is not None:
+      self.results_dir = misc.make_results_dir()
+      volumes[self.results_dir] = {"bind": self.results_mount, "mode": "rw"}
+      group_add = misc.results_dir_group_add()
     self.container = self.client.containers.run(
       image=image,
       detach=True,
-      tty=True
+      tty=True,
+      volumes=volumes,
+      group_add=group_add
     )
     
-  def add_files_to_docker(self, files_to_copy : List[Tuple[str,str]] = None):
+  def add_files_to_docker(self, files_to_copy : ContainerArchive|typing.Dict[str, bytes|str]|List[Tuple[str,str]] = None):
     """
-    
-    :param files_to_copy: Format is [(src, target), ...]):
-    :return:
+    Copy files into the container with a single put_archive.
+    :param files_to_copy: Either a ContainerArchive, a mapping of {destination path: bytes or source path}, or the
+      older format of [(src, target_dir), ...]
     """
-    
-    def add_file_to_container(src_file, target_dir, container):
-      # Prepare the files as a tarball to push into container
-      tarstream = io.BytesIO()
-      with tarfile.open(fileobj=tarstream, mode="w") as tarhandle:
-        tarhandle.add(src_file, arcname=os.path.basename(src_file))
-      tarstream.seek(0)
-      
-      # Push student files to image
-      container.put_archive(f"{target_dir}", tarstream)
-    
-    for src_file, target_dir in files_to_copy:
-      add_file_to_container(src_file, target_dir, self.container)
+    archive = ContainerArchive.from_files_to_copy(files_to_copy)
+    self.container.put_archive(archive.root, archive.data)
   
   def execute(self, command="", container=None, workdir=None) -> typing.Tuple[int, str, str]:
     log.debug(f"execute: {command}")
@@ -142,23 +299,61 @@ class Grader_docker(Grader, ABC):
     
     # Open the tarball we just pulled and read the contents to a string buffer
     with tarfile.open(fileobj=f, mode="r") as tarhandle:
-      results_f = tarhandle.getmember("results.json")
+      results_f = tarhandle.getmember(os.path.basename(path_to_file.rstrip('/')))
       f = tarhandle.extractfile(results_f)
       f.seek(0)
       return f.read().decode()
+  
+  def get_archive(self, path) -> ContainerArchive:
+    """Pack up path (e.g. a directory of build artifacts) from the container, so it can be copied into another one"""
+    bits, stats = self.container.get_archive(path)
+    return ContainerArchive(os.path.dirname(path.rstrip('/')), b''.join(bits))
+  
+  def read_result(self, filename) -> str|None:
+    """Read a file that grading wrote to results_mount, straight off the host if it is mounted"""
+    if self.results_dir is not None:
+      results_path = os.path.join(self.results_dir, filename)
+      if os.path.exists(results_path):
+        with open(results_path) as fid:
+          return fid.read()
+      # e.g. the docker daemon is on another host, so the mount isn't the directory we made
+    return self.read_file(os.path.join(self.results_mount or "/tmp", filename))
    
   def stop(self):
-    self.container.stop(timeout=1)
-    self.container.remove()
+    if self.container_pool is not None:
+      self.container_pool.release(self.container)
+    else:
+      self.container.stop(timeout=1)
+      self.container.remove()
+      if self.results_dir is not None:
+        shutil.rmtree(self.results_dir, ignore_errors=True)
     self.container = None
+    self.results_dir = None
+  
+  def cleanup(self):
+    if self.result_cache is not None:
+      log.info(self.result_cache.describe())
+    if len(self.timeline.spans) > 0:
+      self.timeline.log_summary()
+      if self.timing_report is not None:
+        self.timeline.write_report(self.timing_report)
+      if self.trace_file is not None:
+        self.timeline.write_chrome_trace(self.trace_file)
+    with self.container_pool_lock:
+      if self.container_pool is not None:
+        self.container_pool.close()
+        self.container_pool = None
     
   def __enter__(self):
-    log.info(f"Starting docker image {self.image} context")
-    self.start(self.image)
+    image = self.get_image()
+    log.info(f"Starting docker image {image} context")
+    with self.timeline.span("container_start"):
+      self.start(image)
   
   def __exit__(self, exc_type, exc_val, exc_tb):
     log.info(f"Exiting docker image context")
-    self.stop()
+    with self.timeline.span("stop"):
+      self.stop()
     if exc_type is not None:
       log.error(f"An exception occured: {exc_val}")
       log.error(exc_tb)
@@ -173,23 +368,103 @@ class Grader_docker(Grader, ABC):
     pass
   
   def grade_in_docker(self, files_to_copy=None, *args, **kwargs) -> misc.Feedback:
-    with self:
-      if files_to_copy is not None:
-        self.add_files_to_docker(files_to_copy)
-      execution_results = self.execute_grading(*args, **kwargs)
-      return self.score_grading(execution_results,*args,  **kwargs)
-    
+    with self.timeline.span("grade_run") as span_args, self:
+      sampler = None
+      if self.sample_container_stats and self.container is not None:
+        sampler = timing.ContainerStatsSampler(self.container).__enter__()
+      try:
+        if files_to_copy is not None:
+          with self.timeline.span("file_copy"):
+            self.add_files_to_docker(files_to_copy)
+        with self.timeline.span("exec"):
+          execution_results = self.execute_grading(*args, **kwargs)
+        with self.timeline.span("result_read"):
+          return self.score_grading(execution_results,*args,  **kwargs)
+      finally:
+        if sampler is not None:
+          sampler.__exit__(None, None, None)
+          span_args["peak_memory_bytes"] = sampler.peak_memory_bytes
+          span_args["peak_cpu_percent"] = sampler.peak_cpu_percent
 
 class Grader_CST334(Grader_docker):
+  results_mount = "/tmp/results"
 
-  def __init__(self, assignment_path, use_online_repo=False):
-    super().__init__()
+  def __init__(self, assignment_path, use_online_repo=False, container_pool_size=2, stable_repeats=3, use_result_cache=True, build_command="make", build_target=None, adaptive_timeout=True, timeout_multiplier=5.0, timeout_floor=10, timeout_ceiling=120, reference_solution=None, **kwargs):
+    """
+    :param adaptive_timeout: Time the harness on reference_solution and give students timeout_multiplier times that
+      (but at least timeout_floor and at most timeout_ceiling seconds).  Otherwise, or if there is no reference
+      solution, every run gets timeout_ceiling seconds.
+    :param reference_solution: The assignment's reference student_code.c (and .h), or a directory holding them
+    :param stable_repeats: Stop repeating the tests once this many runs in a row give the same score.  Set it to
+      num_repeats (or higher) to always run every repeat.
+    :param build_command: Run once in the assignment directory before the tests, so that the test runs start from what
+      it built rather than each building it again.  If it fails, the test harness is left to do its own build (and
+      report any errors) as it did before.  None skips the build step.
+    :param build_target: The make target that the test harness builds, passed to build_command.  None uses the
+      Makefile's default target.
+    """
+    super().__init__(container_pool_size=container_pool_size, use_result_cache=use_result_cache, **kwargs)
+    self.stable_repeats = stable_repeats
+    self.build_command = build_command
+    self.build_target = build_target
+    self.adaptive_timeout = adaptive_timeout
+    self.timeout_multiplier = timeout_multiplier
+    self.timeout_floor = timeout_floor
+    self.timeout_ceiling = timeout_ceiling
+    self.reference_files = self.get_reference_files(reference_solution)
+    self.timeout : int|None = None
+    self.timeout_lock = threading.Lock()
+    # user_id -> (number of runs needed, whether the runs disagreed)
+    self.runs_by_student : typing.Dict[int, typing.Tuple[int, bool]] = {}
+    self.runs_lock = threading.Lock()
     if use_online_repo:
       github_repo="https://github.com/samogden/CST334-assignments-online.git"
     else:
       github_repo="https://github.com/samogden/CST334-assignments.git"
     self.assignment_path = assignment_path
-    self.image = Grader_CST334.build_docker_image(base_image="samogden/cst334", github_repo=github_repo)
+    # Grading waits on this the first time it needs a container, so the build overlaps with downloading submissions
+    self.image_future = self.start_environment_build(github_repo)
+  
+  def start_environment_build(self, github_repo) -> concurrent.futures.Future:
+    return Grader_CST334.start_docker_image_build(base_image="samogden/cst334", github_repo=github_repo)
+  
+  def get_reference_files(self, reference_solution) -> List[str]:
+    if reference_solution is None:
+      return []
+    if not os.path.exists(reference_solution):
+      log.warning(f"Reference solution {reference_solution} doesn't exist")
+      return []
+    if os.path.isdir(reference_solution):
+      return self.find_student_files([os.path.join(reference_solution, f) for f in sorted(os.listdir(reference_solution))])
+    return self.find_student_files([reference_solution])
+  
+  def record_runs(self, student_id, num_runs, flaky):
+    log.debug(f"Needed {num_runs} runs{' (flaky)' if flaky else ''}")
+    with self.runs_lock:
+      self.runs_by_student[student_id] = (num_runs, flaky)
+  
+  def cleanup(self):
+    with self.runs_lock:
+      if len(self.runs_by_student) > 0:
+        total_runs = sum(num_runs for num_runs, _ in self.runs_by_student.values())
+        flaky_students = [student_id for student_id, (_, flaky) in self.runs_by_student.items() if flaky]
+        log.info(
+          f"Ran tests {total_runs} times for {len(self.runs_by_student)} students "
+          f"({total_runs / len(self.runs_by_student):0.1f} on average), {len(flaky_students)} flaky: {flaky_students}"
+        )
+    super().cleanup()
+  
+  @staticmethod
+  def find_student_files(input_files: List[str]) -> List[str]:
+    """The student_code.c and student_code.h out of input_files"""
+    files_copied = []
+    for file_extension in [".c", ".h"]:
+      try:
+        file_to_copy = list(filter(lambda f: "student_code" in f and f.endswith(file_extension), input_files))[0]
+        files_copied.append(file_to_copy)
+      except IndexError:
+        log.warning("Single file submitted")
+    return files_copied
   
   def check_for_trickery(self, input_file) -> bool:
     try:
@@ -275,15 +550,74 @@ class Grader_CST334(Grader_docker):
     
     return '\n'.join(feedback_strs)
   
-  def execute_grading(self, programming_assignment, *args, **kwargs) -> Tuple[int, str, str]:
+  # The assignment Makefiles don't list header dependencies, so objects prebuilt in the image against the template
+  # student_code.h would otherwise be linked in as-is when a student submits their own header
+  REMOVE_PREBUILT_OBJECTS = "find . -name '*.o' -delete; "
+  
+  @staticmethod
+  def includes_header(files_copied: List[str]) -> bool:
+    return any(f.endswith(".h") for f in files_copied)
+  
+  def execute_grading(self, programming_assignment, *args, timeout=None, **kwargs) -> Tuple[int, str, str]:
+    remove_objects = self.REMOVE_PREBUILT_OBJECTS if getattr(self.thread_state, "remove_prebuilt_objects", False) else ""
     rc, stdout, stderr = self.execute(
-      command="timeout 120 python ../../helpers/grader.py --output /tmp/results.json",
+      command=f"{remove_objects}timeout {timeout if timeout is not None else self.get_timeout()} python ../../helpers/grader.py --output {self.results_mount}/results.json",
       workdir=f"/tmp/grading/programming-assignments/{programming_assignment}/"
     )
+    # timeout exits with 124, which tells grade_assignment not to bother repeating
+    self.thread_state.timed_out = (rc == 124)
     return rc, stdout, stderr
   
+  def get_timeout_path(self) -> str:
+    key = GradingResultCache.get_key(
+      [(f"student_code{os.path.splitext(f)[1]}", f) for f in self.reference_files],
+      self.get_image_id(), self.assignment_path
+    )
+    return os.path.join(misc.get_cache_dir("timeouts"), f"{key[:32]}.json")
+  
+  def get_timeout(self) -> int:
+    """
+    Seconds each run of the test harness gets.  The harness only reports results for the whole run, so this is one
+    timeout for the whole assignment rather than one per test suite.
+    """
+    with self.timeout_lock:
+      if self.timeout is not None:
+        return self.timeout
+      if not self.adaptive_timeout or len(self.reference_files) == 0:
+        if self.adaptive_timeout:
+          log.info(f"No reference solution for {self.assignment_path}, test runs time out after {self.timeout_ceiling}s")
+        self.timeout = self.timeout_ceiling
+        return self.timeout
+      
+      timeout_path = self.get_timeout_path()
+      reference_runtime = None
+      if os.path.exists(timeout_path):
+        with open(timeout_path) as fid:
+          reference_runtime = json.load(fid)["reference_runtime"]
+      else:
+        log.info(f"Timing the test harness on the reference solution for {self.assignment_path}")
+        with self.timeline.span("reference_run"), self:
+          self.add_files_to_docker(self.get_student_files(self.reference_files))
+          self.thread_state.remove_prebuilt_objects = self.includes_header(self.reference_files)
+          start_time = time.time()
+          rc, _, _ = self.execute_grading(self.assignment_path, timeout=self.timeout_ceiling)
+          elapsed = time.time() - start_time
+        if rc == 124:
+          log.warning(f"Test harness timed out on the reference solution for {self.assignment_path}, using {self.timeout_ceiling}s")
+        else:
+          reference_runtime = elapsed
+          with open(timeout_path, 'w') as fid:
+            json.dump({"reference_runtime": reference_runtime, "assignment_path": self.assignment_path}, fid)
+      
+      if reference_runtime is None:
+        self.timeout = self.timeout_ceiling
+      else:
+        self.timeout = int(min(self.timeout_ceiling, max(self.timeout_floor, math.ceil(self.timeout_multiplier * reference_runtime))))
+      log.info(f"Test runs for {self.assignment_path} time out after {self.timeout}s")
+      return self.timeout
+  
   def score_grading(self, *args, **kwargs) -> misc.Feedback:
-    results = self.read_file("/tmp/results.json")
+    results = self.read_result("results.json")
     if results is None:
       # Then something went awry in reading back feedback file
       return misc.Feedback(
@@ -299,40 +633,76 @@ class Grader_CST334(Grader_docker):
       overall_feedback=self.build_feedback(results_dict)
     )
   
-  def grade_in_docker(self, source_dir, programming_assignment, lint_bonus) -> misc.Feedback:
-    files_to_copy = [
-      (
-        f,
-        f"/tmp/grading/programming-assignments/{programming_assignment}/{'src' if f.endswith('.c') else 'include'}"
-      )
-      for f in [os.path.join(source_dir, f_wo_path) for f_wo_path in os.listdir(source_dir)]
-    ]
-    return super().grade_in_docker(files_to_copy, programming_assignment=programming_assignment, lint_bonus=lint_bonus)
+  def grade_in_docker(self, student_files: ContainerArchive|None, programming_assignment, lint_bonus) -> misc.Feedback:
+    return super().grade_in_docker(student_files, programming_assignment=programming_assignment, lint_bonus=lint_bonus)
+  
+  @staticmethod
+  def get_student_file_path(f) -> str:
+    """Where a student's file goes, relative to the assignment directory: .c files into src and everything else into include"""
+    return f"{'src' if f.endswith('.c') else 'include'}/student_code{os.path.splitext(f)[1]}"
+  
+  def get_student_files(self, files_copied: List[str]) -> ContainerArchive:
+    """Pack the student's code into an archive for the assignment directory"""
+    if len(files_copied) == 0:
+      return None
+    assignment_dir = f"/tmp/grading/programming-assignments/{self.assignment_path}"
+    files = {}
+    for f in files_copied:
+      # Passed as bytes so they are stamped with the current time, which keeps them newer than the objects prebuilt in
+      # the image (a downloaded file's own mtime can be older) and make always recompiles them
+      with open(f, 'rb') as fid:
+        files[f"{assignment_dir}/{self.get_student_file_path(f)}"] = fid.read()
+    return ContainerArchive.from_files(files)
     
+  def build_student_code(self, student_files: ContainerArchive|None, files_copied: List[str]) -> ContainerArchive|None:
+    """
+    Build the student's code once, ahead of the test runs.
+    :return: The student's files and everything the build wrote, with their timestamps so that when the harness runs
+      make again there is nothing left to do, or None if the build failed and the harness should do its own
+    """
+    assignment_dir = f"/tmp/grading/programming-assignments/{self.assignment_path}"
+    stamp_path = f"{self.results_mount}/.build_stamp"
+    artifacts_path = f"{self.results_mount}/build_artifacts.tar"
+    build_command = self.build_command if self.build_target is None else f"{self.build_command} {shlex.quote(self.build_target)}"
+    list_student_files = (
+      f"printf '%s\\0' {' '.join(shlex.quote(self.get_student_file_path(f)) for f in files_copied)}; "
+      if len(files_copied) > 0 else ""
+    )
+    with self.timeline.span("build"), self:
+      if student_files is not None:
+        self.add_files_to_docker(student_files)
+      # An assignment without a makefile is left to the test harness as before.  Only what is newer than the stamp
+      # (i.e. what the build wrote) is kept, along with the student's files so they stay older than what was built.
+      rc, stdout, stderr = self.execute(
+        command=(
+          f"if [ ! -f Makefile ] && [ ! -f makefile ]; then exit 200; fi; "
+          f"{self.REMOVE_PREBUILT_OBJECTS if self.includes_header(files_copied) else ''}"
+          f"touch {stamp_path} && timeout 60 {build_command} 2>&1 || exit $?; "
+          f"{{ {list_student_files}find . -type f -newer {stamp_path} -print0; }} "
+          f"| tar --null -T - -cf {artifacts_path} || exit 201"
+        ),
+        workdir=assignment_dir
+      )
+      log.debug(f"Build output: {(stdout or b'').decode(errors='replace')}")
+      if rc == 200:
+        return None
+      if rc != 0:
+        log.info(f"Building ahead of the tests failed ({rc}), leaving the build to the test harness")
+        return None
+      with tarfile.open(fileobj=io.BytesIO(self.get_archive(artifacts_path).data), mode="r") as tarhandle:
+        artifacts = tarhandle.extractfile(os.path.basename(artifacts_path)).read()
+      return ContainerArchive(assignment_dir, artifacts)
+  
   def grade_assignment(self, input_files: List[str], *args, **kwargs) -> misc.Feedback:
     
     # Legacy settings
     use_max = "use_max" in kwargs and kwargs["use_name"]
     tags = ["main"] if "tags" not in kwargs else kwargs["tags"]
     num_repeats = 10 if "num_repeats" not in kwargs else kwargs["num_repeats"]
+    stable_repeats = self.stable_repeats if "stable_repeats" not in kwargs else kwargs["stable_repeats"]
     
-    # Setup input files
-    # todo: convert to using a temp file since I currently have to manually delete later on
-    if os.path.exists("student_code"): shutil.rmtree("student_code")
-    os.mkdir("student_code")
-    
-    # Copy the student code to the staging directory
-    files_copied = []
-    for file_extension in [".c", ".h"]:
-      try:
-        file_to_copy = list(filter(lambda f: "student_code" in f and f.endswith(file_extension), input_files))[0]
-        files_copied.append(file_to_copy)
-        shutil.copy(
-          file_to_copy,
-          f"./student_code/student_code{file_extension}"
-        )
-      except IndexError:
-        log.warning("Single file submitted")
+    # Find the student code to copy in
+    files_copied = self.find_student_files(input_files)
     
     # Check for trickery, per Elijah's trials (so far)
     if any([self.check_for_trickery(f) for f in files_copied]):
@@ -351,35 +721,286 @@ class Grader_CST334(Grader_docker):
     # Set up to be able to run multiple times
     # todo: I should probably move to the results format for this
     
+    # Skip the runs entirely if we've graded exactly these files before
+    result_cache_key = self.get_result_cache_key(
+      [(f"student_code{os.path.splitext(f)[1]}", f) for f in files_copied],
+      self.assignment_path, num_repeats, use_max, self.build_command, self.build_target, self.get_timeout()
+    )
+    if result_cache_key is not None:
+      results = self.result_cache.lookup(result_cache_key)
+      if results is not None:
+        return results
+    
+    # Most submissions score the same every run, so stop once stable_repeats runs in a row agree.  As soon as two
+    # runs disagree the submission is flaky, and we go on to the full num_repeats to find its worst (or best) case.
     results = misc.Feedback()
+    scores_seen = set()
+    num_agreeing = 0
+    num_runs = 0
+    timed_out = False
+    
+    # Built once and reused for every repeat
+    student_files = self.get_student_files(files_copied)
+    
+    # Compile once up front, so the repeats don't each rebuild
+    build_artifacts = None
+    if self.build_command is not None:
+      build_artifacts = self.build_student_code(student_files, files_copied)
+      if build_artifacts is not None:
+        student_files = build_artifacts
+    # What was built already used the student's header, otherwise each run has to rebuild everything against it
+    self.thread_state.remove_prebuilt_objects = (build_artifacts is None and self.includes_header(files_copied))
     
     for i in range(num_repeats):
       new_results = self.grade_in_docker(
-        os.path.abspath("./student_code"),
+        student_files,
         self.assignment_path,
         1
       )
+      num_runs += 1
       if is_better(new_results, results):
         # log.debug(f"Updating to use new results: {new_results}")
         results = new_results
       log.info(f"new_results: {new_results}")
+      
+      num_agreeing = (num_agreeing + 1) if new_results.overall_score in scores_seen else 1
+      scores_seen.add(new_results.overall_score)
+      timed_out = getattr(self.thread_state, "timed_out", False)
+      if len(scores_seen) == 1 and num_agreeing >= stable_repeats:
+        break
+      if timed_out:
+        # Most likely an infinite loop, which would just time out again on every repeat
+        log.info(f"Run timed out after {self.get_timeout()}s, not repeating")
+        break
+    
+    self.record_runs(kwargs.get("student_id"), num_runs, flaky=(len(scores_seen) > 1))
     if results.overall_score is None:
       results.overall_score = 0
     log.debug(f"final results: {results}")
-    shutil.rmtree("student_code")
+    # Flaky submissions could score differently next time, and a timeout could have been the machine being busy rather
+    # than the student's code, so they get rerun rather than cached
+    if result_cache_key is not None and len(scores_seen) == 1 and not timed_out:
+      self.result_cache.add(result_cache_key, results)
     return results
 
 
+class Grader_CST334_local(Grader_CST334):
+  """
+  Runs the same grading as Grader_CST334, but directly on this machine instead of in a container, which saves the
+  container overhead on short test runs.  Each run gets a throwaway copy of the assignments repo, and the harness is
+  run under prlimit (CPU time, memory, file size and process limits) in a sandbox made with unprivileged user, mount,
+  network, ipc and pid namespaces (see SANDBOX_SCRIPT).  The host needs the same toolchain as the grading image (gcc,
+  make, python) installed outside $HOME, which the sandbox hides.  Paths under /tmp/grading and /tmp/results in
+  commands are rewritten to the run's own directory.
+  """
+  CONTAINER_PATHS = {"/tmp/grading": "grading", "/tmp/results": "results"}
+  # Runs inside the new namespaces.  Builds a root out of read-only binds of the system directories, empty /tmp,
+  # /dev/shm and $HOME, a few device nodes and the job directory (the only thing that is writable), pivots into it and
+  # then runs the command in a nested user namespace, so the student's code can't undo any of it.  Nothing else on the
+  # host is visible: not the result, timeout and golden caches, not the sync state and not other students' jobs.
+  SANDBOX_SCRIPT = r"""
+    set -e
+    job_dir="$1"; work_dir="$2"; command="$3"; shift 3
+    root="$job_dir/.sandbox"
+    mount --make-rprivate /
+    mount -t tmpfs -o mode=755 sandbox "$root"
+    for dir in /usr /bin /sbin /lib /lib32 /lib64 /libx32 /etc /opt; do
+      if [ -L "$dir" ]; then
+        ln -s "$(readlink "$dir")" "$root$dir"
+      elif [ -d "$dir" ]; then
+        mkdir "$root$dir"
+        mount --rbind "$dir" "$root$dir"
+        mount -o remount,bind,ro "$root$dir"
+      fi
+    done
+    # In case $HOME or the cache dir live under one of the directories above
+    for hidden_dir in "$@"; do
+      if [ -d "$root$hidden_dir" ]; then
+        mount -t tmpfs -o mode=700 hidden "$root$hidden_dir"
+      fi
+    done
+    mkdir -p "$root/tmp" "$root/dev" "$root/proc"
+    mount -t tmpfs -o mode=1777 tmp "$root/tmp"
+    mount -t tmpfs -o mode=755 dev "$root/dev"
+    for device in null zero full random urandom tty; do
+      if [ -e "/dev/$device" ]; then
+        touch "$root/dev/$device"
+        mount --bind "/dev/$device" "$root/dev/$device"
+      fi
+    done
+    mkdir "$root/dev/shm"
+    mount -t tmpfs -o mode=1777 shm "$root/dev/shm"
+    mount -t proc proc "$root/proc" 2>/dev/null || true
+    mkdir -p "$root$job_dir"
+    mount --bind "$job_dir" "$root$job_dir"
+    cd "$root"
+    mkdir .old
+    pivot_root . .old
+    umount -l /.old
+    rmdir /.old
+    cd "$work_dir"
+    exec unshare --user --map-root-user bash -c "$command"
+  """
+  sandbox_available : bool|None = None
+  
+  def __init__(self, assignment_path, use_online_repo=False, cpu_seconds=300, memory_bytes=4*1024**3, max_processes=512, max_file_size=256*1024**2, allow_unsandboxed=False, **kwargs):
+    """
+    :param allow_unsandboxed: Grade with only resource limits if the sandbox can't be set up on this machine.  Student
+      code then runs as us with full access to our files, including the caches that grades are served from.
+    """
+    if not self.check_sandbox():
+      if not allow_unsandboxed:
+        raise RuntimeError("Could not set up the local grading sandbox (unprivileged user and mount namespaces are needed), use the docker backend or allow grading without it")
+      log.warning("Local grading sandbox isn't available, student code will run with resource limits only and can access this user's files")
+    kwargs["container_pool_size"] = 0
+    super().__init__(assignment_path, use_online_repo=use_online_repo, **kwargs)
+    self.cpu_seconds = cpu_seconds
+    self.memory_bytes = memory_bytes
+    self.max_processes = max_processes
+    self.max_file_size = max_file_size
+  
+  def start_environment_build(self, github_repo) -> concurrent.futures.Future:
+    # The "image" is a plain checkout of the repo
+    return GradingImageBuilder.submit_checkout(github_repo)
+  
+  def get_image_id(self) -> str:
+    return f"local:{os.path.basename(self.get_image())}"
+  
+  @property
+  def job_dir(self) -> str|None:
+    return getattr(self.thread_state, "job_dir", None)
+  
+  @job_dir.setter
+  def job_dir(self, job_dir: str|None):
+    self.thread_state.job_dir = job_dir
+  
+  @classmethod
+  def get_sandbox_args(cls, job_dir, work_dir, command) -> List[str]:
+    hidden_dirs = [os.path.expanduser("~"), misc.get_cache_dir()]
+    return [
+      "unshare", "--user", "--map-root-user", "--mount", "--net", "--ipc", "--pid", "--fork",
+      "bash", "-c", cls.SANDBOX_SCRIPT, "sandbox", job_dir, work_dir, command, *hidden_dirs
+    ]
+  
+  @classmethod
+  def check_sandbox(cls) -> bool:
+    if cls.sandbox_available is None:
+      job_dir = tempfile.mkdtemp(prefix="grading_sandbox_check_")
+      try:
+        os.mkdir(os.path.join(job_dir, ".sandbox"))
+        result = subprocess.run(cls.get_sandbox_args(job_dir, job_dir, "true"), capture_output=True, text=True)
+        cls.sandbox_available = (result.returncode == 0)
+        if not cls.sandbox_available:
+          log.debug(f"Sandbox check failed: {result.stderr.strip()}")
+      except FileNotFoundError as e:
+        log.debug(f"Sandbox check failed: {e}")
+        cls.sandbox_available = False
+      finally:
+        shutil.rmtree(job_dir, ignore_errors=True)
+    return cls.sandbox_available
+  
+  def translate_path(self, path: str) -> str:
+    for container_path, job_subdir in self.CONTAINER_PATHS.items():
+      if path == container_path or path.startswith(container_path + "/"):
+        return os.path.join(self.job_dir, job_subdir) + path[len(container_path):]
+    return path
+  
+  def translate_command(self, command: str) -> str:
+    return re.sub(
+      "|".join(re.escape(container_path) + r"(?=/|\b)" for container_path in self.CONTAINER_PATHS),
+      lambda match: self.translate_path(match.group(0)),
+      command
+    )
+  
+  def start(self, checkout_dir):
+    parent_dir = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else None
+    self.job_dir = tempfile.mkdtemp(prefix="grading_job_", dir=parent_dir)
+    # Mount point for the sandbox's root
+    os.mkdir(os.path.join(self.job_dir, ".sandbox"))
+    shutil.copytree(checkout_dir, os.path.join(self.job_dir, "grading"), symlinks=True)
+    self.results_dir = os.path.join(self.job_dir, "results")
+    os.mkdir(self.results_dir)
+  
+  def add_files_to_docker(self, files_to_copy : ContainerArchive|typing.Dict[str, bytes|str]|List[Tuple[str,str]] = None):
+    archive = ContainerArchive.from_files_to_copy(files_to_copy)
+    with tarfile.open(fileobj=io.BytesIO(archive.data), mode="r") as tarhandle:
+      tarhandle.extractall(self.translate_path(archive.root))
+  
+  def execute(self, command="", container=None, workdir=None) -> typing.Tuple[int, str, str]:
+    log.debug(f"execute: {command}")
+    args = [
+      "prlimit",
+      f"--cpu={self.cpu_seconds}",
+      f"--as={self.memory_bytes}",
+      f"--nproc={self.max_processes}",
+      f"--fsize={self.max_file_size}",
+      "--",
+    ]
+    work_dir = (self.translate_path(workdir) if workdir is not None else os.path.join(self.job_dir, "grading"))
+    if self.check_sandbox():
+      args += self.get_sandbox_args(self.job_dir, work_dir, self.translate_command(command))
+    else:
+      args += ["bash", "-c", self.translate_command(command)]
+    
+    # Output is combined like it is with a tty in docker
+    result = subprocess.run(
+      args,
+      cwd=work_dir,
+      env={"PATH": os.environ.get("PATH", "/usr/bin:/bin"), "HOME": self.job_dir, "LANG": "C.UTF-8"},
+      stdin=subprocess.DEVNULL,
+      stdout=subprocess.PIPE,
+      stderr=subprocess.STDOUT
+    )
+    log.debug(f"stdout: {result.stdout}")
+    return result.returncode, result.stdout, None
+  
+  def read_file(self, path_to_file) -> str|None:
+    try:
+      with open(self.translate_path(path_to_file)) as fid:
+        return fid.read()
+    except OSError as e:
+      log.error(f"Could not read {path_to_file}: {e}")
+      return None
+  
+  def get_archive(self, path) -> ContainerArchive:
+    local_path = self.translate_path(path.rstrip('/'))
+    tarstream = io.BytesIO()
+    with tarfile.open(fileobj=tarstream, mode="w") as tarhandle:
+      tarhandle.add(local_path, arcname=os.path.basename(local_path))
+    return ContainerArchive(os.path.dirname(path.rstrip('/')), tarstream.getvalue())
+  
+  def stop(self):
+    shutil.rmtree(self.job_dir, ignore_errors=True)
+    self.job_dir = None
+    self.results_dir = None
+
+
 class Grader_stepbystep(Grader_docker):
+  # The student container is shared between steps, so only one student at a time
+  supports_parallel_grading = False
   # todo:
   #  We will want to enable rollback, where we can "undo" a few instructions.  This will likely be done by restarting student container
   #  This will likely mean either overriding grade_in_docker, or a new function that restarts student and walks it forward again
   
-  def __init__(self, rubric_file, *args, **kwargs):
-    super().__init__(*args, **kwargs)
+  def __init__(self, rubric_file, use_shell_session=True, use_result_cache=True, step_timeout=None, *args, **kwargs):
+    """
+    :param use_shell_session: Run each container's steps in one persistent shell, so state like cd carries over
+      between steps and each step doesn't need its own exec.  Otherwise every step is a separate bash -c.
+    :param step_timeout: Seconds each step gets in the shell session before it is given up on, or None for no limit
+    """
+    super().__init__(*args, use_result_cache=use_result_cache, **kwargs)
     self.rubric = self.parse_rubric(rubric_file)
-    self.golden_container : docker.models.containers.Container = None
+    self.use_shell_session = use_shell_session
+    self.step_timeout = step_timeout
+    self.shell_sessions : typing.Dict[str, ShellSession] = {}
     self.student_container : docker.models.containers.Container = None
+    self.golden_transcript : typing.List[typing.Tuple[int, bytes|None, bytes|None]]|None = None
+    
+    # Golden state after each rubric step, shared by every student for rollbacks, with the shell state that goes with it
+    self.snapshots : List[docker.models.images.Image] = []
+    self.snapshot_shell_states : List[str|None] = []
+    self.snapshot_container : docker.models.containers.Container = None
+    self.snapshot_lock = threading.Lock()
   
   def parse_rubric(self, rubric_file):
     with open(rubric_file) as fid:
@@ -392,28 +1013,118 @@ class Grader_stepbystep(Grader_docker):
     with open(student_file) as fid:
       return [l.strip() for l in fid.readlines()]
       
-  def rollback(self):
+  def get_snapshot(self, step_index) -> docker.models.images.Image:
+    """
+    Image of the golden state after rubric step step_index.  Snapshots are made by walking a container of our own
+    through the rubric and committing after every step, so each one is only made once per run rather than once per
+    student per mismatch.
+    """
+    with self.snapshot_lock:
+      steps = self.rubric["steps"]
+      while len(self.snapshots) <= step_index:
+        if self.snapshot_container is None:
+          self.snapshot_container = self.client.containers.run(
+            image=self.get_image(),
+            detach=True,
+            tty=True
+          )
+        next_step = len(self.snapshots)
+        self.execute(container=self.snapshot_container, command=steps[next_step])
+        self.snapshots.append(
+          self.snapshot_container.commit(repository="rollback", tag=f"{os.getpid()}-{id(self)}-{next_step}")
+        )
+        self.snapshot_shell_states.append(
+          self.get_shell_session(self.snapshot_container).get_state() if self.use_shell_session else None
+        )
+      return self.snapshots[step_index]
+  
+  def rollback(self, step_index):
+    """Put the student container in the golden state after step_index"""
+    with self.timeline.span("rollback", step=step_index):
+      self.restart_student_container(step_index)
+  
+  def restart_student_container(self, step_index):
     # Stop and delete student container
+    self.close_shell_session(self.student_container)
     self.student_container.stop(timeout=1)
     self.student_container.remove()
     self.student_container = None
     
-    # Make a copy of the golden_container
-    rollback_image = self.golden_container.commit(repository="rollback", tag="latest")
-    
-    # Start student from the copy we just made
+    # Start student from the snapshot of that step
     self.student_container = self.client.containers.run(
-      image=rollback_image.id,
+      image=self.get_snapshot(step_index).id,
       detach=True,
       tty=True
     )
+    if self.snapshot_shell_states[step_index] is not None:
+      self.get_shell_session(self.student_container).restore_state(self.snapshot_shell_states[step_index])
+  
+  def cleanup(self):
+    with self.snapshot_lock:
+      if self.snapshot_container is not None:
+        self.close_shell_session(self.snapshot_container)
+        self.snapshot_container.remove(force=True)
+        self.snapshot_container = None
+      # Newest first, since each snapshot is the parent of the next one
+      for snapshot in reversed(self.snapshots):
+        try:
+          self.client.images.remove(snapshot.id, force=True)
+        except docker.errors.APIError as e:
+          log.warning(f"Could not remove rollback snapshot {snapshot.short_id}: {e}")
+      self.snapshots = []
+      self.snapshot_shell_states = []
+    super().cleanup()
+  
+  def get_golden_transcript_path(self) -> str:
+    image_id = self.get_image_id()
+    rubric_hash = hashlib.sha256(json.dumps(self.rubric["steps"]).encode()).hexdigest()
+    # The shell session and bash -c give differently formatted output (no tty, separate stderr), so keep them apart
+    backend = "exec"
+    if self.use_shell_session:
+      backend = "shell" if self.step_timeout is None else f"shell-{self.step_timeout}s"
+    return os.path.join(misc.get_cache_dir("golden"), f"{rubric_hash[:16]}-{image_id.split(':')[-1][:16]}-{backend}.json")
+  
+  def get_golden_transcript(self) -> typing.List[typing.Tuple[int, bytes|None, bytes|None]]:
+    """
+    (rc, stdout, stderr) for each rubric step run in order in a fresh container.  This is the same for every student,
+    so it is worked out once per rubric and image and kept on disk.
+    """
+    with self.snapshot_lock:
+      if self.golden_transcript is not None:
+        return self.golden_transcript
+      
+      def encode(output: bytes|None):
+        return None if output is None else base64.b64encode(output).decode()
+      def decode(output: str|None):
+        return None if output is None else base64.b64decode(output)
+      
+      transcript_path = self.get_golden_transcript_path()
+      if os.path.exists(transcript_path):
+        with open(transcript_path) as fid:
+          self.golden_transcript = [(rc, decode(stdout), decode(stderr)) for rc, stdout, stderr in json.load(fid)]
+        log.debug(f"Loaded golden transcript from {transcript_path}")
+        return self.golden_transcript
+      
+      log.info("Running rubric to get the golden transcript")
+      golden_container = self.client.containers.run(
+        image=self.get_image(),
+        detach=True,
+        tty=True
+      )
+      try:
+        self.golden_transcript = [self.execute(container=golden_container, command=step) for step in self.rubric["steps"]]
+      finally:
+        self.close_shell_session(golden_container)
+        golden_container.remove(force=True)
+      
+      tmp_path = f"{transcript_path}.part"
+      with open(tmp_path, 'w') as fid:
+        json.dump([(rc, encode(stdout), encode(stderr)) for rc, stdout, stderr in self.golden_transcript], fid)
+      os.replace(tmp_path, transcript_path)
+      return self.golden_transcript
   
   def start(self, image : docker.models.images,):
-    self.golden_container = self.client.containers.run(
-      image=image,
-      detach=True,
-      tty=True
-    )
+    # The golden side comes from get_golden_transcript and get_snapshot, so only the student needs a container
     self.student_container = self.client.containers.run(
       image=image,
       detach=True,
@@ -421,13 +1132,31 @@ class Grader_stepbystep(Grader_docker):
     )
   
   def stop(self):
-    self.golden_container.stop(timeout=1)
-    self.golden_container.remove()
-    self.golden_container = None
+    self.close_shell_session(self.student_container)
     self.student_container.stop(timeout=1)
     self.student_container.remove()
     self.student_container = None
   
+  def get_shell_session(self, container: docker.models.containers.Container) -> ShellSession:
+    if container.id not in self.shell_sessions:
+      self.shell_sessions[container.id] = ShellSession(self.client, container, timeout=self.step_timeout)
+    return self.shell_sessions[container.id]
+  
+  def close_shell_session(self, container: docker.models.containers.Container):
+    shell_session = self.shell_sessions.pop(container.id, None)
+    if shell_session is not None:
+      shell_session.close()
+  
+  def execute(self, command="", container=None, workdir=None) -> typing.Tuple[int, str, str]:
+    if not self.use_shell_session or workdir is not None:
+      return super().execute(command, container, workdir)
+    if container is None:
+      container = self.container
+    log.debug(f"execute: {command}")
+    rc, stdout, stderr = self.get_shell_session(container).run(command)
+    log.debug(f"stdout: {stdout}")
+    return rc, stdout, stderr
+  
   
   def execute_grading(self, golden_lines=[], student_lines=[], rollback=True, *args, **kwargs):
     golden_results = collections.defaultdict(list)
@@ -437,15 +1166,16 @@ class Grader_stepbystep(Grader_docker):
       results_dict["stdout"].append(stdout)
       results_dict["stderr"].append(stderr)
     
+    golden_transcript = self.get_golden_transcript()
     for i, (golden, student) in enumerate(zip(golden_lines, student_lines)):
       log.debug(f"commands: '{golden}' <-> '{student}'")
-      rc_g, stdout_g, stderr_g = self.execute(container=self.golden_container, command=golden)
+      rc_g, stdout_g, stderr_g = golden_transcript[i]
       rc_s, stdout_s, stderr_s = self.execute(container=self.student_container, command=student)
       add_results(golden_results, rc_g, stdout_g, stderr_g)
       add_results(student_results, rc_s, stdout_s, stderr_s)
       if (not self.outputs_match(stdout_g, stdout_s, stderr_g, stderr_s, rc_g, rc_s) ) and rollback:
         # Bring the student container up to date with our container
-        self.rollback()
+        self.rollback(i)
     
     return golden_results, student_results
   
@@ -484,9 +1214,20 @@ class Grader_stepbystep(Grader_docker):
     golden_lines = self.rubric["steps"]
     student_lines = self.parse_student_file(input_files[0])
     
+    result_cache_key = self.get_result_cache_key(
+      [("steps", input_files[0])],
+      json.dumps(golden_lines), self.use_shell_session, self.step_timeout, kwargs.get("rollback", True)
+    )
+    if result_cache_key is not None:
+      results = self.result_cache.lookup(result_cache_key)
+      if results is not None:
+        return results
+    
     results = self.grade_in_docker(golden_lines=golden_lines, student_lines=student_lines, *args, **kwargs)
     
     log.debug(f"final results: {results}")
+    if result_cache_key is not None:
+      self.result_cache.add(result_cache_key, results)
     return results
 
 
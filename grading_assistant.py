@@ -49,6 +49,11 @@ def GUI():
   root.mainloop()
 
 
+def parse_grade_workers(value: str):
+  if value == "auto":
+    return value
+  return int(value)
+
 def parse_args():
 
   # Create a parent parser with shared arguments
@@ -58,12 +63,28 @@ def parse_args():
   parent_parser.add_argument("--assignment_id", type=int, default=377043)
   parent_parser.add_argument("--name", default="PA1")
   parent_parser.add_argument("--regrade", action="store_true")
+  parent_parser.add_argument("--full_resync", "--full-resync", action="store_true", dest="full_resync", help="Ignore what previous runs recorded as already graded")
   parent_parser.add_argument("--online", action="store_true")
   parent_parser.add_argument("--prod", action="store_true")
   parent_parser.add_argument("--push", action="store_true")
-  parent_parser.add_argument("--clobber", action="store_true")
+  parent_parser.add_argument("--clobber", action="store_true", help="Delete all existing comments before pushing feedback")
+  parent_parser.add_argument("--clobber_own", action="store_true", help="Only delete existing comments that were posted by this account (e.g. old feedback.txt files)")
+  parent_parser.add_argument("--clobber_dry_run", action="store_true", help="Report how many comments would be deleted without changing anything on canvas")
   parent_parser.add_argument("--limit", type=int)
   parent_parser.add_argument("--user_id", type=int, default=None, help="Specific user_id to check submission for")
+  parent_parser.add_argument("--pipeline", action="store_true", help="Download, grade and push students concurrently instead of one phase at a time")
+  parent_parser.add_argument("--download_workers", type=int, default=4)
+  parent_parser.add_argument("--grade_workers", type=parse_grade_workers, default=1, help="Students to grade at once, or 'auto' to size it to this machine")
+  parent_parser.add_argument("--push_workers", type=int, default=2)
+  parent_parser.add_argument("--backend", choices=["docker", "local"], default="docker", help="Run the grading harness in docker containers or in a local sandbox")
+  parent_parser.add_argument("--reference_solution", default=None, help="Reference student_code.c, or a directory with its .c and .h, to set test timeouts from ({assignment} is replaced by the assignment name)")
+  parent_parser.add_argument("--build_target", default=None, help="Make target the test harness builds, to build once ahead of the test runs (default: the Makefile's default target)")
+  parent_parser.add_argument("--allow_unsandboxed", action="store_true", help="With --backend local, grade even if the sandbox can't be set up here (student code can then access this user's files)")
+  parent_parser.add_argument("--timing_report", default=None, help="Write per-phase/per-student grading timings to this .json or .csv file ({assignment} is replaced by the assignment name)")
+  parent_parser.add_argument("--trace", default=None, help="Write grading timings as a Chrome trace to this file ({assignment} is replaced by the assignment name)")
+  parent_parser.add_argument("--sample_container_stats", action="store_true", help="Record peak memory and CPU use of each grading container")
+  parent_parser.add_argument("--no_result_cache", action="store_false", dest="use_result_cache", help="Grade every submission even if the same files were graded before")
+  parent_parser.add_argument("--container_pool_size", type=int, default=2, help="Warm grading containers to reuse between runs (0 starts a fresh container every run)")
   
   # Main parser
   parser = argparse.ArgumentParser()
@@ -87,11 +108,36 @@ def parse_args():
   
   return args
 
+def get_clobber_kwargs(args) -> dict:
+  clobber_feedback = "own" if args.clobber_own else args.clobber
+  return {
+    "clobber_feedback": clobber_feedback,
+    "clobber_dry_run": args.clobber_dry_run,
+  }
+
+def get_pipeline_kwargs(args) -> dict:
+  if not args.pipeline:
+    return {"grade_workers": args.grade_workers}
+  return {
+    "pipelined": True,
+    "download_workers": args.download_workers,
+    "grade_workers": args.grade_workers,
+    "push_workers": args.push_workers,
+  }
+
+def get_timing_kwargs(args, assignment_name) -> dict:
+  return {
+    "timing_report": args.timing_report.format(assignment=assignment_name) if args.timing_report is not None else None,
+    "trace_file": args.trace.format(assignment=assignment_name) if args.trace is not None else None,
+    "sample_container_stats": args.sample_container_stats,
+  }
+
+def get_reference_solution(args, assignment_name) -> str|None:
+  return args.reference_solution.format(assignment=assignment_name) if args.reference_solution is not None else None
+
 def run_moss_flow(course_id: int, assignment_id: int, assignment_name: str, prod: bool, limit=None):
   with assignment.CanvasAssignment(course_id, assignment_id, prod) as a:
-    student_submissions = a.get_student_submissions(a.canvas_assignment, False)
-    if limit != None:
-      student_submissions = student_submissions[:limit]
+    student_submissions = list(a.iter_student_submissions(limit=limit))
     submissions = a.download_submission_files(student_submissions)
     submission_c_files = [os.path.basename(item) for sublist in submissions.values() for item in sublist if item.endswith(".c")]
     
@@ -118,7 +164,8 @@ def run_semi_manual_flow(
     prod: bool,
     limit=None,
     push_feedback=False,
-    clobber_feedback=False
+    clobber_feedback=False,
+    clobber_dry_run=False
 ):
   if isinstance(csv_or_df, str):
     df = pd.read_csv(csv_or_df)
@@ -149,7 +196,8 @@ def run_semi_manual_flow(
       grader=grader.Grader_old_manual(df),
       push_feedback=push_feedback,
       to_upload_base_dir=upload_dir,
-      clobber_feedback=clobber_feedback
+      clobber_feedback=clobber_feedback,
+      clobber_dry_run=clobber_dry_run
     )
   
 
@@ -168,9 +216,15 @@ def main():
       assignment_id = int(assignment_id)
       log.debug(f"{assignment_name}, {assignment_id}")
       with assignment.CanvasProgrammingAssignment(args.course_id, assignment_id, args.prod) as a:
-        a.prepare_assignment_for_grading(limit=args.limit, regrade=args.regrade)
+        a.prepare_assignment_for_grading(limit=args.limit, regrade=args.regrade, download=(not args.pipeline), full_resync=args.full_resync)
         if a.needs_grading:
-          a.grade(grader.Grader_stepbystep(rubric_file=args.rubric), push_feedback=args.push, rollback=args.rollback)
+          a.grade(
+            grader.Grader_stepbystep(rubric_file=args.rubric, use_result_cache=args.use_result_cache, **get_timing_kwargs(args, assignment_name)),
+            push_feedback=args.push,
+            rollback=args.rollback,
+            **get_clobber_kwargs(args),
+            **get_pipeline_kwargs(args)
+          )
         else:
           log.info("No grading needed")
   
@@ -190,7 +244,7 @@ def main():
         args.prod,
         args.limit,
         push_feedback=args.push,
-        clobber_feedback=args.clobber
+        **get_clobber_kwargs(args)
       )
   else:
     
@@ -198,11 +252,21 @@ def main():
     for assignment_name, assignment_id in args.assignments:
       assignment_id = int(assignment_id)
       log.debug(f"{assignment_name}, {assignment_id}")
+      # Creating the grader starts the image build, which then runs while submissions are downloaded
+      if args.backend == "local":
+        assignment_grader = grader.Grader_CST334_local(assignment_name, use_online_repo=args.online, allow_unsandboxed=args.allow_unsandboxed, use_result_cache=args.use_result_cache, build_target=args.build_target, reference_solution=get_reference_solution(args, assignment_name), **get_timing_kwargs(args, assignment_name))
+      else:
+        assignment_grader = grader.Grader_CST334(assignment_name, use_online_repo=args.online, container_pool_size=args.container_pool_size, use_result_cache=args.use_result_cache, build_target=args.build_target, reference_solution=get_reference_solution(args, assignment_name), **get_timing_kwargs(args, assignment_name))
       with assignment.CanvasProgrammingAssignment(args.course_id, assignment_id, args.prod) as a:
         # a = assignment.CanvasAssignment(args.course_id, assignment_id, args.prod)
-        a.prepare_assignment_for_grading(limit=args.limit, regrade=args.regrade, user_ids=[args.user_id])
+        a.prepare_assignment_for_grading(limit=args.limit, regrade=args.regrade, user_ids=[args.user_id], download=(not args.pipeline), full_resync=args.full_resync)
         if a.needs_grading:
-          a.grade(grader.Grader_CST334(assignment_name, use_online_repo=args.online), push_feedback=args.push)
+          a.grade(
+            assignment_grader,
+            push_feedback=args.push,
+            **get_clobber_kwargs(args),
+            **get_pipeline_kwargs(args)
+          )
         else:
           log.info("No grading needed")
   return
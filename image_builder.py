@@ -0,0 +1,163 @@
+#!env python
+from __future__ import annotations
+
+import concurrent.futures
+import hashlib
+import io
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tarfile
+import threading
+from typing import Dict, Tuple
+
+import docker
+import docker.errors
+import docker.models.images
+
+import misc
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+class GradingImageBuilder:
+  """
+  Builds the grading image (base image + a prebuilt checkout of the assignments repo), tagged by the repo commit, the
+  base image id and the Dockerfile so that an unchanged repo and base image reuse the image from a previous build instead of rebuilding it.
+  The repo is cloned once into a local mirror, which is fetched before each build and used as the build source, so
+  rebuilds don't clone over the network and still work offline.
+  Builds run in the background; submit() hands back a future and builds of the same image are shared.
+  """
+  # Build everything that doesn't depend on the student (test files, libraries, the starter code) for each assignment
+  # ahead of time, so grading only has to recompile the student's file and relink.  -k gets as much built as possible
+  # even if the starter code itself doesn't compile.
+  PREBUILD_SCRIPT = (
+    "for assignment_dir in {grading_dir}/programming-assignments/*/; do "
+    "if [ -f \"$assignment_dir/Makefile\" ] || [ -f \"$assignment_dir/makefile\" ]; then "
+    "make -k -C \"$assignment_dir\" > /dev/null 2>&1 || true; "
+    "fi; "
+    "done"
+  )
+  
+  executor : concurrent.futures.ThreadPoolExecutor|None = None
+  futures : Dict[Tuple[str, str], concurrent.futures.Future] = {}
+  lock = threading.Lock()
+
+  @classmethod
+  def submit_job(cls, key, func, *args) -> concurrent.futures.Future:
+    with cls.lock:
+      if key not in cls.futures:
+        if cls.executor is None:
+          cls.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="image_build")
+        cls.futures[key] = cls.executor.submit(func, *args)
+      return cls.futures[key]
+
+  @classmethod
+  def submit(cls, client: docker.DockerClient, base_image: str, github_repo: str) -> concurrent.futures.Future:
+    return cls.submit_job((base_image, github_repo), cls.build, client, base_image, github_repo)
+
+  @classmethod
+  def submit_checkout(cls, github_repo: str) -> concurrent.futures.Future:
+    """Like submit, but for a plain directory checkout of the repo (for grading without docker)"""
+    return cls.submit_job(("checkout", github_repo), cls.checkout, github_repo)
+
+  @classmethod
+  def checkout(cls, github_repo: str) -> str:
+    """Extract the repo at its current commit into the cache dir (once per commit) and return the directory"""
+    commit = cls.update_mirror(github_repo)
+    checkout_dir = os.path.join(misc.get_cache_dir("checkouts"), commit)
+    if not os.path.exists(checkout_dir):
+      log.info(f"Checking out {github_repo} at {commit[:12]}")
+      archive = subprocess.run(
+        ["git", "--git-dir", cls.get_mirror_path(github_repo), "archive", "--format=tar", commit],
+        check=True,
+        capture_output=True
+      ).stdout
+      tmp_dir = f"{checkout_dir}.part"
+      shutil.rmtree(tmp_dir, ignore_errors=True)
+      with tarfile.open(fileobj=io.BytesIO(archive), mode="r") as tarhandle:
+        tarhandle.extractall(tmp_dir)
+      subprocess.run(["bash", "-c", cls.PREBUILD_SCRIPT.format(grading_dir=tmp_dir)], check=False, capture_output=True)
+      os.replace(tmp_dir, checkout_dir)
+    return checkout_dir
+
+  @staticmethod
+  def get_mirror_path(github_repo: str) -> str:
+    repo_name = re.sub(r"[^A-Za-z0-9._-]+", "_", github_repo.split("://")[-1]).strip("_")
+    return os.path.join(misc.get_cache_dir("git"), repo_name)
+
+  @classmethod
+  def update_mirror(cls, github_repo: str) -> str:
+    """Clone or fetch the local mirror of github_repo and return the commit its default branch points at"""
+    mirror_path = cls.get_mirror_path(github_repo)
+    if not os.path.exists(mirror_path):
+      log.info(f"Creating local mirror of {github_repo}")
+      subprocess.run(["git", "clone", "--mirror", "--quiet", github_repo, mirror_path], check=True, capture_output=True)
+    else:
+      result = subprocess.run(["git", "--git-dir", mirror_path, "fetch", "--prune", "--quiet"], capture_output=True, text=True)
+      if result.returncode != 0:
+        log.warning(f"Could not fetch {github_repo}, building from the local mirror as-is: {result.stderr.strip()}")
+    result = subprocess.run(["git", "--git-dir", mirror_path, "rev-parse", "HEAD"], check=True, capture_output=True, text=True)
+    return result.stdout.strip()
+
+  @staticmethod
+  def get_base_image(client: docker.DockerClient, base_image: str) -> docker.models.images.Image:
+    try:
+      return client.images.pull(base_image)
+    except docker.errors.APIError as e:
+      log.warning(f"Could not pull {base_image}, using the local copy: {e}")
+      return client.images.get(base_image)
+
+  @classmethod
+  def get_docker_file(cls, base_image: str) -> str:
+    return f"""
+    FROM {base_image}
+    COPY repo /tmp/grading/
+    RUN {cls.PREBUILD_SCRIPT.format(grading_dir="/tmp/grading")}
+    WORKDIR /tmp/grading
+    CMD ["/bin/bash"]
+    """
+
+  @classmethod
+  def get_build_context(cls, base_image: str, github_repo: str, commit: str) -> io.BytesIO:
+    """Tarball of the repo at commit with a Dockerfile that copies it to /tmp/grading"""
+    archive = subprocess.run(
+      ["git", "--git-dir", cls.get_mirror_path(github_repo), "archive", "--format=tar", "--prefix=repo/", commit],
+      check=True,
+      capture_output=True
+    ).stdout
+    context = io.BytesIO(archive)
+    docker_file = cls.get_docker_file(base_image).encode()
+    with tarfile.open(fileobj=context, mode="a") as tarhandle:
+      tarinfo = tarfile.TarInfo("Dockerfile")
+      tarinfo.size = len(docker_file)
+      tarhandle.addfile(tarinfo, io.BytesIO(docker_file))
+    context.seek(0)
+    return context
+
+  @classmethod
+  def build(cls, client: docker.DockerClient, base_image: str, github_repo: str) -> docker.models.images.Image:
+    commit = cls.update_mirror(github_repo)
+    base = cls.get_base_image(client, base_image)
+    # Changes to how the image is put together need a new image too
+    docker_file_hash = hashlib.sha256(cls.get_docker_file(base_image).encode()).hexdigest()
+    tag = f"{commit[:12]}-{base.id.split(':')[-1][:12]}-{docker_file_hash[:8]}"
+
+    try:
+      image = client.images.get(f"grading:{tag}")
+      log.info(f"Reusing grading image grading:{tag}")
+    except docker.errors.ImageNotFound:
+      log.info(f"Building grading image grading:{tag}...")
+      image, logs = client.images.build(
+        fileobj=cls.get_build_context(base_image, github_repo, commit),
+        custom_context=True,
+        tag=f"grading:{tag}",
+        rm=True
+      )
+      log.debug("Docker image built successfully")
+    image.tag("grading", "latest")
+    return image
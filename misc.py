@@ -2,10 +2,13 @@
 from __future__ import annotations
 
 import abc
+import contextlib
 import dataclasses
 import io
 import logging
 import os
+import tempfile
+import threading
 from typing import List, Dict
 
 from openai.types import CompletionUsage
@@ -28,6 +31,87 @@ def get_file_list(dir_to_deduplicate) -> List[str]:
   )
 
 
+def get_cache_dir(*subdirs) -> str:
+  """
+  Returns (and creates) a directory for state that should persist between runs.
+  Can be redirected with the GRADING_ASSISTANT_CACHE environment variable.
+  """
+  cache_dir = os.path.join(
+    os.path.expanduser(os.environ.get("GRADING_ASSISTANT_CACHE", "~/.cache/grading_assistant")),
+    *subdirs
+  )
+  os.makedirs(cache_dir, exist_ok=True)
+  return cache_dir
+
+
+def make_results_dir() -> str:
+  """
+  A fresh host directory to bind-mount into a grading container for it to write results to.
+  Uses /dev/shm when there is one, so results never touch disk.
+  Only we and our group can get in, so containers that mount it need our gid added (see results_dir_group_add).
+  """
+  parent_dir = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else None
+  results_dir = tempfile.mkdtemp(prefix="grading_results_", dir=parent_dir)
+  # Not world-writable, since other users on the host could otherwise plant or read results.  Root in the container
+  # gets in regardless, and an image that runs as some other user gets in through our group.
+  os.chmod(results_dir, 0o770)
+  return results_dir
+
+
+def results_dir_group_add() -> List[int]:
+  """Supplementary groups to run a container with so that whatever user it runs as can write to make_results_dir()"""
+  return [os.getgid()]
+
+
+def get_default_parallelism(memory_per_worker=1024**3) -> int:
+  """
+  How many students to grade at once on this host: one per available core, but no more than fit in memory.
+  :param memory_per_worker: bytes of RAM to budget for each student being graded (e.g. for their container)
+  """
+  try:
+    num_cores = len(os.sched_getaffinity(0))
+  except AttributeError:
+    num_cores = os.cpu_count() or 1
+  try:
+    total_memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+  except (ValueError, OSError, AttributeError):
+    return num_cores
+  return max(1, min(num_cores, total_memory // memory_per_worker))
+
+
+# Tag that log lines from the current thread are prefixed with, e.g. the student being graded
+log_context = threading.local()
+
+
+@contextlib.contextmanager
+def log_tag(tag):
+  previous_tag = getattr(log_context, "tag", None)
+  log_context.tag = tag
+  try:
+    yield
+  finally:
+    log_context.tag = previous_tag
+
+
+def install_log_tags():
+  """Prefix every log record made while inside log_tag(...) with its tag, so interleaved parallel output can be told apart"""
+  record_factory = logging.getLogRecordFactory()
+  if getattr(record_factory, "adds_log_tags", False):
+    return
+  
+  def tagged_record_factory(*args, **kwargs):
+    record = record_factory(*args, **kwargs)
+    tag = getattr(log_context, "tag", None)
+    if tag is not None:
+      record.msg = f"[{tag}] {record.msg}"
+    return record
+  tagged_record_factory.adds_log_tags = True
+  logging.setLogRecordFactory(tagged_record_factory)
+
+
+install_log_tags()
+
+
 class Costable(abc.ABC):
   
   class TokenCounts:
@@ -0,0 +1,116 @@
+#!env python
+from __future__ import annotations
+
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable, List
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+class Stage:
+  """
+  One step of a Pipeline.
+  `func` takes a single item and returns a list of items to hand to the next stage (empty to drop the item), which lets
+  a stage fan out, e.g. one submission turning into several attempts.
+  """
+  def __init__(self, name: str, func: Callable[[Any], List[Any]], num_workers=1, queue_size=4):
+    self.name = name
+    self.func = func
+    self.num_workers = max(1, num_workers)
+    self.queue_size = queue_size
+
+    self.items_processed = 0
+    self.busy_time = 0.0
+    self.errors : List[Exception] = []
+    self.lock = threading.Lock()
+
+  def __str__(self):
+    return f"Stage({self.name}, workers={self.num_workers}, processed={self.items_processed}, errors={len(self.errors)}, busy={self.busy_time:0.1f}s)"
+
+
+class Pipeline:
+  """
+  Runs items through a series of stages connected by bounded queues, so different items can be in different stages at
+  the same time (e.g. downloading student N+1 while grading student N and pushing student N-1).
+  Each stage has its own pool of worker threads, and a full queue blocks the stage feeding it, so a slow stage applies
+  backpressure instead of letting work pile up in memory.
+  """
+
+  # Marks the end of the input for a queue
+  _DONE = object()
+
+  def __init__(self, stages: List[Stage]):
+    self.stages = stages
+
+  def run(self, items: Iterable[Any]) -> List[Any]:
+    """
+    Push items through every stage.
+    :return: outputs of the last stage, in completion order
+    """
+    start_time = time.time()
+    queues = [queue.Queue(maxsize=stage.queue_size) for stage in self.stages]
+    results = []
+    results_lock = threading.Lock()
+
+    def emit(stage_index, outputs):
+      if stage_index + 1 < len(self.stages):
+        for output in outputs:
+          queues[stage_index + 1].put(output)
+      else:
+        with results_lock:
+          results.extend(outputs)
+
+    def worker(stage_index):
+      stage = self.stages[stage_index]
+      input_queue = queues[stage_index]
+      while True:
+        item = input_queue.get()
+        if item is self._DONE:
+          # Let the other workers of this stage see the marker too
+          input_queue.put(self._DONE)
+          return
+        item_start_time = time.time()
+        try:
+          outputs = stage.func(item)
+        except Exception as e:
+          log.error(f"{stage.name} failed on {item}: {e}")
+          with stage.lock:
+            stage.errors.append(e)
+          outputs = []
+        with stage.lock:
+          stage.items_processed += 1
+          stage.busy_time += time.time() - item_start_time
+        emit(stage_index, outputs if outputs is not None else [])
+
+    # Start every stage up front so work flows downstream as soon as the first item is ready
+    workers_by_stage = []
+    for stage_index, stage in enumerate(self.stages):
+      stage_workers = [
+        threading.Thread(target=worker, args=(stage_index,), name=f"{stage.name}-{i}", daemon=True)
+        for i in range(stage.num_workers)
+      ]
+      for t in stage_workers:
+        t.start()
+      workers_by_stage.append(stage_workers)
+
+    # Feed the first stage, blocking whenever it's backed up
+    for item in items:
+      queues[0].put(item)
+    queues[0].put(self._DONE)
+
+    # Shut down stage by stage, since a stage is only finished once everything upstream of it has finished
+    for stage_index, stage_workers in enumerate(workers_by_stage):
+      for t in stage_workers:
+        t.join()
+      if stage_index + 1 < len(queues):
+        queues[stage_index + 1].put(self._DONE)
+
+    log.info(f"Pipeline finished in {time.time() - start_time:0.1f}s")
+    for stage in self.stages:
+      log.info(f"  {stage}")
+    return results
@@ -0,0 +1,92 @@
+#!env python
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, Tuple
+
+import misc
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+class GradingResultCache:
+  """
+  Feedback from earlier grading runs, keyed by a hash of everything that went into them: the student's files, the
+  assignment, the grading image and the grader version.  Unchanged resubmissions and identical submissions (e.g.
+  untouched starter code) then don't have to be graded again, including across --regrade runs.
+  """
+
+  def __init__(self, cache_dir=None):
+    if cache_dir is None:
+      cache_dir = misc.get_cache_dir("results")
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(os.path.join(cache_dir, "results.sqlite"), check_same_thread=False)
+    with self.db:
+      self.db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, feedback TEXT, created_at REAL)")
+    self.hits = 0
+    self.misses = 0
+
+  def close(self):
+    self.db.close()
+
+  @staticmethod
+  def get_key(files: Iterable[Tuple[str, str]], *parts) -> str:
+    """
+    :param files: (name the file is graded as, local path) for each of the student's files
+    :param parts: anything else the result depends on, e.g. assignment, image id and grader version
+    """
+    sha = hashlib.sha256()
+    for part in parts:
+      sha.update(f"{part}\0".encode())
+    for name, path in sorted(files):
+      sha.update(f"{name}\0".encode())
+      with open(path, 'rb') as fid:
+        for chunk in iter(lambda: fid.read(1024*1024), b''):
+          sha.update(chunk)
+      sha.update(b"\0")
+    return sha.hexdigest()
+
+  def lookup(self, key) -> misc.Feedback|None:
+    with self.lock:
+      row = self.db.execute("SELECT feedback FROM results WHERE key = ?", (key,)).fetchone()
+      if row is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+    log.debug(f"Using cached result {key[:12]}")
+    feedback = json.loads(row[0])
+    return misc.Feedback(
+      overall_score=feedback["overall_score"],
+      overall_feedback=feedback["overall_feedback"],
+      # Stored as pairs, since json would turn the item numbers into strings
+      per_item_score=dict(feedback["per_item_score"]),
+      per_item_feedback=dict(feedback["per_item_feedback"])
+    )
+
+  def add(self, key, feedback: misc.Feedback):
+    if len(feedback.attachments) > 0:
+      # Attachments are file buffers, which we don't keep
+      return
+    feedback_json = json.dumps({
+      "overall_score": feedback.overall_score,
+      "overall_feedback": feedback.overall_feedback,
+      "per_item_score": list(feedback.per_item_score.items()),
+      "per_item_feedback": list(feedback.per_item_feedback.items()),
+    })
+    with self.lock:
+      with self.db:
+        self.db.execute(
+          "INSERT OR REPLACE INTO results (key, feedback, created_at) VALUES (?, ?, ?)",
+          (key, feedback_json, time.time())
+        )
+
+  def describe(self) -> str:
+    return f"result cache: {self.hits} hits, {self.misses} misses"
@@ -0,0 +1,161 @@
+#!env python
+from __future__ import annotations
+
+import logging
+import re
+import select
+import shlex
+import struct
+import time
+import typing
+import uuid
+
+import docker
+import docker.models.containers
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+class ShellSession:
+  """
+  One long-running bash attached over a socket, so that a series of commands run like they would in a terminal
+  (cd, exported variables, etc. carry over) without paying for a new exec per command.
+  Each command is followed by markers on stdout and stderr that are unique to it, and its output is everything read
+  from the multiplexed stream before them.  If the shell exits the next command gets a new shell.
+  Commands only time out if a timeout is given.  The shell is then replaced, and the working directory and exported
+  variables from before the command that timed out are put back into the new one.
+  """
+  # Variables that describe the container or shell itself rather than anything the commands set up
+  UNSAVED_VARIABLES = {"HOSTNAME", "PWD", "OLDPWD", "SHLVL", "_"}
+
+  def __init__(self, client: docker.DockerClient, container: docker.models.containers.Container, timeout=None):
+    """
+    :param timeout: Seconds each command gets, or None to wait as long as it takes
+    """
+    self.client = client
+    self.container = container
+    self.timeout = timeout
+    # From get_state, kept up to date after every command when there is a timeout so it can be put back after one
+    self.state : str|None = None
+    self.exec_id = None
+    self.socket = None
+    self.raw_socket = None
+
+  def start(self):
+    self.exec_id = self.client.api.exec_create(
+      self.container.id,
+      ["bash", "--noprofile", "--norc"],
+      stdin=True,
+      stdout=True,
+      stderr=True,
+      tty=False
+    )["Id"]
+    self.socket = self.client.api.exec_start(self.exec_id, socket=True)
+    self.raw_socket = getattr(self.socket, "_sock", self.socket)
+
+  def close(self):
+    if self.socket is not None:
+      try:
+        self.socket.close()
+      except OSError:
+        pass
+    self.exec_id = None
+    self.socket = None
+    self.raw_socket = None
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+    return False
+
+  def recv_exactly(self, num_bytes, deadline) -> bytes:
+    data = b""
+    while len(data) < num_bytes:
+      if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          raise TimeoutError()
+        ready, _, _ = select.select([self.raw_socket], [], [], remaining)
+        if len(ready) == 0:
+          raise TimeoutError()
+      chunk = self.raw_socket.recv(num_bytes - len(data))
+      if len(chunk) == 0:
+        raise EOFError()
+      data += chunk
+    return data
+
+  def run(self, command, timeout=None) -> typing.Tuple[int, bytes|None, bytes|None]:
+    """
+    Run command in the shell.
+    :return: (rc, stdout, stderr), like exec_run(demux=True).  rc is 124 if the command timed out.
+    """
+    rc, stdout, stderr = self.run_command(command, timeout)
+    if rc == 124 and self.socket is None:
+      # It timed out, so carry on from where the old shell was before the command
+      if self.state is not None:
+        self.run_command(self.state)
+    elif self.timeout is not None and self.socket is not None:
+      self.state = self.get_state()
+    return rc, stdout, stderr
+  
+  def run_command(self, command, timeout=None) -> typing.Tuple[int, bytes|None, bytes|None]:
+    if self.socket is None:
+      self.start()
+    timeout = timeout if timeout is not None else self.timeout
+    deadline = (time.time() + timeout) if timeout is not None else None
+
+    marker = f"__GRADING_{uuid.uuid4().hex}__"
+    # eval keeps a malformed command from leaving the shell waiting on more input, and /dev/null keeps the command
+    # from reading the rest of what we send
+    self.raw_socket.sendall((
+      f"eval {shlex.quote(command)} < /dev/null\n"
+      f"__rc=$?; printf '\\n{marker} %d\\n' \"$__rc\"; printf '\\n{marker}\\n' >&2\n"
+    ).encode())
+
+    stdout_marker = re.compile(rf"\n{marker} (\d+)\n".encode())
+    stderr_marker = f"\n{marker}\n".encode()
+    outputs = {1: b"", 2: b""}
+    stdout_match = None
+
+    def as_output(output: bytes) -> bytes|None:
+      return output if len(output) > 0 else None
+
+    try:
+      while stdout_match is None or stderr_marker not in outputs[2]:
+        stream, size = struct.unpack(">BxxxL", self.recv_exactly(8, deadline))
+        outputs[stream] = outputs.get(stream, b"") + self.recv_exactly(size, deadline)
+        if stdout_match is None:
+          stdout_match = stdout_marker.search(outputs[1])
+    except TimeoutError:
+      log.warning(f"Timed out after running '{command}', starting a new shell")
+      self.close()
+      return 124, as_output(outputs[1]), as_output(outputs[2])
+    except EOFError:
+      # e.g. the command was exit
+      rc = self.client.api.exec_inspect(self.exec_id).get("ExitCode")
+      self.close()
+      return rc, as_output(outputs[1]), as_output(outputs[2])
+
+    return (
+      int(stdout_match.group(1)),
+      as_output(outputs[1][:stdout_match.start()]),
+      as_output(outputs[2][:outputs[2].index(stderr_marker)])
+    )
+
+  def get_state(self) -> str:
+    """A script that puts another shell in the same working directory with the same exported variables"""
+    rc, stdout, stderr = self.run_command("printf 'cd %q\\n' \"$PWD\"; export -p")
+    lines = (stdout or b"").decode(errors="replace").splitlines()
+    return '\n'.join(
+      line for line in lines
+      if not (line.startswith("declare -x ") and line[len("declare -x "):].split("=")[0] in self.UNSAVED_VARIABLES)
+    )
+
+  def restore_state(self, state: str):
+    self.run_command(state)
+    self.state = state
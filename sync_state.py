@@ -0,0 +1,138 @@
+#!env python
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+from typing import Dict, Iterable, Iterator, List, Set
+
+import canvasapi.submission
+
+import misc
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+class SyncState:
+  """
+  What we have already graded for a (course, assignment), so repeated runs only need to look at what changed.
+
+  We keep a submitted_at watermark, which is passed to canvas as submitted_since, and the ids of every attachment we
+  have already graded and pushed, which catches anything the watermark lets through twice.  The watermark only moves
+  after a run that listed every ungraded submission (no limit or user filter) and got all of them graded, since
+  otherwise students that were never listed could have submitted before it and would be skipped from then on.
+  Partial runs leave it where it was and rely on the attachment ids instead.
+  Students left outstanding at the end of a run are remembered as retry_user_ids, since one whose grade reached canvas
+  but whose comments didn't is no longer "submitted" there, and so would otherwise never be listed again.
+  """
+
+  def __init__(self, course_id: int, assignment_id: int, canvas_url: str|None = None, cache_dir=None):
+    if cache_dir is None:
+      cache_dir = misc.get_cache_dir("sync")
+    host = urllib.parse.urlparse(canvas_url).netloc if canvas_url is not None else "canvas"
+    self.state_path = os.path.join(cache_dir, f"{host}_{course_id}_{assignment_id}.json")
+
+    self.submitted_at_watermark : str|None = None
+    self.graded_at_watermark : str|None = None
+    self.graded_attachment_ids : Set[int] = set()
+    self.retry_user_ids : Set[int] = set()
+
+    # Submissions seen this run that we haven't finished with yet, keyed by user_id
+    self.outstanding_submissions : Dict[int, canvasapi.submission.Submission] = {}
+    self.newest_graded_submitted_at : str|None = None
+    # Whether this run listed every ungraded submission, i.e. it wasn't cut short by a limit or filtered to some users
+    self.listing_complete = False
+    self.lock = threading.Lock()
+
+    self.load()
+
+  def load(self):
+    if not os.path.exists(self.state_path):
+      return
+    try:
+      with open(self.state_path) as fid:
+        state = json.load(fid)
+    except (OSError, json.JSONDecodeError) as e:
+      log.warning(f"Could not read sync state {self.state_path}, starting fresh: {e}")
+      return
+    self.submitted_at_watermark = state.get("submitted_at_watermark")
+    self.graded_at_watermark = state.get("graded_at_watermark")
+    self.graded_attachment_ids = set(state.get("graded_attachment_ids", []))
+    self.retry_user_ids = set(state.get("retry_user_ids", []))
+    log.debug(f"Loaded sync state: submitted_at >= {self.submitted_at_watermark}, {len(self.graded_attachment_ids)} graded attachments")
+
+  def save(self):
+    with self.lock:
+      # Only move past what we've seen if we saw everything and got through all of it
+      new_watermark = self.newest_graded_submitted_at
+      if not self.listing_complete or len(self.outstanding_submissions) > 0:
+        if new_watermark is not None:
+          log.debug("Not every ungraded submission was listed and graded this run, leaving the submitted_at watermark as is")
+        new_watermark = None
+      if new_watermark is not None and (self.submitted_at_watermark is None or new_watermark > self.submitted_at_watermark):
+        self.submitted_at_watermark = new_watermark
+
+      self.retry_user_ids.update(self.outstanding_submissions.keys())
+      state = {
+        "submitted_at_watermark": self.submitted_at_watermark,
+        "graded_at_watermark": self.graded_at_watermark,
+        "graded_attachment_ids": sorted(self.graded_attachment_ids),
+        "retry_user_ids": sorted(self.retry_user_ids),
+        "last_sync": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+      }
+    tmp_path = f"{self.state_path}.part"
+    with open(tmp_path, 'w') as fid:
+      json.dump(state, fid, indent=2)
+    os.replace(tmp_path, self.state_path)
+    log.debug(f"Saved sync state, submitted_at watermark is now {self.submitted_at_watermark}")
+
+  def reset(self):
+    """Forget everything, for a full resync.  Students still owed a retry are kept, since canvas won't list them."""
+    self.submitted_at_watermark = None
+    self.graded_at_watermark = None
+    self.graded_attachment_ids = set()
+
+  @staticmethod
+  def get_latest_attachment_ids(submission: canvasapi.submission.Submission) -> List[int]:
+    for submission_attempt in getattr(submission, "submission_history", [])[::-1]:
+      if "attachments" in submission_attempt:
+        return [attachment["id"] for attachment in submission_attempt["attachments"]]
+    return []
+
+  def needs_grading(self, submission: canvasapi.submission.Submission) -> bool:
+    attachment_ids = self.get_latest_attachment_ids(submission)
+    if len(attachment_ids) == 0:
+      return True
+    return not all(attachment_id in self.graded_attachment_ids for attachment_id in attachment_ids)
+
+  def filter_submissions(self, submissions: Iterable[canvasapi.submission.Submission], skip_graded=True) -> Iterator[canvasapi.submission.Submission]:
+    """
+    Lazily drop submissions whose latest attachments were already graded, and track the rest until they are graded.
+    :param skip_graded: If False, nothing is dropped but submissions are still tracked (e.g. for a regrade)
+    """
+    for submission in submissions:
+      graded_at = getattr(submission, "graded_at", None)
+      if graded_at is not None and (self.graded_at_watermark is None or graded_at > self.graded_at_watermark):
+        self.graded_at_watermark = graded_at
+      if skip_graded and not self.needs_grading(submission):
+        log.debug(f"Already graded latest attachments for {submission.user_id}, skipping")
+        self.retry_user_ids.discard(submission.user_id)
+        continue
+      self.outstanding_submissions[submission.user_id] = submission
+      yield submission
+
+  def record_graded(self, user_id: int):
+    with self.lock:
+      submission = self.outstanding_submissions.pop(user_id, None)
+      if submission is None:
+        return
+      self.retry_user_ids.discard(user_id)
+      self.graded_attachment_ids.update(self.get_latest_attachment_ids(submission))
+      submitted_at = getattr(submission, "submitted_at", None)
+      if submitted_at is not None and (self.newest_graded_submitted_at is None or submitted_at > self.newest_graded_submitted_at):
+        self.newest_graded_submitted_at = submitted_at
@@ -0,0 +1,39 @@
+import logging
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repo rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import assignment
+import benchmark
+import fake_canvas
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+  """Keep every cache (sync state, rosters, files, results) out of the real ~/.cache"""
+  cache_dir = tmp_path / "cache"
+  monkeypatch.setenv("GRADING_ASSISTANT_CACHE", str(cache_dir))
+  return cache_dir
+
+
+@pytest.fixture
+def canvas_server(monkeypatch):
+  """A fake canvas with 6 students waiting to be graded, which CanvasProgrammingAssignment(1, 1) connects to"""
+  data = fake_canvas.FakeCanvasData.generate_course(6, num_attachments=1, attachment_size=128)
+  with fake_canvas.FakeCanvasServer(data, progress_delay=0) as server:
+    monkeypatch.setenv("CANVAS_API_URL", server.url)
+    monkeypatch.setenv("CANVAS_API_KEY", "fake-key")
+    benchmark.reset_canvas_connection(assignment.CanvasProgrammingAssignment)
+    yield server
+  benchmark.reset_canvas_connection(assignment.CanvasProgrammingAssignment)
+
+
+@pytest.fixture(autouse=True)
+def quiet_logs():
+  logging.disable(logging.WARNING)
+  yield
+  logging.disable(logging.NOTSET)
@@ -0,0 +1,126 @@
+import pytest
+
+import assignment
+import benchmark
+import misc
+
+
+class FailingGrader(benchmark.BenchmarkGrader):
+  """Grades like BenchmarkGrader, except that grading the given students raises"""
+  def __init__(self, failing_user_ids=(), *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.failing_user_ids = set(failing_user_ids)
+
+  def grade_assignment(self, input_files, *args, student_id=None, **kwargs) -> misc.Feedback:
+    if student_id in self.failing_user_ids:
+      raise RuntimeError(f"Harness crashed on {student_id}")
+    return super().grade_assignment(input_files, *args, **kwargs)
+
+
+def student_ids(canvas_server):
+  return sorted(user_id for (_, user_id) in canvas_server.data.submissions.keys())
+
+
+def run_grading(grader, pipelined, patch=None, **kwargs):
+  with assignment.CanvasProgrammingAssignment(1, 1) as a:
+    if patch is not None:
+      patch(a)
+    a.prepare_assignment_for_grading(download=not pipelined)
+    feedback = a.grade(grader, push_feedback=True, pipelined=pipelined, **kwargs)
+    return feedback, a.sync_state
+
+
+def pending_user_ids():
+  """Who the next run would pick up"""
+  with assignment.CanvasProgrammingAssignment(1, 1) as a:
+    a.prepare_assignment_for_grading(download=False)
+    return sorted(submission.user_id for submission in a.submissions_to_download)
+
+
+def posted_scores(canvas_server):
+  return {user_id: submission["score"] for (_, user_id), submission in canvas_server.data.submissions.items()}
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_everyone_graded_and_pushed(canvas_server, pipelined):
+  feedback, state = run_grading(FailingGrader(), pipelined)
+  assert sorted(feedback.keys()) == student_ids(canvas_server)
+  assert all(score == 1.0 for score in posted_scores(canvas_server).values())
+  assert len(state.outstanding_submissions) == 0
+  assert state.submitted_at_watermark is not None
+  assert pending_user_ids() == []
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_grader_failure_only_loses_that_student(canvas_server, pipelined):
+  failing_user_id = student_ids(canvas_server)[2]
+  feedback, state = run_grading(FailingGrader([failing_user_id]), pipelined, grade_workers=2)
+
+  assert failing_user_id not in feedback
+  assert len(feedback) == len(student_ids(canvas_server)) - 1
+  scores = posted_scores(canvas_server)
+  assert scores.pop(failing_user_id) is None
+  assert all(score == 1.0 for score in scores.values())
+  # They stay ungraded, and the watermark can't move past them
+  assert list(state.outstanding_submissions.keys()) == [failing_user_id]
+  assert state.submitted_at_watermark is None
+  assert pending_user_ids() == [failing_user_id]
+
+
+def test_failed_comment_push_is_not_recorded_serial(canvas_server):
+  failing_user_id = student_ids(canvas_server)[1]
+
+  def patch(a: assignment.CanvasAssignment):
+    push_comments = a.push_comments
+    a.push_comments = lambda submission, *args, **kwargs: (
+      False if submission.user_id == failing_user_id else push_comments(submission, *args, **kwargs)
+    )
+
+  feedback, state = run_grading(FailingGrader(), False, patch=patch)
+  # The grade itself went out in the bulk update, but without its comments it needs pushing again
+  assert len(feedback) == len(student_ids(canvas_server))
+  assert list(state.outstanding_submissions.keys()) == [failing_user_id]
+  assert pending_user_ids() == [failing_user_id]
+
+
+def test_failed_push_is_not_recorded_pipelined(canvas_server):
+  failing_user_id = student_ids(canvas_server)[1]
+
+  def patch(a: assignment.CanvasAssignment):
+    push_feedback = a.push_feedback
+    a.push_feedback = lambda user_id, *args, **kwargs: (
+      False if user_id == failing_user_id else push_feedback(user_id, *args, **kwargs)
+    )
+
+  feedback, state = run_grading(FailingGrader(), True, patch=patch)
+  assert list(state.outstanding_submissions.keys()) == [failing_user_id]
+  assert pending_user_ids() == [failing_user_id]
+
+
+def test_failed_bulk_update_records_nobody(canvas_server):
+  def patch(a: assignment.CanvasAssignment):
+    a.wait_for_progress = lambda progress, *args, **kwargs: False
+
+  feedback, state = run_grading(FailingGrader(), False, patch=patch)
+  assert sorted(state.outstanding_submissions.keys()) == student_ids(canvas_server)
+  assert pending_user_ids() == student_ids(canvas_server)
+
+
+def test_push_feedback_batch_reports_failures(canvas_server):
+  user_ids = student_ids(canvas_server)
+  failing_user_id = user_ids[0]
+  with assignment.CanvasProgrammingAssignment(1, 1) as a:
+    push_comments = a.push_comments
+    a.push_comments = lambda submission, *args, **kwargs: (
+      False if submission.user_id == failing_user_id else push_comments(submission, *args, **kwargs)
+    )
+    assert a.push_feedback_batch({}) == set()
+    failed_user_ids = a.push_feedback_batch({
+      user_id: misc.Feedback(overall_score=3.0, overall_feedback="Nice work")
+      for user_id in user_ids
+    })
+  assert failed_user_ids == {failing_user_id}
+  assert all(score == 3.0 for score in posted_scores(canvas_server).values())
+  comments = {user_id: len(submission["submission_comments"]) for (_, user_id), submission in canvas_server.data.submissions.items()}
+  assert comments.pop(failing_user_id) == 0
+  assert all(num_comments == 1 for num_comments in comments.values())
@@ -0,0 +1,109 @@
+import threading
+import time
+
+import requests
+
+import downloader
+
+
+def make_response(remaining=None, history=()) -> requests.Response:
+  response = requests.Response()
+  if remaining is not None:
+    response.headers[downloader.AttachmentDownloader.RATE_LIMIT_HEADER] = str(remaining)
+  response.history = list(history)
+  return response
+
+
+def make_downloader(initial_workers=4, max_workers=8) -> downloader.AttachmentDownloader:
+  return downloader.AttachmentDownloader(
+    max_workers=max_workers,
+    initial_workers=initial_workers,
+    low_water_mark=200.0,
+    high_water_mark=500.0
+  )
+
+
+def test_limiter_clamps_limit():
+  limiter = downloader.ConcurrencyLimiter(10, min_limit=2, max_limit=6)
+  assert limiter.limit == 6
+  limiter.set_limit(0)
+  assert limiter.limit == 2
+  limiter.set_limit(100)
+  assert limiter.limit == 6
+
+
+def test_limiter_blocks_past_limit():
+  limiter = downloader.ConcurrencyLimiter(1)
+  entered = threading.Event()
+
+  def second_request():
+    with limiter:
+      entered.set()
+
+  with limiter:
+    t = threading.Thread(target=second_request)
+    t.start()
+    assert not entered.wait(0.1)
+  assert entered.wait(1)
+  t.join()
+
+
+def test_limiter_wakes_waiters_when_raised():
+  limiter = downloader.ConcurrencyLimiter(1, max_limit=2)
+  entered = threading.Event()
+
+  def second_request():
+    with limiter:
+      entered.set()
+
+  with limiter:
+    t = threading.Thread(target=second_request)
+    t.start()
+    time.sleep(0.05)
+    limiter.set_limit(2)
+    assert entered.wait(1)
+  t.join()
+
+
+def test_low_quota_halves_concurrency():
+  with make_downloader(initial_workers=4) as d:
+    d.update_from_response(make_response(remaining=100))
+    assert d.limiter.limit == 2
+    d.update_from_response(make_response(remaining=100))
+    d.update_from_response(make_response(remaining=100))
+    # Never below one worker
+    assert d.limiter.limit == 1
+
+
+def test_high_quota_adds_one_worker():
+  with make_downloader(initial_workers=4, max_workers=5) as d:
+    d.update_from_response(make_response(remaining=600))
+    assert d.limiter.limit == 5
+    d.update_from_response(make_response(remaining=600))
+    assert d.limiter.limit == 5
+
+
+def test_quota_between_water_marks_leaves_concurrency():
+  with make_downloader(initial_workers=4) as d:
+    d.update_from_response(make_response(remaining=300))
+    assert d.limiter.limit == 4
+
+
+def test_missing_or_bad_header_is_ignored():
+  with make_downloader(initial_workers=4) as d:
+    d.update_from_response(make_response())
+    d.update_from_response(make_response(remaining="lots"))
+    assert d.limiter.limit == 4
+
+
+def test_rate_limit_read_from_redirect_history():
+  # Canvas answers with a redirect to file storage, whose response doesn't carry the header
+  with make_downloader(initial_workers=4) as d:
+    d.update_from_response(make_response(history=[make_response(remaining=100)]))
+    assert d.limiter.limit == 2
+
+
+def test_lowest_reading_in_the_chain_wins():
+  with make_downloader(initial_workers=4) as d:
+    d.update_from_response(make_response(remaining=600, history=[make_response(remaining=100)]))
+    assert d.limiter.limit == 2
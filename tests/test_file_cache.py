@@ -0,0 +1,103 @@
+import errno
+import os
+
+import pytest
+
+import file_cache
+
+
+def make_attachment(attachment_id, size=5, updated_at="2026-01-01T10:00:00Z"):
+  return {"id": attachment_id, "size": size, "updated_at": updated_at}
+
+
+def write_file(path, contents: bytes) -> str:
+  with open(path, 'wb') as fid:
+    fid.write(contents)
+  return str(path)
+
+
+@pytest.fixture
+def cache(tmp_path):
+  with file_cache.SubmissionFileCache(tmp_path / "store", max_size=None) as cache:
+    yield cache
+
+
+def test_parse_size():
+  assert file_cache.parse_size("500") == 500
+  assert file_cache.parse_size("2K") == 2048
+  assert file_cache.parse_size("1.5MB") == int(1.5 * 1024**2)
+  assert file_cache.parse_size("10g") == 10 * 1024**3
+
+
+def test_add_and_lookup(cache, tmp_path):
+  blob_path = cache.add(make_attachment(1), write_file(tmp_path / "a.c", b"hello"))
+  assert cache.lookup(make_attachment(1)) == blob_path
+  # A resubmission changes updated_at, so it isn't found
+  assert cache.lookup(make_attachment(1, updated_at="2026-01-02T10:00:00Z")) is None
+
+
+def test_identical_files_share_a_blob(cache, tmp_path):
+  first = cache.add(make_attachment(1), write_file(tmp_path / "a.c", b"starter code"))
+  second = cache.add(make_attachment(2), write_file(tmp_path / "b.c", b"starter code"))
+  assert first == second
+  assert cache.get_total_size() == len(b"starter code")
+
+
+def test_lookup_forgets_missing_blobs(cache, tmp_path):
+  blob_path = cache.add(make_attachment(1), write_file(tmp_path / "a.c", b"hello"))
+  os.remove(blob_path)
+  assert cache.lookup(make_attachment(1)) is None
+  assert cache.get_total_size() == 0
+
+
+def test_link_hardlinks(cache, tmp_path):
+  blob_path = cache.add(make_attachment(1), write_file(tmp_path / "a.c", b"hello"))
+  local_path = str(tmp_path / "submission.c")
+  cache.link(blob_path, local_path)
+  assert os.path.samefile(blob_path, local_path)
+
+
+def test_link_replaces_existing_file(cache, tmp_path):
+  blob_path = cache.add(make_attachment(1), write_file(tmp_path / "a.c", b"hello"))
+  local_path = write_file(tmp_path / "submission.c", b"stale")
+  cache.link(blob_path, local_path)
+  with open(local_path, 'rb') as fid:
+    assert fid.read() == b"hello"
+
+
+def test_link_across_filesystems_copies(cache, tmp_path, monkeypatch):
+  blob_path = cache.add(make_attachment(1), write_file(tmp_path / "a.c", b"hello"))
+
+  def cross_device_link(src, dst):
+    raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+  monkeypatch.setattr(os, "link", cross_device_link)
+
+  local_path = str(tmp_path / "submission.c")
+  cache.link(blob_path, local_path)
+  assert not os.path.islink(local_path)
+
+  # The copy has to outlive the blob, since prune can evict it while the submission is still being graded
+  cache.prune(max_size=0)
+  assert not os.path.exists(blob_path)
+  with open(local_path, 'rb') as fid:
+    assert fid.read() == b"hello"
+
+
+def test_prune_evicts_least_recently_used(cache, tmp_path):
+  old_blob = cache.add(make_attachment(1), write_file(tmp_path / "a.c", b"a" * 10))
+  new_blob = cache.add(make_attachment(2), write_file(tmp_path / "b.c", b"b" * 10))
+  # Looking up the first one makes it the most recently used
+  cache.db.execute("UPDATE blobs SET last_used = 0")
+  cache.lookup(make_attachment(1))
+
+  assert cache.prune(max_size=15) == 10
+  assert os.path.exists(old_blob)
+  assert not os.path.exists(new_blob)
+  assert cache.lookup(make_attachment(2)) is None
+  assert cache.lookup(make_attachment(1)) == old_blob
+
+
+def test_prune_within_limit_does_nothing(cache, tmp_path):
+  cache.add(make_attachment(1), write_file(tmp_path / "a.c", b"hello"))
+  assert cache.prune(max_size=100) == 0
+  assert cache.prune() == 0
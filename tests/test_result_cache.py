@@ -0,0 +1,142 @@
+import concurrent.futures
+import threading
+
+import pytest
+
+import grader
+import misc
+import result_cache
+
+
+def write_file(path, contents: str) -> str:
+  with open(path, 'w') as fid:
+    fid.write(contents)
+  return str(path)
+
+
+@pytest.fixture
+def student_files(tmp_path):
+  return [
+    ("student_code.c", write_file(tmp_path / "student_code.c", "int main() { return 1; }")),
+    ("student_code.h", write_file(tmp_path / "student_code.h", "#define VALUE 1")),
+  ]
+
+
+def test_key_depends_on_contents_not_location(tmp_path, student_files):
+  key = result_cache.GradingResultCache.get_key(student_files, "PA1")
+  (tmp_path / "copy").mkdir()
+  copied_files = [(name, write_file(tmp_path / "copy" / name, open(path).read())) for name, path in student_files]
+  assert result_cache.GradingResultCache.get_key(copied_files, "PA1") == key
+  # ...and on neither the order files are given in
+  assert result_cache.GradingResultCache.get_key(student_files[::-1], "PA1") == key
+
+  write_file(student_files[1][1], "#define VALUE 2")
+  assert result_cache.GradingResultCache.get_key(student_files, "PA1") != key
+
+
+def test_key_depends_on_names_and_parts(student_files):
+  key = result_cache.GradingResultCache.get_key(student_files, "PA1", "image-a")
+  assert result_cache.GradingResultCache.get_key(student_files, "PA2", "image-a") != key
+  assert result_cache.GradingResultCache.get_key(student_files, "PA1", "image-b") != key
+  # Which file a student's code is graded as matters, not just its bytes
+  swapped = [("student_code.h", student_files[0][1]), ("student_code.c", student_files[1][1])]
+  assert result_cache.GradingResultCache.get_key(swapped, "PA1", "image-a") != key
+
+
+def test_round_trip(cache_dir):
+  cache = result_cache.GradingResultCache()
+  feedback = misc.Feedback(overall_score=7.5, overall_feedback="Almost")
+  feedback.per_item_score[1] = 2.5
+  feedback.per_item_feedback[1] = "Check the edge case"
+  cache.add("key", feedback)
+
+  cached = cache.lookup("key")
+  assert cached.overall_score == 7.5
+  assert cached.overall_feedback == "Almost"
+  # Item numbers stay ints rather than coming back as json keys
+  assert cached.per_item_score == {1: 2.5}
+  assert cached.per_item_feedback == {1: "Check the edge case"}
+  assert cache.lookup("other key") is None
+  assert (cache.hits, cache.misses) == (1, 1)
+  cache.close()
+
+
+def test_feedback_with_attachments_is_not_cached(cache_dir):
+  cache = result_cache.GradingResultCache()
+  feedback = misc.Feedback(overall_score=1.0, overall_feedback="See attached")
+  feedback.attachments.append(object())
+  cache.add("key", feedback)
+  assert cache.lookup("key") is None
+  cache.close()
+
+
+class ScriptedGrader(grader.Grader_CST334):
+  """A Grader_CST334 whose runs hand back scripted scores instead of starting containers"""
+
+  def __init__(self, scores, timed_out=(), **kwargs):
+    super().__init__("PA1", adaptive_timeout=False, build_command=None, **kwargs)
+    self.scores = list(scores)
+    self.timed_out = list(timed_out)
+    self.num_runs = 0
+    self.lock = threading.Lock()
+
+  def start_environment_build(self, github_repo) -> concurrent.futures.Future:
+    future = concurrent.futures.Future()
+    future.set_result("fake-image")
+    return future
+
+  def get_image_id(self) -> str:
+    return "sha256:fake"
+
+  def grade_in_docker(self, student_files, programming_assignment, lint_bonus) -> misc.Feedback:
+    with self.lock:
+      run = self.num_runs
+      self.num_runs += 1
+    self.thread_state.timed_out = run in self.timed_out
+    return misc.Feedback(overall_score=self.scores[run % len(self.scores)])
+
+
+@pytest.fixture
+def submission(tmp_path):
+  return [write_file(tmp_path / "student_code.c", "int main() { return 0; }")]
+
+
+def test_stable_result_is_cached(cache_dir, submission):
+  first = ScriptedGrader([10.0])
+  assert first.grade_assignment(submission, student_id=1, num_repeats=5).overall_score == 10.0
+  # Stops once stable_repeats runs agree
+  assert first.num_runs == 3
+
+  second = ScriptedGrader([0.0])
+  assert second.grade_assignment(submission, student_id=1, num_repeats=5).overall_score == 10.0
+  assert second.num_runs == 0
+
+
+def test_timed_out_result_is_not_cached(cache_dir, submission):
+  first = ScriptedGrader([0.0], timed_out=[0])
+  assert first.grade_assignment(submission, student_id=1, num_repeats=5).overall_score == 0.0
+  # A timeout isn't repeated either
+  assert first.num_runs == 1
+
+  # It could have been a busy machine, so the next run grades it again
+  second = ScriptedGrader([10.0])
+  assert second.grade_assignment(submission, student_id=1, num_repeats=5).overall_score == 10.0
+  assert second.num_runs == 3
+
+
+def test_flaky_result_is_not_cached(cache_dir, submission):
+  first = ScriptedGrader([10.0, 5.0])
+  # Runs every repeat and keeps the worst
+  assert first.grade_assignment(submission, student_id=1, num_repeats=4).overall_score == 5.0
+  assert first.num_runs == 4
+
+  second = ScriptedGrader([10.0])
+  second.grade_assignment(submission, student_id=1, num_repeats=4)
+  assert second.num_runs == 3
+
+
+def test_cache_key_covers_build_target(cache_dir, submission):
+  ScriptedGrader([10.0]).grade_assignment(submission, student_id=1, num_repeats=5)
+  other_target = ScriptedGrader([0.0], build_target="unit_tests")
+  assert other_target.grade_assignment(submission, student_id=1, num_repeats=5).overall_score == 0.0
+  assert other_target.num_runs == 3
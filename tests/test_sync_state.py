@@ -0,0 +1,112 @@
+import types
+
+import sync_state
+
+
+def make_submission(user_id, submitted_at, attachment_ids, graded_at=None):
+  return types.SimpleNamespace(
+    user_id=user_id,
+    submitted_at=submitted_at,
+    graded_at=graded_at,
+    submission_history=[{"attempt": 1, "attachments": [{"id": attachment_id} for attachment_id in attachment_ids]}]
+  )
+
+
+SUBMISSIONS = [
+  make_submission(1, "2026-01-01T10:00:00Z", [101]),
+  make_submission(2, "2026-01-02T10:00:00Z", [102]),
+  make_submission(3, "2026-01-03T10:00:00Z", [103, 104]),
+]
+
+
+def run(state: sync_state.SyncState, submissions, graded_user_ids, listing_complete=True):
+  listed = list(state.filter_submissions(submissions))
+  state.listing_complete = listing_complete
+  for user_id in graded_user_ids:
+    state.record_graded(user_id)
+  state.save()
+  return listed
+
+
+def test_watermark_advances_when_everything_listed_is_graded(tmp_path):
+  state = sync_state.SyncState(1, 1, cache_dir=tmp_path)
+  run(state, SUBMISSIONS, [1, 2, 3])
+  assert state.submitted_at_watermark == "2026-01-03T10:00:00Z"
+  assert len(state.outstanding_submissions) == 0
+
+
+def test_watermark_holds_while_anyone_is_outstanding(tmp_path):
+  state = sync_state.SyncState(1, 1, cache_dir=tmp_path)
+  run(state, SUBMISSIONS, [2, 3])
+  assert state.submitted_at_watermark is None
+  assert list(state.outstanding_submissions.keys()) == [1]
+  # The ones that were graded are still skipped next time through their attachments
+  assert state.graded_attachment_ids == {102, 103, 104}
+
+
+def test_watermark_holds_after_partial_listing(tmp_path):
+  # e.g. a --limit run, which never saw the students past the limit
+  state = sync_state.SyncState(1, 1, cache_dir=tmp_path)
+  run(state, SUBMISSIONS[:2], [1, 2], listing_complete=False)
+  assert state.submitted_at_watermark is None
+
+
+def test_watermark_never_moves_backwards(tmp_path):
+  state = sync_state.SyncState(1, 1, cache_dir=tmp_path)
+  run(state, SUBMISSIONS, [1, 2, 3])
+  state = sync_state.SyncState(1, 1, cache_dir=tmp_path)
+  run(state, [make_submission(4, "2025-12-01T10:00:00Z", [105])], [4])
+  assert state.submitted_at_watermark == "2026-01-03T10:00:00Z"
+
+
+def test_state_persists_between_runs(tmp_path):
+  state = sync_state.SyncState(1, 1, canvas_url="https://canvas.example.edu", cache_dir=tmp_path)
+  run(state, SUBMISSIONS, [1, 2])
+
+  reloaded = sync_state.SyncState(1, 1, canvas_url="https://canvas.example.edu", cache_dir=tmp_path)
+  assert reloaded.graded_attachment_ids == {101, 102}
+  # Only the student that wasn't graded comes through again
+  assert [s.user_id for s in reloaded.filter_submissions(SUBMISSIONS)] == [3]
+
+
+def test_new_attachments_need_grading(tmp_path):
+  state = sync_state.SyncState(1, 1, cache_dir=tmp_path)
+  run(state, SUBMISSIONS, [1, 2, 3])
+  resubmission = make_submission(1, "2026-01-04T10:00:00Z", [106])
+  assert state.needs_grading(resubmission)
+  assert not state.needs_grading(SUBMISSIONS[0])
+
+
+def test_regrade_lists_everything(tmp_path):
+  state = sync_state.SyncState(1, 1, cache_dir=tmp_path)
+  run(state, SUBMISSIONS, [1, 2, 3])
+  assert len(list(state.filter_submissions(SUBMISSIONS, skip_graded=False))) == 3
+
+
+def test_corrupt_state_starts_fresh(tmp_path):
+  state = sync_state.SyncState(1, 1, cache_dir=tmp_path)
+  with open(state.state_path, 'w') as fid:
+    fid.write("{not json")
+  state = sync_state.SyncState(1, 1, cache_dir=tmp_path)
+  assert state.submitted_at_watermark is None
+  assert state.graded_attachment_ids == set()
+
+
+def test_outstanding_students_are_kept_for_retry(tmp_path):
+  state = sync_state.SyncState(1, 1, cache_dir=tmp_path)
+  run(state, SUBMISSIONS, [2, 3])
+
+  reloaded = sync_state.SyncState(1, 1, cache_dir=tmp_path)
+  assert reloaded.retry_user_ids == {1}
+  reloaded.reset()
+  assert reloaded.retry_user_ids == {1}
+  run(reloaded, SUBMISSIONS[:1], [1])
+  assert reloaded.retry_user_ids == set()
+
+
+def test_retry_dropped_once_already_graded(tmp_path):
+  state = sync_state.SyncState(1, 1, cache_dir=tmp_path)
+  run(state, SUBMISSIONS, [1, 2, 3])
+  state.retry_user_ids.add(1)
+  assert list(state.filter_submissions(SUBMISSIONS[:1])) == []
+  assert state.retry_user_ids == set()
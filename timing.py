@@ -0,0 +1,187 @@
+#!env python
+from __future__ import annotations
+
+import collections
+import contextlib
+import csv
+import dataclasses
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List
+
+import docker.errors
+import docker.models.containers
+
+import misc
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+@dataclasses.dataclass
+class Span:
+  name: str
+  start: float
+  duration: float
+  thread_id: int
+  student: str|None = None
+  args: Dict = dataclasses.field(default_factory=dict)
+
+
+class Timeline:
+  """
+  Spans of time spent in each phase of a grading run (image build, container start, file copy, exec, ...), tagged
+  with the student being graded (see misc.log_tag).  Can be summarised per phase and per student, and written out as
+  JSON, CSV or a Chrome trace (chrome://tracing or https://ui.perfetto.dev).
+  """
+
+  def __init__(self):
+    self.spans : List[Span] = []
+    self.lock = threading.Lock()
+    self.created_at = time.time()
+
+  @contextlib.contextmanager
+  def span(self, name, **args):
+    """Time the body of the with block.  Yields a dict that extra details (e.g. resource usage) can be added to."""
+    start = time.time()
+    try:
+      yield args
+    finally:
+      span = Span(
+        name=name,
+        start=start,
+        duration=(time.time() - start),
+        thread_id=threading.get_ident(),
+        student=(str(misc.log_context.tag) if getattr(misc.log_context, "tag", None) is not None else None),
+        args=args
+      )
+      with self.lock:
+        self.spans.append(span)
+
+  def summarize(self) -> Dict:
+    with self.lock:
+      spans = list(self.spans)
+
+    phases = collections.defaultdict(list)
+    students = collections.defaultdict(lambda: collections.defaultdict(float))
+    peak_stats = collections.defaultdict(dict)
+    for span in spans:
+      phases[span.name].append(span.duration)
+      if span.student is not None:
+        students[span.student][span.name] += span.duration
+        for stat in ["peak_memory_bytes", "peak_cpu_percent"]:
+          if stat in span.args:
+            peak_stats[span.student][stat] = max(peak_stats[span.student].get(stat, 0), span.args[stat])
+
+    return {
+      "wall_time": (max((span.start + span.duration for span in spans), default=self.created_at) - self.created_at),
+      "phases": {
+        name: {
+          "count": len(durations),
+          "total": sum(durations),
+          "mean": sum(durations) / len(durations),
+          "max": max(durations),
+        }
+        for name, durations in phases.items()
+      },
+      "students": {
+        student: {**phase_totals, **peak_stats.get(student, {})}
+        for student, phase_totals in students.items()
+      },
+    }
+
+  def log_summary(self):
+    summary = self.summarize()
+    for name, phase in sorted(summary["phases"].items(), key=(lambda item: -item[1]["total"])):
+      log.info(f"{name}: {phase['total']:0.2f}s over {phase['count']} ({phase['mean']:0.3f}s mean, {phase['max']:0.3f}s max)")
+
+  def write_report(self, path):
+    """Write the per-phase and per-student summary, as CSV if path ends in .csv and JSON otherwise"""
+    summary = self.summarize()
+    if path.endswith(".csv"):
+      phase_names = sorted(summary["phases"].keys())
+      with open(path, 'w', newline='') as fid:
+        writer = csv.writer(fid)
+        writer.writerow(["student"] + phase_names + ["peak_memory_bytes", "peak_cpu_percent"])
+        for student, totals in summary["students"].items():
+          writer.writerow(
+            [student]
+            + [round(totals.get(name, 0.0), 4) for name in phase_names]
+            + [totals.get("peak_memory_bytes"), totals.get("peak_cpu_percent")]
+          )
+        writer.writerow(["total"] + [round(summary["phases"][name]["total"], 4) for name in phase_names] + [None, None])
+    else:
+      with open(path, 'w') as fid:
+        json.dump(summary, fid, indent=2)
+    log.info(f"Wrote timing report to {path}")
+
+  def write_chrome_trace(self, path):
+    with self.lock:
+      spans = list(self.spans)
+    events = [
+      {
+        "name": span.name,
+        "cat": "grading",
+        "ph": "X",
+        "ts": (span.start - self.created_at) * 1e6,
+        "dur": span.duration * 1e6,
+        "pid": os.getpid(),
+        "tid": span.thread_id,
+        "args": {"student": span.student, **span.args},
+      }
+      for span in spans
+    ]
+    with open(path, 'w') as fid:
+      json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fid)
+    log.info(f"Wrote chrome trace to {path}")
+
+
+class ContainerStatsSampler:
+  """Polls a container's stats in the background and keeps the peak memory use and CPU percentage"""
+
+  def __init__(self, container: docker.models.containers.Container, interval=0.5):
+    self.container = container
+    self.interval = interval
+    self.peak_memory_bytes = 0
+    self.peak_cpu_percent = 0.0
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.previous_cpu = None
+
+  def __enter__(self):
+    self.thread.start()
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.stopped.set()
+    self.thread.join()
+    return False
+
+  def sample(self):
+    stats = self.container.stats(stream=False, one_shot=True)
+    memory_stats = stats.get("memory_stats", {})
+    self.peak_memory_bytes = max(self.peak_memory_bytes, memory_stats.get("max_usage", 0), memory_stats.get("usage", 0))
+
+    cpu_stats = stats.get("cpu_stats", {})
+    cpu = (cpu_stats.get("cpu_usage", {}).get("total_usage"), cpu_stats.get("system_cpu_usage"))
+    if None not in cpu and self.previous_cpu is not None:
+      cpu_delta = cpu[0] - self.previous_cpu[0]
+      system_delta = cpu[1] - self.previous_cpu[1]
+      if system_delta > 0:
+        cpu_percent = 100.0 * cpu_delta / system_delta * cpu_stats.get("online_cpus", 1)
+        self.peak_cpu_percent = max(self.peak_cpu_percent, cpu_percent)
+    if None not in cpu:
+      self.previous_cpu = cpu
+
+  def run(self):
+    while not self.stopped.is_set():
+      try:
+        self.sample()
+      except docker.errors.APIError as e:
+        log.debug(f"Could not sample stats for {self.container.short_id}: {e}")
+        return
+      self.stopped.wait(self.interval)